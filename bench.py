@@ -0,0 +1,253 @@
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from fake_librenms import FakeLibreNMS, serve
+
+# =======================
+# Benchmark: prod.py against the fake LibreNMS API
+# =======================
+# Runs prod.py's AlertHandler and recovery code in-process against
+# fake_librenms.py and reports:
+#   - alert intake: alerts/sec, p50/p99 acknowledgement latency, time until
+#     every force-down has been sent, API calls per alert
+#   - recovery passes: duration and devices/sec per fleet size, API calls per
+#     recovered device
+#
+#   python3 bench.py --devices 10000 --alerts 2000 --sizes 100,1000,10000
+#   python3 bench.py --engine async ...   (same runs against the asyncio engine)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark prod.py against a fake LibreNMS API.")
+    parser.add_argument("--devices", type=int, default=10000, help="fake fleet size")
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="fake API latency per request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of fake API requests failing with 500")
+    parser.add_argument("--recover-rate", type=float, default=1.0, help="fraction of devices whose port comes back up")
+    parser.add_argument("--alerts", type=int, default=1000, help="alerts replayed against the handler")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent alert senders")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="alerts per request; above 1 they go to /alerts/batch as JSON arrays")
+    parser.add_argument("--sizes", default="100,1000", help="comma-separated fleet sizes for recovery passes")
+    parser.add_argument("--fake-port", type=int, default=18099)
+    parser.add_argument("--port", type=int, default=15000, help="port for the handler under test")
+    parser.add_argument("--engine", choices=("threads", "async"), default="threads", help="prod.py engine to run")
+    parser.add_argument("--json", metavar="FILE", help="also write the results as JSON")
+    return parser.parse_args()
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+def alert_payload(fake, device_id):
+    """Same shape as the LibreNMS alert template in Output-example.txt."""
+    ip = fake.device_ip(device_id)
+    return {"host": ip, "device_id": str(device_id), "ip": ip}
+
+def send_alert(port, body, path="/"):
+    started = time.monotonic()
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        conn.request("POST", path, body=body, headers={"Content-Type": "application/json"})
+        status = conn.getresponse().status
+    except OSError:
+        status = None
+    finally:
+        conn.close()
+    return status, time.monotonic() - started
+
+def wait_for_intake(prod, timeout=300):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if isinstance(prod.RECOVERY, prod.AsyncRecoveryManager):
+            if not prod.ASYNC_SERVER.pending:
+                return True
+        elif not prod.COALESCER.pending and prod.FORCE_DOWN_QUEUE.depth() == 0:
+            return True
+        time.sleep(0.01)
+    return False
+
+def bench_intake(prod, fake, args):
+    count = min(args.alerts, args.devices)
+    alerts = [alert_payload(fake, d) for d in range(1, count + 1)]
+    if args.batch_size > 1:
+        path = "/alerts/batch"
+        payloads = [json.dumps(alerts[i:i + args.batch_size]).encode()
+                    for i in range(0, count, args.batch_size)]
+    else:
+        path = "/"
+        payloads = [json.dumps(alert).encode() for alert in alerts]
+    fake.reset_counters()
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda body: send_alert(args.port, body, path), payloads))
+    acked = time.monotonic() - started
+    drained = wait_for_intake(prod)
+    settled = time.monotonic() - started
+
+    latencies = [lat for _, lat in results]
+    statuses = {}
+    for status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    api = fake.snapshot()
+    return {
+        "alerts": count,
+        "requests": len(payloads),
+        "concurrency": args.concurrency,
+        "statuses": statuses,
+        "alerts_per_sec": count / acked if acked else None,
+        "ack_p50_ms": percentile(latencies, 50) * 1000,
+        "ack_p99_ms": percentile(latencies, 99) * 1000,
+        "all_forced_down_sec": settled if drained else None,
+        "api_calls": api["total"],
+        "api_calls_per_alert": api["total"] / count,
+        "api_errors": api["errors"],
+    }
+
+def checks_done(prod):
+    with prod.METRICS.lock:
+        return sum(v for (name, _), v in prod.METRICS.counters.items() if name == "recovery_checks_total")
+
+def run_async_checks(prod, loop, device_ids, timeout=600):
+    """Make every device due now on the async engine and wait for all checks."""
+    done_before = checks_done(prod)
+    now = time.time()
+    loop.call_soon_threadsafe(lambda: [prod.RECOVERY.schedule(d, now) for d in device_ids])
+    deadline = time.monotonic() + timeout
+    while checks_done(prod) - done_before < len(device_ids) and time.monotonic() < deadline:
+        time.sleep(0.005)
+
+def bench_recovery_pass(prod, fake, size, loop=None):
+    """Track `size` forced-down devices and time one recovery pass over them
+    (with `loop`, the async engine's checks of all of them)."""
+    now = datetime.now()
+    state = {}
+    for device_id in range(1, size + 1):
+        ip = fake.device_ip(device_id)
+        state[str(device_id)] = {
+            "hostname": ip, "ip": ip, "port_id": str(fake.port_id(device_id)),
+            "applied_ip": prod.UNSUPERVISED_IP, "added_at": (now - timedelta(minutes=5)).isoformat(),
+            "attempts": 0, "status": "active",
+            "next_check_at": (now + timedelta(days=1)).isoformat(),
+        }
+        with fake.lock:
+            fake.overwrite_ip[device_id] = prod.UNSUPERVISED_IP
+    for device_id in list(prod.RECOVERY.scheduled):
+        if loop is None:
+            prod.RECOVERY.unschedule(device_id)
+        else:
+            loop.call_soon_threadsafe(prod.RECOVERY.unschedule, device_id)
+    prod.STATE.replace_all(state)
+    fake.reset_counters()
+
+    started = time.monotonic()
+    if loop is None:
+        prod.RECOVERY._do_recovery_pass(list(state))
+    else:
+        run_async_checks(prod, loop, list(state))
+    elapsed = time.monotonic() - started
+
+    recovered = size - prod.STATE.count()
+    api = fake.snapshot()
+    return {
+        "devices": size,
+        "pass_sec": elapsed,
+        "devices_per_sec": size / elapsed if elapsed else None,
+        "recovered": recovered,
+        "api_calls": api["total"],
+        "api_calls_per_recovered": api["total"] / recovered if recovered else None,
+        "api_calls_by_route": api["calls"],
+        "api_errors": api["errors"],
+    }
+
+def print_report(results):
+    i = results["intake"]
+    print("\n=== Alert intake ===")
+    print(f"{i['alerts']} alerts in {i['requests']} requests, {i['concurrency']} senders, responses {i['statuses']}")
+    print(f"throughput        {i['alerts_per_sec']:.1f} alerts/s")
+    print(f"ack latency       p50 {i['ack_p50_ms']:.1f} ms, p99 {i['ack_p99_ms']:.1f} ms")
+    settled = i["all_forced_down_sec"]
+    print(f"all forced down   {'%.2f s' % settled if settled is not None else 'timed out'}")
+    print(f"API calls         {i['api_calls']} ({i['api_calls_per_alert']:.2f} per alert, {i['api_errors']} errors)")
+
+    print("\n=== Recovery pass vs fleet size ===")
+    print(f"{'devices':>8} {'pass s':>8} {'dev/s':>8} {'recovered':>10} {'API calls':>10} {'calls/rec':>10}")
+    for r in results["recovery"]:
+        per = f"{r['api_calls_per_recovered']:.2f}" if r["api_calls_per_recovered"] else "-"
+        print(f"{r['devices']:>8} {r['pass_sec']:>8.2f} {r['devices_per_sec']:>8.1f} "
+              f"{r['recovered']:>10} {r['api_calls']:>10} {per:>10}")
+
+def main():
+    args = parse_args()
+    sizes = [min(int(s), args.devices) for s in args.sizes.split(",") if s.strip()]
+    with tempfile.TemporaryDirectory(prefix="alert-bench-") as workdir:
+
+        # prod.py reads its configuration at import time; explicit env vars win.
+        defaults = {
+            "LIBRENMS_URL": f"http://127.0.0.1:{args.fake_port}/api/v0",
+            "LIBRENMS_API_TOKEN": "bench",
+            "STATE_FILE": os.path.join(workdir, "device_state.json"),
+            "STATE_DB": os.path.join(workdir, "device_state.db"),
+            "RECOVERY_INTERVAL_SEC": "86400",   # passes are driven by the benchmark
+            "POLL_BACKEND": "none",
+            "API_RATE_PER_SEC": "0",
+            "INTAKE_QUEUE_MAX": str(max(1000, args.alerts)),
+            "LOG_LEVEL": "ERROR",
+        }
+        for key, value in defaults.items():
+            os.environ.setdefault(key, value)
+
+        fake = FakeLibreNMS(args.devices, args.latency_ms, error_rate=args.error_rate,
+                            recover_rate=args.recover_rate)
+        serve(fake, port=args.fake_port)
+
+        import prod
+        prod.open_state()
+        loop = server = None
+        if args.engine == "async":
+            prod.RECOVERY = prod.AsyncRecoveryManager()
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="event-loop", daemon=True).start()
+            asyncio.run_coroutine_threadsafe(
+                prod.ASYNC_SERVER.serve("127.0.0.1", args.port, max(prod.HTTP_BACKLOG, args.concurrency * 2)),
+                loop).result()
+            loop.call_soon_threadsafe(prod.RECOVERY.start)
+        else:
+            if prod.INTAKE_MODE == "queue":
+                prod.FORCE_DOWN_QUEUE.start()
+            class BenchHTTPServer(prod.AlertHTTPServer):
+                request_queue_size = max(prod.HTTP_BACKLOG, args.concurrency * 2)
+
+            server = BenchHTTPServer(("127.0.0.1", args.port), prod.AlertHandler)
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name="handler", daemon=True).start()
+
+        intake = "async" if loop else prod.INTAKE_MODE
+        print(f"Benchmarking prod.py ({intake} intake, {prod.STATE_BACKEND} state, "
+              f"{prod.RECOVERY_CHECK_MODE} checks) against a fake fleet of {args.devices} devices "
+              f"at {args.latency_ms} ms/request.", flush=True)
+        results = {"config": vars(args), "intake": bench_intake(prod, fake, args), "recovery": []}
+        for size in sizes:
+            results["recovery"].append(bench_recovery_pass(prod, fake, size, loop))
+
+        prod.LOGGER.flush()
+        print_report(results)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
+            print(f"\nResults written to {args.json}")
+        if server is not None:
+            server.shutdown()
+        prod.STATE.flush()   # before the state files are removed with workdir
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,17 @@
 from http.server import BaseHTTPRequestHandler, HTTPServer
 import json
 import requests
+import shlex
 import time
 import threading
 import os
 import paramiko
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
+import librenms_common
+from librenms_common import COUNT_BUCKETS, METRICS, RECOVERY_BUCKETS, LibreClient, LocalPoller, endpoint_label
+
 # =======================
 # Config
 # =======================
@@ -15,11 +20,41 @@ API_TOKEN      = "4e66b5ae770fa19a0a0b846e18245341"
 UNSUPERVISED_IP = "127.0.0.50"
 STATE_FILE     = "device_state.json"
 
+# LibreNMS API client: pooled keep-alive session, timeouts, retries, rate limit
+API_POOL_SIZE       = 10
+API_CONNECT_TIMEOUT = 5
+API_READ_TIMEOUT    = 60
+API_MAX_RETRIES     = 3
+API_BACKOFF_SEC     = 0.5
+API_BACKOFF_MAX_SEC = 10
+API_RATE_PER_SEC    = 20  # 0 disables the limiter
+API_RATE_BURST      = 40
+
 # SSH to the LibreNMS host
 SSH_HOST = "192.168.150.136"
 SSH_USER = "test"
 SSH_PASS = "test"  # secure this (env var / file) in production
 
+# How device:poll is run: "ssh" (on SSH_HOST) or "local" (on this host, in a
+# bounded subprocess pool; use when the handler runs on the LibreNMS server)
+POLL_BACKEND        = "ssh"
+POLL_COMMAND        = "php /opt/librenms/artisan device:poll"
+POLL_CONCURRENCY    = 4
+POLL_TIMEOUT_SEC    = 300
+POLL_KILL_GRACE_SEC = 5
+
+# The SSH connection is kept open and shared; each poll runs on its own channel
+SSH_KEEPALIVE_SEC   = 30
+SSH_MAX_CHANNELS    = 4     # concurrent device:poll channels on the connection
+SSH_CONNECT_TIMEOUT = 10
+SSH_COMMAND_TIMEOUT = 600   # per single-device channel; a batch channel gets
+                            # POLL_TIMEOUT_SEC + POLL_KILL_GRACE_SEC per device it polls.
+                            # Both are enforced on the LibreNMS host with timeout(1).
+# True: restore all due devices first, then poll them together (over at most
+# SSH_MAX_CHANNELS channels, or POLL_CONCURRENCY local processes) instead of
+# one poll per device.
+SSH_BATCH_POLL = True
+
 # If your user still needs sudo for docker, set this True
 SUDO_FOR_DOCKER = False
 DOCKER_CONTAINER = "librenms"
@@ -32,6 +67,8 @@ RECOVERY_INTERVAL_SEC = 60  # 20 minutes
 def log(msg):
     print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {msg}")
 
+librenms_common.use_logger(log)
+
 def load_state():
     if os.path.exists(STATE_FILE):
         try:
@@ -50,8 +87,25 @@ def save_state(state):
         json.dump(state, f, indent=2)
     os.replace(tmp, STATE_FILE)
 
+# =======================
+# Metrics
+# =======================
+# Metrics, TokenBucket, LibreClient and LocalPoller live in librenms_common (shared with prod.py).
+METRICS.counter("alerts_received_total", "Alert webhooks received.")
+METRICS.counter("alerts_rejected_total", "Alert webhooks rejected, by reason.")
+METRICS.histogram("alert_handling_seconds", "Time to handle an alert webhook.")
+METRICS.histogram("api_request_seconds", "LibreNMS API call latency, by method, endpoint and status.")
+METRICS.histogram("poll_seconds", "device:poll duration, by backend and outcome.")
+METRICS.histogram("recovery_pass_seconds", "Duration of a recovery pass.")
+METRICS.histogram("recovery_pass_devices", "Devices checked per recovery pass.", COUNT_BUCKETS)
+METRICS.histogram("recovery_pass_recovered", "Devices recovered per recovery pass.", COUNT_BUCKETS)
+METRICS.histogram("time_to_recovery_seconds", "Time from first alert to recovery.", RECOVERY_BUCKETS)
+METRICS.gauge("devices_tracked", "Devices currently tracked in state.", lambda: len(load_state()))
+
+API = LibreClient(LIBRENMS_URL, API_TOKEN, API_POOL_SIZE, API_CONNECT_TIMEOUT, API_READ_TIMEOUT,
+                  API_MAX_RETRIES, API_BACKOFF_SEC, API_BACKOFF_MAX_SEC, API_RATE_PER_SEC, API_RATE_BURST)
+
 def libre_api(method, endpoint, data=None, params=None):
-    headers = {"X-Auth-Token": API_TOKEN, "Content-Type": "application/json"}
     url = f"{LIBRENMS_URL}{endpoint}"
 
     log(f"\n--- LibreNMS API Request ---")
@@ -61,7 +115,10 @@ def libre_api(method, endpoint, data=None, params=None):
         log(f"PARAMS: {params}")
     log(f"DATA:   {json.dumps(data, indent=2) if data else None}")
 
-    r = requests.request(method, url, headers=headers, json=data, params=params)
+    with METRICS.timer("api_request_seconds", method=method, endpoint=endpoint_label(endpoint),
+                       status="error") as labels:
+        r = API.request(method, endpoint, data=data, params=params)
+        labels["status"] = r.status_code
 
     log(f"--- LibreNMS API Response ---")
     log(f"STATUS: {r.status_code}")
@@ -79,25 +136,175 @@ def libre_api(method, endpoint, data=None, params=None):
             return None
     return None
 
-def ssh_poll_device(host_or_id):
-    cmd = f"php /opt/librenms/artisan device:poll {host_or_id}"
-    full_cmd = cmd
+class SSHPool:
+    """Long-lived SSH connection to the LibreNMS host.
+
+    One authenticated transport is kept open with keepalives and reopened on
+    demand when it drops. Every command runs on its own channel, up to
+    SSH_MAX_CHANNELS at once, so concurrent polls share a single key
+    exchange and login. Output is logged line by line as it arrives.
+    Commands run under timeout(1) on the remote side, so one that overruns
+    is killed there rather than left running when we stop waiting.
+    """
+    def __init__(self, host, user, password, max_channels=SSH_MAX_CHANNELS,
+                 keepalive_sec=SSH_KEEPALIVE_SEC):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.keepalive_sec = keepalive_sec
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_channels)
+        self.client = None
 
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    def _transport(self):
+        with self.lock:
+            transport = self.client.get_transport() if self.client else None
+            if transport is None or not transport.is_active():
+                if self.client:
+                    self.client.close()
+                client = paramiko.SSHClient()
+                client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                client.connect(hostname=self.host, username=self.user, password=self.password,
+                               timeout=SSH_CONNECT_TIMEOUT)
+                transport = client.get_transport()
+                transport.set_keepalive(self.keepalive_sec)
+                self.client = client
+                log(f"🔐 SSH connection to {self.host} established.")
+            return transport
+
+    def _reset(self):
+        with self.lock:
+            if self.client:
+                self.client.close()
+            self.client = None
+
+    def run(self, cmd, timeout=SSH_COMMAND_TIMEOUT, on_line=None):
+        """Run `cmd` on a fresh channel, streaming its output (each stdout
+        line also goes to `on_line`); returns the exit status, 124 when the
+        remote timeout killed it."""
+        with self.slots:
+            try:
+                chan = self._transport().open_session(timeout=SSH_CONNECT_TIMEOUT)
+            except (paramiko.SSHException, OSError, EOFError):
+                # Stale connection (e.g. the server restarted): reconnect once.
+                self._reset()
+                chan = self._transport().open_session(timeout=SSH_CONNECT_TIMEOUT)
+            try:
+                return self._stream(chan, cmd, timeout, on_line)
+            finally:
+                chan.close()
+
+    def _stream(self, chan, cmd, timeout, on_line):
+        log(f"Running SSH poll command: {cmd}")
+        chan.exec_command(f"timeout -k {POLL_KILL_GRACE_SEC} {timeout} sh -c {shlex.quote(cmd)}")
+        partial = {"STDOUT": b"", "STDERR": b""}
+        readers = {"STDOUT": (chan.recv_ready, chan.recv),
+                   "STDERR": (chan.recv_stderr_ready, chan.recv_stderr)}
+        # The remote timeout fires first; this only guards against a hung channel.
+        deadline = time.monotonic() + timeout + POLL_KILL_GRACE_SEC + SSH_CONNECT_TIMEOUT
+
+        def drain(final=False):
+            got = False
+            for name, (ready, recv) in readers.items():
+                while ready():
+                    partial[name] += recv(32768)
+                    got = True
+                *lines, partial[name] = partial[name].split(b"\n")
+                if final and partial[name]:
+                    lines.append(partial[name])
+                    partial[name] = b""
+                for line in lines:
+                    if line.strip():
+                        text = line.decode(errors='replace')
+                        log(f"SSH {name}: {text}")
+                        if on_line and name == "STDOUT":
+                            on_line(text.strip())
+            return got
+
+        while not chan.exit_status_ready():
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"SSH command timed out after {timeout}s: {cmd}")
+            if not drain():
+                time.sleep(0.05)
+        drain(final=True)
+        return chan.recv_exit_status()
+
+SSH_POOL = SSHPool(SSH_HOST, SSH_USER, SSH_PASS)
+
+POLL_STATUS_MARK = "POLL-STATUS"
+
+def poll_command(host_or_id):
+    return (f"timeout -k {POLL_KILL_GRACE_SEC} {POLL_TIMEOUT_SEC} "
+            + shlex.join(shlex.split(POLL_COMMAND) + [str(host_or_id)]))
+
+def log_poll_status(host_or_id, status):
+    if status is None:
+        log(f"⚠️ device:poll {host_or_id} reported no status (its channel failed or timed out first)")
+    elif status in (124, 137):
+        log(f"⚠️ device:poll {host_or_id} timed out; killed on the LibreNMS host")
+    elif status != 0:
+        log(f"⚠️ device:poll {host_or_id} exited with status {status}")
+
+def ssh_poll_device(host_or_id):
     try:
-        ssh.connect(hostname=SSH_HOST, username=SSH_USER, password=SSH_PASS)
-        log(f"Running SSH poll command: {full_cmd}")
-        stdin, stdout, stderr = ssh.exec_command(full_cmd)
-        out = stdout.read().decode()
-        err = stderr.read().decode()
-        log(f"SSH STDOUT:\n{out}")
-        if err.strip():
-            log(f"SSH STDERR:\n{err}")
+        with METRICS.timer("poll_seconds", backend="ssh", outcome="failed") as labels:
+            status = SSH_POOL.run(poll_command(host_or_id))
+            if status == 0:
+                labels["outcome"] = "ok"
+        log_poll_status(host_or_id, status)
     except Exception as e:
         log(f"⚠️ SSH polling failed: {e}")
-    finally:
-        ssh.close()
+
+def ssh_poll_devices(hosts_or_ids):
+    """Poll many devices over at most SSH_MAX_CHANNELS channels, each channel
+    running its share of device:poll invocations back to back. Every poll
+    echoes a POLL-STATUS:<device>:<exit status> line, so each device's
+    outcome is reported on its own."""
+    hosts_or_ids = list(hosts_or_ids)
+    if not hosts_or_ids:
+        return
+    channels = min(SSH_MAX_CHANNELS, len(hosts_or_ids))
+    groups = [hosts_or_ids[i::channels] for i in range(channels)]
+    log(f"📡 Polling {len(hosts_or_ids)} devices over {channels} SSH channels.")
+
+    def run_group(group):
+        statuses = {}
+
+        def on_line(line):
+            mark, _, rest = line.partition(":")
+            host, _, status = rest.rpartition(":")
+            if mark == POLL_STATUS_MARK and status.isdigit():
+                statuses[host] = int(status)
+
+        cmd = "; ".join(f"{poll_command(h)}; echo {POLL_STATUS_MARK}:{shlex.quote(str(h))}:$?" for h in group)
+        try:
+            with METRICS.timer("poll_seconds", backend="ssh_batch", outcome="failed") as labels:
+                # Room for every poll of the group to run to its own timeout.
+                SSH_POOL.run(cmd, timeout=len(group) * (POLL_TIMEOUT_SEC + POLL_KILL_GRACE_SEC)
+                             + SSH_CONNECT_TIMEOUT, on_line=on_line)
+                if all(statuses.get(str(h)) == 0 for h in group):
+                    labels["outcome"] = "ok"
+        except Exception as e:
+            log(f"⚠️ SSH batch polling failed for {group}: {e}")
+        for h in group:
+            log_poll_status(h, statuses.get(str(h)))
+
+    with ThreadPoolExecutor(max_workers=channels, thread_name_prefix="ssh-poll") as pool:
+        list(pool.map(run_group, groups))
+
+LOCAL_POLLER = LocalPoller(POLL_COMMAND, POLL_CONCURRENCY, POLL_TIMEOUT_SEC, POLL_KILL_GRACE_SEC)
+
+def poll_device(host_or_id):
+    if POLL_BACKEND == "local":
+        LOCAL_POLLER.poll(host_or_id)
+    else:
+        ssh_poll_device(host_or_id)
+
+def poll_devices(hosts_or_ids):
+    if POLL_BACKEND == "local":
+        LOCAL_POLLER.poll_many(hosts_or_ids)
+    else:
+        ssh_poll_devices(hosts_or_ids)
 
 def find_port_id_for_dialer(device_id_or_host, target_ifname="port2"):
     """
@@ -186,7 +393,8 @@ class RecoveryManager:
                 if wait_s > 0:
                     self.cv.wait(timeout=wait_s)
 
-            self._do_recovery_pass()
+            with METRICS.timer("recovery_pass_seconds"):
+                self._do_recovery_pass()
 
             with self.lock:
                 self.next_run_at = datetime.now() + timedelta(seconds=RECOVERY_INTERVAL_SEC)
@@ -197,8 +405,11 @@ class RecoveryManager:
             return
 
         log("🔁 Starting recovery pass for all tracked devices.")
+        METRICS.observe("recovery_pass_devices", len(state))
         changed = False
+        recovered = 0
 
+        restored = {}
         for device_id, info in list(state.items()):
             hostname = info.get("hostname")
             original_ip = info.get("ip")
@@ -208,8 +419,24 @@ class RecoveryManager:
 
             try:
                 restore_device_ip(device_id, original_ip)
-                ssh_poll_device(device_id)
+                if not SSH_BATCH_POLL:
+                    poll_device(device_id)
+                restored[device_id] = info
+            except requests.HTTPError as e:
+                log(f"⚠️ HTTP error during recovery for {hostname}: {e}")
+            except Exception as e:
+                log(f"⚠️ Unexpected error during recovery for {hostname}: {e}")
+
+        if SSH_BATCH_POLL:
+            poll_devices(restored)
+
+        repoll = []
+        for device_id, info in restored.items():
+            hostname = info.get("hostname")
+            original_ip = info.get("ip")
+            port_id = info.get("port_id")
 
+            try:
                 if not port_id:
                     log("ℹ️ No port_id in state; attempting to re-detect.")
                     port_id = find_port_id_for_dialer(device_id)
@@ -218,23 +445,35 @@ class RecoveryManager:
                         save_state(state)
 
                 status = get_port_oper_status(port_id) if port_id else None
-                log(f"Dialer 1 ifOperStatus = {status}")
+                log(f"{hostname}: Dialer 1 ifOperStatus = {status}")
 
                 if status and status.lower() == "up":
                     log(f"✅ {hostname} recovered (Dialer 1 is UP). Removing from state.")
                     del state[device_id]
                     save_state(state)
                     changed = True
+                    recovered += 1
+                    try:
+                        METRICS.observe("time_to_recovery_seconds",
+                                        (datetime.now() - datetime.fromisoformat(info["added_at"])).total_seconds())
+                    except (KeyError, TypeError, ValueError):
+                        pass
                 else:
                     log(f"❌ {hostname} still not healthy; forcing UNSUPERVISED_IP again.")
                     force_device_down(device_id)
-                    ssh_poll_device(original_ip)
+                    if SSH_BATCH_POLL:
+                        repoll.append(original_ip)
+                    else:
+                        poll_device(original_ip)
 
             except requests.HTTPError as e:
                 log(f"⚠️ HTTP error during recovery for {hostname}: {e}")
             except Exception as e:
                 log(f"⚠️ Unexpected error during recovery for {hostname}: {e}")
 
+        poll_devices(repoll)
+        METRICS.observe("recovery_pass_recovered", recovered)
+
         if not load_state():
             log("🎉 All devices recovered; recovery loop will pause until next alert.")
         elif changed:
@@ -246,7 +485,28 @@ RECOVERY = RecoveryManager()
 # HTTP Handler
 # =======================
 class AlertHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/metrics":
+            body, ctype = METRICS.render().encode(), "text/plain; version=0.0.4; charset=utf-8"
+        elif path == "/healthz":
+            body, ctype = json.dumps({"status": "ok", "devices_tracked": len(load_state())}).encode(), "application/json"
+        else:
+            self.send_response(404)
+            self.end_headers()
+            self.wfile.write(b"Not found")
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.end_headers()
+        self.wfile.write(body)
+
     def do_POST(self):
+        METRICS.inc("alerts_received_total")
+        with METRICS.timer("alert_handling_seconds"):
+            self._handle_alert()
+
+    def _handle_alert(self):
         content_length = int(self.headers.get("Content-Length", 0))
         raw = self.rfile.read(content_length)
 
@@ -258,6 +518,7 @@ class AlertHandler(BaseHTTPRequestHandler):
             payload = json.loads(raw)
         except json.JSONDecodeError as e:
             log(f"⚠️ JSON decode error: {e}")
+            METRICS.inc("alerts_rejected_total", reason="invalid_json")
             self.send_response(400)
             self.end_headers()
             self.wfile.write(b"Invalid JSON")
@@ -276,6 +537,7 @@ class AlertHandler(BaseHTTPRequestHandler):
 
         if not all([device_id, hostname, ip]):
             log("⚠️ Missing device_id/hostname/ip in alert; ignoring.")
+            METRICS.inc("alerts_rejected_total", reason="missing_fields")
             self.send_response(400)
             self.end_headers()
             self.wfile.write(b"Missing required fields")
@@ -308,6 +570,12 @@ class AlertHandler(BaseHTTPRequestHandler):
 # Main
 # =======================
 if __name__ == "__main__":
-    log("HTTP server listening on 0.0.0.0:5000 for LibreNMS alerts...")
     server = HTTPServer(("0.0.0.0", 5000), AlertHandler)
+    tracked = load_state()
+    if tracked:
+        # Devices left forced down by a previous run are checked right away
+        # instead of waiting for the next alert to start the loop.
+        log(f"▶️ Resuming recovery for {len(tracked)} devices from {STATE_FILE}.")
+        RECOVERY.start_if_needed(delay_sec=0)
+    log("HTTP server listening on 0.0.0.0:5000 for LibreNMS alerts...")
     server.serve_forever()
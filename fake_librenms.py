@@ -0,0 +1,222 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+
+# =======================
+# Fake LibreNMS API
+# =======================
+# Just enough of /api/v0 for the handlers: overwrite_ip PATCHes, discovery,
+# port lookups and port status. Used by bench.py, or standalone to point a
+# handler at (LIBRENMS_URL=http://127.0.0.1:8099/api/v0).
+
+IFNAMES = ("port1", "port2")
+
+ROUTES = [
+    ("PATCH", re.compile(r"^/api/v0/devices/(?P<device>[^/]+)$"), "patch_device"),
+    ("GET", re.compile(r"^/api/v0/devices/(?P<device>[^/]+)/discover$"), "discover"),
+    ("GET", re.compile(r"^/api/v0/devices/(?P<device>[^/]+)/ports$"), "device_ports"),
+    ("GET", re.compile(r"^/api/v0/devices$"), "list_devices"),
+    ("GET", re.compile(r"^/api/v0/ports/search/ifName/(?P<ifname>[^/]+)$"), "search_ifname"),
+    ("GET", re.compile(r"^/api/v0/ports/(?P<port>\d+)$"), "get_port"),
+]
+
+class FakeLibreNMS:
+    """In-memory fleet of `devices` devices (IDs 1..N), each with ports
+    port1 and port2.
+
+    A device's port2 is "up" once its overwrite_ip is back to its real IP,
+    except for a stable `1 - recover_rate` share of the fleet that stays
+    down. Every request sleeps for about `latency_ms` (+/- `jitter`), and
+    `error_rate` of them fail with 500.
+    """
+    def __init__(self, devices=10000, latency_ms=5.0, jitter=0.5, error_rate=0.0,
+                 recover_rate=1.0, seed=0):
+        self.devices = devices
+        self.latency_sec = latency_ms / 1000.0
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.recover_rate = recover_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.overwrite_ip = {}
+        self.calls = Counter()
+        self.errors = 0
+
+    @staticmethod
+    def device_ip(device_id):
+        device_id = int(device_id)
+        return f"10.{(device_id >> 16) & 255}.{(device_id >> 8) & 255}.{device_id & 255}"
+
+    @staticmethod
+    def port_id(device_id, ifname="port2"):
+        return int(device_id) * 10 + (2 if ifname == "port2" else 1)
+
+    def _device(self, key):
+        """Resolve a device ID or hostname (the device IP) to an ID."""
+        if str(key).isdigit() and 1 <= int(key) <= self.devices:
+            return int(key)
+        parts = str(key).split(".")
+        if len(parts) == 4 and parts[0] == "10" and all(p.isdigit() for p in parts):
+            device_id = (int(parts[1]) << 16) | (int(parts[2]) << 8) | int(parts[3])
+            if 1 <= device_id <= self.devices:
+                return device_id
+        return None
+
+    def _recovers(self, device_id):
+        return (device_id * 2654435761 % 1000) / 1000.0 < self.recover_rate
+
+    def oper_status(self, device_id, ifname="port2"):
+        if ifname != "port2":
+            return "up"
+        with self.lock:
+            restored = self.overwrite_ip.get(device_id) in (None, self.device_ip(device_id))
+        return "up" if restored and self._recovers(device_id) else "down"
+
+    def _port(self, device_id, ifname):
+        return {"port_id": self.port_id(device_id, ifname), "device_id": device_id,
+                "ifName": ifname, "ifOperStatus": self.oper_status(device_id, ifname)}
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls.clear()
+            self.errors = 0
+
+    def snapshot(self):
+        with self.lock:
+            return {"calls": dict(self.calls), "total": sum(self.calls.values()), "errors": self.errors}
+
+    def handle(self, method, path, query, body):
+        """Returns (status, payload)."""
+        for route_method, pattern, name in ROUTES:
+            m = pattern.match(path)
+            if m and route_method == method:
+                break
+        else:
+            return 404, {"status": "error", "message": f"no route for {method} {path}"}
+
+        delay = self.latency_sec * (1 + self.jitter * (2 * self.random.random() - 1))
+        if delay > 0:
+            time.sleep(delay)
+        with self.lock:
+            self.calls[name] += 1
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.errors += 1
+                return 500, {"status": "error", "message": "injected failure"}
+        return getattr(self, name)(query=query, body=body, **m.groupdict())
+
+    def patch_device(self, device, body, **_):
+        device_id = self._device(device)
+        if device_id is None:
+            return 404, {"status": "error", "message": "Device does not exist"}
+        if (body or {}).get("field") == "overwrite_ip":
+            with self.lock:
+                self.overwrite_ip[device_id] = body.get("data")
+        return 200, {"status": "ok", "message": "Device overwrite_ip field has been updated"}
+
+    def discover(self, device, **_):
+        if self._device(device) is None:
+            return 404, {"status": "error", "message": "Device does not exist"}
+        return 200, {"status": "ok", "result": {"status": 1, "message": "Device will be rediscovered"}, "count": 2}
+
+    def device_ports(self, device, **_):
+        device_id = self._device(device)
+        if device_id is None:
+            return 404, {"status": "error", "message": "Device does not exist"}
+        ports = [self._port(device_id, n) for n in IFNAMES]
+        return 200, {"status": "ok", "ports": ports, "count": len(ports)}
+
+    def list_devices(self, **_):
+        with self.lock:
+            overwrite = dict(self.overwrite_ip)
+        devices = [{"device_id": d, "hostname": self.device_ip(d), "overwrite_ip": overwrite.get(d)}
+                   for d in range(1, self.devices + 1)]
+        return 200, {"status": "ok", "devices": devices, "count": len(devices)}
+
+    def search_ifname(self, ifname, query, **_):
+        columns = [c for c in query.get("columns", "").split(",") if c]
+        ports = []
+        for device_id in range(1, self.devices + 1 if ifname in IFNAMES else 1):
+            port = self._port(device_id, ifname)
+            ports.append({k: v for k, v in port.items() if k in columns} if columns else port)
+        return 200, {"status": "ok", "ports": ports, "count": len(ports)}
+
+    def get_port(self, port, **_):
+        port = int(port)
+        device_id, kind = divmod(port, 10)
+        if not 1 <= device_id <= self.devices or kind not in (1, 2):
+            return 200, {"status": "ok", "port": []}
+        ifname = "port2" if kind == 2 else "port1"
+        return 200, {"status": "ok", "port": [self._port(device_id, ifname)]}
+
+def make_handler(fake):
+    class FakeHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"   # keep-alive, like the real API behind nginx
+        wbufsize = 65536                # headers and body leave in one write
+        disable_nagle_algorithm = True
+
+        def log_message(self, fmt, *args):
+            pass
+
+        def _dispatch(self):
+            parts = urlsplit(self.path)
+            query = dict(parse_qsl(parts.query))
+            length = int(self.headers.get("Content-Length", 0))
+            body = None
+            if length:
+                try:
+                    body = json.loads(self.rfile.read(length))
+                except json.JSONDecodeError:
+                    body = None
+            if parts.path == "/_stats":
+                code, payload = 200, fake.snapshot()
+            else:
+                code, payload = fake.handle(self.command, parts.path, query, body)
+            data = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_PATCH = do_POST = _dispatch
+
+    return FakeHandler
+
+class FakeHTTPServer(ThreadingHTTPServer):
+    request_queue_size = 1024   # load tests open many connections at once
+
+def serve(fake, host="127.0.0.1", port=8099):
+    """Start the fake in a daemon thread; returns the server."""
+    server = FakeHTTPServer((host, port), make_handler(fake))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-librenms", daemon=True).start()
+    return server
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Fake LibreNMS API for load testing the alert handlers.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--devices", type=int, default=10000, help="fleet size")
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="mean per-request latency")
+    parser.add_argument("--jitter", type=float, default=0.5, help="+/- fraction applied to the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests failing with 500")
+    parser.add_argument("--recover-rate", type=float, default=1.0, help="fraction of devices whose port comes back up")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    fake = FakeLibreNMS(args.devices, args.latency_ms, args.jitter, args.error_rate, args.recover_rate)
+    serve(fake, args.host, args.port)
+    print(f"Fake LibreNMS with {args.devices} devices on http://{args.host}:{args.port}/api/v0 "
+          f"(stats at /_stats)", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,355 @@
+import argparse
+import asyncio
+import os
+import random
+import re
+import shlex
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+
+import requests
+
+# =======================
+# Shared by prod.py and dialer1.py
+# =======================
+# The metrics registry, the API rate limiter, the LibreNMS API client and
+# the local device:poll runner both handlers use. Each script keeps its
+# own configuration and passes it in; log lines go through the script's
+# own logger once it calls use_logger(). parse_duration() is the duration
+# type of prod.py's and simulate.py's command lines.
+
+def log(msg):
+    print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {msg}")
+
+def warning(msg):
+    log(msg)
+
+def debug(msg, *args):
+    # Arguments may be callables, evaluated only when the line is written.
+    log(msg % tuple(a() if callable(a) else a for a in args))
+
+def use_logger(log_fn, warning_fn=None, debug_fn=None):
+    """Send this module's log lines through the calling script's logger."""
+    global log, warning, debug
+    log = log_fn
+    warning = warning_fn or log_fn
+    if debug_fn is not None:
+        debug = debug_fn
+
+# =======================
+# Metrics
+# =======================
+LATENCY_BUCKETS  = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+RECOVERY_BUCKETS = (60, 300, 900, 1800, 3600, 7200, 14400, 28800, 86400, 259200)
+COUNT_BUCKETS    = (0, 1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+class Metrics:
+    """In-process counters, histograms and gauges rendered in the
+    Prometheus text exposition format for GET /metrics.
+
+    Counters and histograms are keyed by (name, sorted label items). Gauges
+    are callables evaluated at scrape time, so they always read live state.
+    """
+    def __init__(self, prefix="alert_handler_"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.meta = {}        # name -> (type, help, buckets)
+        self.counters = {}    # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self.gauges = {}      # name -> fn() returning a number
+
+    def counter(self, name, help_text):
+        self.meta[name] = ("counter", help_text, None)
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.meta[name] = ("histogram", help_text, tuple(buckets))
+
+    def gauge(self, name, help_text, fn):
+        self.meta[name] = ("gauge", help_text, None)
+        self.gauges[name] = fn
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = self.meta[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the duration of the block; `labels` may be updated inside
+        it (e.g. with a status only known at the end)."""
+        started = time.monotonic()
+        try:
+            yield labels
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    @staticmethod
+    def _labels(items, extra=()):
+        items = tuple(items) + tuple(extra)
+        if not items:
+            return ""
+        return "{" + ",".join(f'{k}="{str(v)}"' for k, v in items) + "}"
+
+    def render(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {k: list(v) for k, v in self.histograms.items()}
+        lines = []
+        for name, (kind, help_text, buckets) in self.meta.items():
+            full = self.prefix + name
+            lines.append(f"# HELP {full} {help_text}")
+            lines.append(f"# TYPE {full} {kind}")
+            if kind == "gauge":
+                try:
+                    lines.append(f"{full} {float(self.gauges[name]())}")
+                except Exception:
+                    pass
+            elif kind == "counter":
+                for (n, labels), value in counters.items():
+                    if n == name:
+                        lines.append(f"{full}{self._labels(labels)} {value}")
+            else:
+                for (n, labels), h in histograms.items():
+                    if n != name:
+                        continue
+                    for bound, count in zip(buckets, h):
+                        lines.append(f"{full}_bucket{self._labels(labels, [('le', bound)])} {count}")
+                    lines.append(f"{full}_bucket{self._labels(labels, [('le', '+Inf')])} {h[-1]}")
+                    lines.append(f"{full}_sum{self._labels(labels)} {h[-2]}")
+                    lines.append(f"{full}_count{self._labels(labels)} {h[-1]}")
+        return "\n".join(lines) + "\n"
+
+def endpoint_label(endpoint):
+    """Collapse numeric path segments so per-device calls share one series."""
+    return re.sub(r"/\d+(?=/|$)", "/{id}", endpoint)
+
+def parse_duration(text):
+    """Seconds in "90", "30s", "15m", "2h" or "1d"."""
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    try:
+        if text[-1:].lower() in units:
+            return float(text[:-1]) * units[text[-1].lower()]
+        return float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid duration {text!r}")
+
+# The process's registry; each script registers its own series on it.
+METRICS = Metrics()
+
+# =======================
+# LibreNMS API client
+# =======================
+class TokenBucket:
+    """Thread-safe token bucket; acquire() blocks until a token is free."""
+    def __init__(self, rate_per_sec, burst):
+        self.rate = rate_per_sec
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        """Take a token if one is free and return 0, otherwise return the
+        seconds until one will be (for callers that must not block)."""
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait_s = self.try_acquire()
+            if wait_s <= 0:
+                return
+            time.sleep(wait_s)
+
+class LibreClient:
+    """Reusable LibreNMS API client.
+
+    Keeps one pooled keep-alive session, applies connect/read timeouts to
+    every call, retries idempotent verbs on connection errors and 5xx/429
+    with jittered exponential backoff, and rate-limits all calls through a
+    token bucket so recovery passes cannot flood the LibreNMS PHP workers.
+    """
+    # PATCH is included because every PATCH we send sets overwrite_ip to an
+    # absolute value, so replaying it is harmless.
+    RETRY_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE", "PATCH"}
+
+    def __init__(self, base_url, token, pool_size=10,
+                 connect_timeout=5, read_timeout=60,
+                 max_retries=3, backoff_sec=0.5, backoff_max_sec=10,
+                 rate_per_sec=20, rate_burst=40):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_sec = backoff_sec
+        self.backoff_max_sec = backoff_max_sec
+        self.limiter = TokenBucket(rate_per_sec, rate_burst)
+
+        self.session = requests.Session()
+        self.session.headers.update({"X-Auth-Token": token, "Content-Type": "application/json"})
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                                                pool_block=True, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(self.backoff_max_sec, retry_after)
+        return random.uniform(0, min(self.backoff_max_sec, self.backoff_sec * (2 ** attempt)))
+
+    def request(self, method, endpoint, data=None, params=None):
+        method = method.upper()
+        url = f"{self.base_url}{endpoint}"
+        retries = self.max_retries if method in self.RETRY_METHODS else 0
+
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                r = self.session.request(method, url, json=data, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= retries:
+                    raise
+                delay = self._backoff(attempt)
+                warning(f"⚠️ {method} {endpoint} failed ({e.__class__.__name__}); retry {attempt + 1}/{retries} in {delay:.1f}s")
+            else:
+                if not (r.status_code >= 500 or r.status_code == 429) or attempt >= retries:
+                    return r
+                retry_after = r.headers.get("Retry-After")
+                delay = self._backoff(attempt, float(retry_after) if retry_after and retry_after.isdigit() else None)
+                warning(f"⚠️ {method} {endpoint} returned {r.status_code}; retry {attempt + 1}/{retries} in {delay:.1f}s")
+            attempt += 1
+            time.sleep(delay)
+
+# =======================
+# Local device:poll
+# =======================
+class LocalPoller:
+    """Runs device:poll on this host in a bounded pool of subprocesses.
+
+    At most `concurrency` polls run at once (tune this against the
+    LibreNMS poller's own workers). Each poll gets its own process group so
+    a timeout kills php and everything it spawned, not just the parent.
+    """
+    def __init__(self, command="php /opt/librenms/artisan device:poll", concurrency=4,
+                 timeout_sec=300, kill_grace_sec=5):
+        self.argv = shlex.split(command)
+        self.concurrency = max(1, concurrency)
+        self.timeout_sec = timeout_sec
+        self.kill_grace_sec = kill_grace_sec
+        self.slots = threading.BoundedSemaphore(self.concurrency)
+        self.async_slots = None   # asyncio.Semaphore for apoll(), created inside the loop
+
+    def poll(self, host_or_id):
+        """Poll one device; returns the exit status, or None on timeout/failure."""
+        with self.slots:
+            with METRICS.timer("poll_seconds", backend="local", outcome="failed") as labels:
+                status = self._run(host_or_id)
+                if status == 0:
+                    labels["outcome"] = "ok"
+            return status
+
+    def _run(self, host_or_id):
+        argv = self.argv + [str(host_or_id)]
+        log(f"Running local poll command: {shlex.join(argv)}")
+        try:
+            proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    text=True, errors="replace", start_new_session=True)
+        except OSError as e:
+            warning(f"⚠️ Local polling failed to start: {e}")
+            return None
+        try:
+            out, _ = proc.communicate(timeout=self.timeout_sec)
+        except subprocess.TimeoutExpired:
+            self._kill(proc)
+            warning(f"⚠️ device:poll {host_or_id} timed out after {self.timeout_sec}s; process group killed.")
+            return None
+        debug("POLL OUTPUT (%s):\n%s", host_or_id, out)
+        if proc.returncode != 0:
+            warning(f"⚠️ device:poll {host_or_id} exited with status {proc.returncode}")
+        return proc.returncode
+
+    def _kill(self, proc):
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+            proc.wait(timeout=self.kill_grace_sec)
+        except ProcessLookupError:
+            pass
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+        proc.communicate()
+
+    async def apoll(self, host_or_id):
+        """poll() for the async engine: an asyncio subprocess under the same
+        concurrency limit and timeout handling."""
+        if self.async_slots is None:
+            self.async_slots = asyncio.Semaphore(self.concurrency)
+        async with self.async_slots:
+            with METRICS.timer("poll_seconds", backend="local", outcome="failed") as labels:
+                status = await self._arun(host_or_id)
+                if status == 0:
+                    labels["outcome"] = "ok"
+            return status
+
+    async def _arun(self, host_or_id):
+        argv = self.argv + [str(host_or_id)]
+        log(f"Running local poll command: {shlex.join(argv)}")
+        try:
+            proc = await asyncio.create_subprocess_exec(*argv, stdout=subprocess.PIPE,
+                                                        stderr=subprocess.STDOUT, start_new_session=True)
+        except OSError as e:
+            warning(f"⚠️ Local polling failed to start: {e}")
+            return None
+        try:
+            out, _ = await asyncio.wait_for(proc.communicate(), self.timeout_sec)
+        except asyncio.TimeoutError:
+            try:
+                os.killpg(proc.pid, signal.SIGTERM)
+                await asyncio.wait_for(proc.wait(), self.kill_grace_sec)
+            except ProcessLookupError:
+                pass
+            except asyncio.TimeoutError:
+                os.killpg(proc.pid, signal.SIGKILL)
+                await proc.wait()
+            warning(f"⚠️ device:poll {host_or_id} timed out after {self.timeout_sec}s; process group killed.")
+            return None
+        debug("POLL OUTPUT (%s):\n%s", host_or_id, lambda: out.decode(errors="replace"))
+        if proc.returncode != 0:
+            warning(f"⚠️ device:poll {host_or_id} exited with status {proc.returncode}")
+        return proc.returncode
+
+    def poll_many(self, hosts_or_ids, poll=None):
+        """Poll every device, at most `concurrency` at a time; `poll`, when
+        given, runs each device's poll in place of self.poll."""
+        hosts_or_ids = list(hosts_or_ids)
+        if not hosts_or_ids:
+            return
+        log(f"📡 Polling {len(hosts_or_ids)} devices locally ({min(self.concurrency, len(hosts_or_ids))} at a time).")
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(hosts_or_ids)),
+                                thread_name_prefix="local-poll") as pool:
+            list(pool.map(poll or self.poll, hosts_or_ids))
@@ -1,12 +1,38 @@
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import asyncio
+import atexit
+import bisect
+import codecs
+import contextvars
+import glob
+import heapq
 import json
+import queue
+import random
 import requests
+import signal
+import socket
+import sqlite3
+import sys
 import time
+import uuid
 import threading
 import os
-from datetime import datetime, timedelta
+import zlib
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from urllib.parse import urlencode, urlsplit
 from dotenv import load_dotenv
 
+import librenms_common
+from librenms_common import (COUNT_BUCKETS, METRICS, RECOVERY_BUCKETS,
+                             LibreClient, TokenBucket, endpoint_label, parse_duration)
+
 # =======================
 # Load .env
 # =======================
@@ -18,263 +44,3432 @@ load_dotenv()
 LIBRENMS_URL   = os.getenv("LIBRENMS_URL", "http://127.0.0.1/api/v0")
 API_TOKEN      = os.getenv("LIBRENMS_API_TOKEN", "")
 UNSUPERVISED_IP = os.getenv("UNSUPERVISED_IP", "127.0.0.50")
-STATE_FILE     = os.getenv("STATE_FILE", "device_state.json")
 TARGET_IFNAME  = os.getenv("TARGET_IFNAME", "port2")
-RECOVERY_INTERVAL_SEC = int(os.getenv("RECOVERY_INTERVAL_SEC", "1200"))  # default 20min
 HTTP_PORT      = int(os.getenv("HTTP_PORT", "5000"))
+HTTP_BACKLOG   = int(os.getenv("HTTP_BACKLOG", "128"))
+# Reconcile saved state against LibreNMS at startup (a few bulk requests)
+STARTUP_RECONCILE = os.getenv("STARTUP_RECONCILE", "1").lower() not in ("0", "false", "no")
+
+# Supervised ports: the default set for every device and the rule that
+# declares a device recovered ("all", "any" or "min:N" of its ports up).
+# Alerts can pick a named group from SUPERVISION_GROUPS_FILE, a JSON object
+# like {"dialers": {"ifnames": ["port1", "port2"], "rule": "any"}}, or carry
+# their own "ifnames"/"rule".
+TARGET_IFNAMES = [n.strip() for n in os.getenv("TARGET_IFNAMES", TARGET_IFNAME).split(",") if n.strip()]
+RECOVERY_RULE  = os.getenv("RECOVERY_RULE", "all").lower()
+SUPERVISION_GROUPS_FILE = os.getenv("SUPERVISION_GROUPS_FILE", "")
+
+# Logging: records are queued and written by a background thread
+LOG_LEVEL     = os.getenv("LOG_LEVEL", "INFO").upper()   # DEBUG adds payload/body dumps
+LOG_FORMAT    = os.getenv("LOG_FORMAT", "text").lower()  # "text" or "json" (JSON lines)
+LOG_BODY_MAX  = int(os.getenv("LOG_BODY_MAX", "2000"))   # chars kept of any logged payload/body
+LOG_QUEUE_MAX = int(os.getenv("LOG_QUEUE_MAX", "10000"))
+
+# Tracing (opt-in): span trees for a sample of recovery checks and alerts,
+# appended to hourly Chrome trace-event JSON files in TRACE_DIR
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))   # 0 disables, 1 traces everything
+TRACE_DIR         = os.getenv("TRACE_DIR", "traces")
+
+# State persistence
+STATE_FILE     = os.getenv("STATE_FILE", "device_state.json")
+STATE_BACKEND  = os.getenv("STATE_BACKEND", "journal").lower()  # "journal", "json" or "sqlite"
+STATE_DB       = os.getenv("STATE_DB", "device_state.db")
+JOURNAL_FSYNC_MS    = int(os.getenv("JOURNAL_FSYNC_MS", "200"))     # fsync batching window
+JOURNAL_COMPACT_OPS = int(os.getenv("JOURNAL_COMPACT_OPS", "1000"))  # journal entries per snapshot
+
+# Sharded mode: several instances share the sqlite state in STATE_DB and
+# split recovery work by hashing device IDs onto SHARD_COUNT shards, each
+# owned through a renewable lease.
+SHARD_MODE      = os.getenv("SHARD_MODE", "0").lower() in ("1", "true", "yes")
+INSTANCE_ID     = os.getenv("INSTANCE_ID", f"{socket.gethostname()}:{HTTP_PORT}")
+SHARD_COUNT     = int(os.getenv("SHARD_COUNT", "256"))
+SHARD_VNODES    = int(os.getenv("SHARD_VNODES", "64"))      # ring points per instance
+LEASE_TTL_SEC   = float(os.getenv("LEASE_TTL_SEC", "30"))
+LEASE_RENEW_SEC = float(os.getenv("LEASE_RENEW_SEC", "10"))
+
+# Recovery scheduling
+RECOVERY_INTERVAL_SEC = int(os.getenv("RECOVERY_INTERVAL_SEC", "1200"))  # default 20min
+# Devices alerted together are spread over this window so their checks do
+# not all land on LibreNMS at once (default: last quarter of the interval).
+RECOVERY_SPLAY_SEC    = int(os.getenv("RECOVERY_SPLAY_SEC", str(RECOVERY_INTERVAL_SEC // 4)))
+RECOVERY_CONCURRENCY  = int(os.getenv("RECOVERY_CONCURRENCY", "8"))  # devices checked in parallel
+
+# Failed checks back off: interval * factor^(attempts-1), capped, +/- jitter
+RECOVERY_BACKOFF_FACTOR  = float(os.getenv("RECOVERY_BACKOFF_FACTOR", "2"))
+RECOVERY_BACKOFF_MAX_SEC = int(os.getenv("RECOVERY_BACKOFF_MAX_SEC", "14400"))
+RECOVERY_BACKOFF_JITTER  = float(os.getenv("RECOVERY_BACKOFF_JITTER", "0.1"))
+
+# Flap damping: a device with this many up/down transitions inside the window
+# is held forced down (quiet) for FLAP_QUIET_SEC before it is checked again.
+FLAP_THRESHOLD  = int(os.getenv("FLAP_THRESHOLD", "4"))  # 0 disables
+FLAP_WINDOW_SEC = int(os.getenv("FLAP_WINDOW_SEC", "3600"))
+FLAP_QUIET_SEC  = int(os.getenv("FLAP_QUIET_SEC", "7200"))
+
+# "full": rediscover a device whenever its overwrite_ip actually changes.
+# "light": never rediscover for IP changes (only when a device's port has to
+# be found again); port status comes from the local poll backend, which light
+# mode therefore requires.
+RECOVERY_CHECK_MODE = os.getenv("RECOVERY_CHECK_MODE", "full").lower()
+
+# Fresh SNMP data before each port check: "none" (rely on LibreNMS' own
+# poller) or "local" (run device:poll on this host, as the Java version does)
+POLL_BACKEND        = os.getenv("POLL_BACKEND", "none").lower()
+POLL_COMMAND        = os.getenv("POLL_COMMAND", "php /opt/librenms/artisan device:poll")
+POLL_CONCURRENCY    = int(os.getenv("POLL_CONCURRENCY", "4"))
+POLL_TIMEOUT_SEC    = int(os.getenv("POLL_TIMEOUT_SEC", "300"))
+POLL_KILL_GRACE_SEC = int(os.getenv("POLL_KILL_GRACE_SEC", "5"))
+
+# LibreNMS API client: pooled keep-alive session, timeouts, retries, rate limit
+API_POOL_SIZE       = int(os.getenv("API_POOL_SIZE", "10"))
+API_CONNECT_TIMEOUT = float(os.getenv("API_CONNECT_TIMEOUT", "5"))
+API_READ_TIMEOUT    = float(os.getenv("API_READ_TIMEOUT", "60"))
+API_MAX_RETRIES     = int(os.getenv("API_MAX_RETRIES", "3"))
+API_BACKOFF_SEC     = float(os.getenv("API_BACKOFF_SEC", "0.5"))
+API_BACKOFF_MAX_SEC = float(os.getenv("API_BACKOFF_MAX_SEC", "10"))
+API_RATE_PER_SEC    = float(os.getenv("API_RATE_PER_SEC", "20"))  # 0 disables the limiter
+API_RATE_BURST      = int(os.getenv("API_RATE_BURST", "40"))
+
+# (device_id, ifName) -> port_id index
+PORT_INDEX_TTL_SEC     = int(os.getenv("PORT_INDEX_TTL_SEC", "900"))
+PORT_INDEX_MAX_ENTRIES = int(os.getenv("PORT_INDEX_MAX_ENTRIES", "50000"))
+PORT_INDEX_REFRESH_SEC = int(os.getenv("PORT_INDEX_REFRESH_SEC", "600"))  # 0 disables background refresh
+# Recovery passes with at least this many devices read every port status
+# from one bulk search instead of one GET /ports/{id} per device.
+PORT_STATUS_BULK_MIN   = int(os.getenv("PORT_STATUS_BULK_MIN", "10"))
+
+# Alert intake: "queue" acks with 202 and hands force-down work to a worker
+# pool; "sync" keeps the legacy behaviour (API calls inline, then 200).
+INTAKE_MODE      = os.getenv("INTAKE_MODE", "queue").lower()
+INTAKE_WORKERS   = int(os.getenv("INTAKE_WORKERS", "4"))
+INTAKE_QUEUE_MAX = int(os.getenv("INTAKE_QUEUE_MAX", "1000"))
+INTAKE_RETRY_AFTER_SEC = int(os.getenv("INTAKE_RETRY_AFTER_SEC", "30"))
+
+# POST /alerts/batch takes a JSON array or NDJSON of alerts, parsed as it is read
+BATCH_MAX_ITEMS      = int(os.getenv("BATCH_MAX_ITEMS", "10000"))
+BATCH_ITEM_MAX_BYTES = int(os.getenv("BATCH_ITEM_MAX_BYTES", "65536"))
+
+# New-device alerts arriving within this window are force-downed as one batch
+COALESCE_WINDOW_MS  = int(os.getenv("COALESCE_WINDOW_MS", "500"))
+COALESCE_MAX_BATCH  = int(os.getenv("COALESCE_MAX_BATCH", "50"))
+
+# Async engine (--engine async): intake and recovery share one event loop
+# and these bound what it keeps in flight.
+ASYNC_API_CONNECTIONS      = int(os.getenv("ASYNC_API_CONNECTIONS", "50"))       # keep-alive connections to LibreNMS
+ASYNC_RECOVERY_CONCURRENCY = int(os.getenv("ASYNC_RECOVERY_CONCURRENCY", "1000"))  # device checks in flight
+ASYNC_BATCH_WINDOW_MS      = int(os.getenv("ASYNC_BATCH_WINDOW_MS", "50"))       # due checks sharing one port snapshot
 
 # =======================
 # Helpers
 # =======================
-def log(msg):
-    line = f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {msg}"
-    print(line, flush=True)
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+CORRELATION_ID = contextvars.ContextVar("correlation_id", default=None)
+
+class AsyncLogger:
+    """Queue-backed, non-blocking logger.
+
+    Callers only enqueue the raw message and its arguments; a writer thread
+    does the %-formatting (calling any callable argument first, so expensive
+    values are built lazily), caps string arguments at LOG_BODY_MAX
+    characters and writes text or JSON lines in batches. Records below
+    LOG_LEVEL are discarded before anything is formatted, and records are
+    dropped (and counted) rather than blocking when the queue is full.
+    """
+    def __init__(self, level=LOG_LEVEL, fmt=LOG_FORMAT, body_max=LOG_BODY_MAX,
+                 queue_max=LOG_QUEUE_MAX, stream=None):
+        self.level = LEVELS.get(level, LEVELS["INFO"])
+        self.json = fmt == "json"
+        self.body_max = body_max
+        self.queue = queue.Queue(maxsize=max(1, queue_max))
+        self.stream = stream or sys.stdout
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._writer, name="logger", daemon=True)
+        self.thread.start()
+
+    def enabled(self, level):
+        return LEVELS[level] >= self.level
+
+    def emit(self, level, msg, args):
+        if LEVELS[level] < self.level:
+            return
+        try:
+            self.queue.put_nowait((time.time(), level, CORRELATION_ID.get(),
+                                   threading.current_thread().name, msg, args))
+        except queue.Full:
+            self.dropped += 1
+
+    def _clip(self, value):
+        if callable(value):
+            value = value()
+        if isinstance(value, bytes):
+            value = value.decode(errors="replace")
+        if isinstance(value, str) and len(value) > self.body_max:
+            return f"{value[:self.body_max]}... [{len(value) - self.body_max} more chars]"
+        return value
+
+    def _format(self, record):
+        ts, level, cid, thread, msg, args = record
+        try:
+            if args:
+                msg = msg % tuple(self._clip(a) for a in args)
+        except Exception as e:
+            msg = f"{msg} {args!r} (log formatting failed: {e})"
+        if self.json:
+            return json.dumps({"ts": datetime.fromtimestamp(ts).isoformat(timespec="milliseconds"),
+                               "level": level, "cid": cid, "thread": thread, "msg": msg},
+                              ensure_ascii=False)
+        prefix = datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
+        if level != "INFO":
+            prefix += f" [{level}]"
+        if cid:
+            prefix += f" [{cid}]"
+        return f"{prefix} - {msg}"
+
+    def _writer(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < 1000:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = [self._format(r) for r in batch]
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                lines.append(self._format((time.time(), "WARNING", None, "logger",
+                                           f"⚠️ Log queue full; dropped {dropped} records.", ())))
+            try:
+                self.stream.write("\n".join(lines) + "\n")
+                self.stream.flush()
+            except Exception:
+                pass
+            for _ in batch:
+                self.queue.task_done()
+
+    def flush(self):
+        self.queue.join()
+
+LOGGER = AsyncLogger()
+atexit.register(LOGGER.flush)
+
+def log(msg, *args, level="INFO"):
+    LOGGER.emit(level, msg, args)
+
+def debug(msg, *args):
+    LOGGER.emit("DEBUG", msg, args)
+
+def warning(msg, *args):
+    LOGGER.emit("WARNING", msg, args)
+
+librenms_common.use_logger(log, warning, debug)
 
-def load_state():
-    if os.path.exists(STATE_FILE):
+@contextmanager
+def correlation(cid):
+    """Tag every log record from this thread/task with `cid`."""
+    token = CORRELATION_ID.set(cid)
+    try:
+        yield cid
+    finally:
+        CORRELATION_ID.reset(token)
+
+def read_state_file(path):
+    if os.path.exists(path):
         try:
-            if os.path.getsize(STATE_FILE) == 0:
+            if os.path.getsize(path) == 0:
                 return {}
-            with open(STATE_FILE, "r") as f:
+            with open(path, "r") as f:
                 return json.load(f)
         except json.JSONDecodeError:
-            log("⚠️ Warning: state file unreadable; resetting.")
+            warning(f"⚠️ Warning: state file {path} unreadable; resetting.")
             return {}
     return {}
 
-def save_state(state):
-    tmp = STATE_FILE + ".tmp"
+def write_state_file(path, state):
+    """Atomically replace `path` with `state`. The new file and the rename
+    are on disk when this returns, so a journal may be truncated after it."""
+    tmp = path + ".tmp"
     with open(tmp, "w") as f:
         json.dump(state, f, indent=2)
-    os.replace(tmp, STATE_FILE)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
-def libre_api(method, endpoint, data=None, params=None):
-    headers = {"X-Auth-Token": API_TOKEN, "Content-Type": "application/json"}
-    url = f"{LIBRENMS_URL}{endpoint}"
+def apply_state_op(state, op, device_id, data=None):
+    """Apply one ("put" | "patch" | "del", device_id, data) mutation to a
+    {device_id: info} dict."""
+    if op == "put":
+        state[device_id] = data
+    elif op == "patch" and device_id in state:
+        state[device_id].update(data)
+    elif op == "del":
+        state.pop(device_id, None)
+
+def due_timestamp(info):
+    try:
+        return datetime.fromisoformat(info["next_check_at"]).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return None
+
+# =======================
+# Metrics
+# =======================
+# Metrics, TokenBucket, LibreClient and LocalPoller live in librenms_common (shared with dialer1.py).
+METRICS.counter("alerts_received_total", "Alert webhooks received.")
+METRICS.counter("alerts_rejected_total", "Alert webhooks rejected, by reason.")
+METRICS.counter("alerts_duplicate_total", "Alerts for devices already tracked (no API calls).")
+METRICS.histogram("alert_handling_seconds", "Time to handle an alert webhook, by intake mode.")
+METRICS.histogram("alert_batch_items", "Alerts per batch request.", COUNT_BUCKETS)
+METRICS.histogram("api_request_seconds", "LibreNMS API call latency, by method, endpoint and status.")
+METRICS.histogram("poll_seconds", "device:poll duration, by backend and outcome.")
+METRICS.histogram("recovery_pass_seconds", "Duration of a recovery pass.")
+METRICS.histogram("recovery_pass_devices", "Devices checked per recovery pass.", COUNT_BUCKETS)
+METRICS.histogram("recovery_pass_recovered", "Devices recovered per recovery pass.", COUNT_BUCKETS)
+METRICS.counter("recovery_checks_total", "Per-device recovery checks, by result.")
+METRICS.histogram("time_to_recovery_seconds", "Time from first alert to recovery.", RECOVERY_BUCKETS)
+METRICS.gauge("devices_tracked", "Devices currently tracked in state.", lambda: STATE.count())
+METRICS.gauge("recovery_scheduled", "Devices with a pending recovery check.", lambda: len(RECOVERY.scheduled))
+METRICS.gauge("intake_queue_depth", "Devices waiting for a force-down worker.", lambda: FORCE_DOWN_QUEUE.depth())
+METRICS.gauge("coalescer_pending", "Devices waiting in the coalescing window.", lambda: len(COALESCER.pending))
+METRICS.gauge("log_queue_depth", "Log records waiting to be written.", lambda: LOGGER.queue.qsize())
+METRICS.gauge("shards_owned", "Shards leased by this instance (sharded mode).",
+              lambda: len(SHARDS.owned) if SHARDS else 0)
+METRICS.gauge("port_index_entries", "Entries in the port index cache.", lambda: len(PORT_INDEX.entries))
 
-    log(f"\n--- LibreNMS API Request ---")
-    log(f"METHOD: {method}")
-    log(f"URL:    {url}")
-    if params:
-        log(f"PARAMS: {params}")
-    log(f"DATA:   {json.dumps(data, indent=2) if data else None}")
+# =======================
+# Tracing
+# =======================
+CURRENT_SPAN = contextvars.ContextVar("current_span", default=None)
 
-    r = requests.request(method, url, headers=headers, json=data, params=params)
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "attrs", "start", "end")
 
-    log(f"--- LibreNMS API Response ---")
-    log(f"STATUS: {r.status_code}")
-    try:
-        log(f"BODY:   {json.dumps(r.json(), indent=2)}")
-    except Exception:
-        log(f"BODY:   {r.text}")
-    log("-----------------------------\n")
+    def __init__(self, trace, span_id, parent_id, name, attrs):
+        self.trace = trace
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self.end = None
 
-    r.raise_for_status()
-    if r.text:
+class Trace:
+    """One sampled span tree: a device in a recovery pass, an alert, or a
+    pass. Its spans may be opened from several threads in turn."""
+    def __init__(self, trace_id, kind, label, attrs):
+        self.trace_id = trace_id
+        self.kind = kind
+        self.label = label
+        self.lock = threading.Lock()
+        self.root = Span(self, 0, None, kind, attrs)
+        self.spans = [self.root]
+        self.refs = 1   # holders that have yet to finish() it
+
+    def child(self, parent, name, attrs):
+        with self.lock:
+            span = Span(self, len(self.spans), parent.span_id, name, attrs)
+            self.spans.append(span)
+        return span
+
+class Tracer:
+    """Records span trees for TRACE_SAMPLE_RATE of recovery checks and
+    alerts and appends each finished tree to an hourly Chrome trace-event
+    file (open in chrome://tracing or ui.perfetto.dev; one row per trace).
+
+    Spans nest through a context variable, so code only opens spans around
+    its own work; with no sampled trace active a span costs one lookup.
+    Work handed on to a worker (a queued force-down) continues the trace:
+    park() it under the correlation id before handing on and the worker
+    claim()s it; it is written once both sides have finished it.
+    """
+    def __init__(self, sample_rate=TRACE_SAMPLE_RATE, directory=TRACE_DIR, max_parked=10000):
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.max_parked = max_parked
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.parked = OrderedDict()   # correlation id -> unfinished Trace
+        self.pid = os.getpid()
+        self.file = None
+        self.file_hour = None
+
+    def start(self, kind, label, **attrs):
+        """A new trace, or None when this one is not sampled."""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        with self.lock:
+            self.next_id += 1
+            trace_id = self.next_id
+        return Trace(trace_id, kind, label, attrs)
+
+    @contextmanager
+    def activate(self, trace):
+        """Open the block's spans under `trace` (a no-op for None)."""
+        if trace is None:
+            yield
+            return
+        token = CURRENT_SPAN.set(trace.root)
         try:
-            return r.json()
-        except ValueError:
+            yield
+        finally:
+            CURRENT_SPAN.reset(token)
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """Time the block as a child of the current span. Yields its attrs,
+        which may be updated inside (e.g. with a status), traced or not."""
+        parent = CURRENT_SPAN.get()
+        if parent is None:
+            yield attrs
+            return
+        span = parent.trace.child(parent, name, attrs)
+        token = CURRENT_SPAN.set(span)
+        try:
+            yield attrs
+        finally:
+            span.end = time.time()
+            CURRENT_SPAN.reset(token)
+
+    def park(self, key, trace=None):
+        """Keep `trace` (by default the active one) for claim(key)."""
+        if trace is None:
+            span = CURRENT_SPAN.get()
+            if span is None:
+                return
+            trace = span.trace
+        with trace.lock:
+            trace.refs += 1
+        with self.lock:
+            self.parked[key] = trace
+            evicted = [self.parked.popitem(last=False)[1] for _ in range(len(self.parked) - self.max_parked)]
+        for trace in evicted:
+            self.finish(trace)
+
+    def retain(self, trace, n=1):
+        """Take `n` more references to `trace`; each needs its own finish()."""
+        if trace is None or n <= 0:
+            return
+        with trace.lock:
+            trace.refs += n
+
+    def claim(self, key):
+        if not self.parked:
             return None
-    return None
+        with self.lock:
+            return self.parked.pop(key, None)
 
-def find_port_id_for_ifname(device_id_or_host, ifname=TARGET_IFNAME):
-    try:
-        resp = libre_api("GET", f"/ports/search/ifName/{ifname}",
-                         params={"columns": "port_id,device_id,ifName"})
-        ports = resp.get("ports", []) if resp else []
+    def finish(self, trace):
+        if trace is None:
+            return
+        with trace.lock:
+            trace.refs -= 1
+            if trace.refs > 0:
+                return
+            trace.root.end = time.time()
+            spans = [s for s in trace.spans if s.end is not None]
+        events = [{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": trace.trace_id,
+                   "args": {"name": trace.label}}]
+        events += [{"name": s.name, "cat": trace.kind, "ph": "X", "pid": self.pid, "tid": trace.trace_id,
+                    "ts": round(s.start * 1e6), "dur": round((s.end - s.start) * 1e6),
+                    "args": dict(s.attrs, span=s.span_id, parent=s.parent_id)}
+                   for s in spans]
+        self._write("".join(json.dumps(e, separators=(",", ":"), default=str) + ",\n" for e in events))
 
-        for p in ports:
-            if str(p.get("device_id")) == str(device_id_or_host):
-                return str(p.get("port_id"))
-    except Exception as e:
-        log(f"⚠️ Failed to lookup port_id via search API for {device_id_or_host}: {e}")
-    return None
+    def _write(self, data):
+        # JSON Array Format: "[" then one event per line; the closing "]" is optional.
+        hour = datetime.now().strftime("%Y%m%d-%H")
+        with self.lock:
+            try:
+                if hour != self.file_hour:
+                    if self.file is not None:
+                        self.file.close()
+                    os.makedirs(self.directory, exist_ok=True)
+                    path = os.path.join(self.directory, f"trace-{hour}-{self.pid}.json")
+                    fresh = not os.path.exists(path)
+                    self.file = open(path, "a")
+                    self.file_hour = hour
+                    if fresh:
+                        self.file.write("[\n")
+                self.file.write(data)
+                self.file.flush()
+            except OSError as e:
+                warning(f"⚠️ Could not write trace to {self.directory}: {e}")
 
-def get_port_oper_status(port_id):
-    resp = libre_api("GET", f"/ports/{port_id}")
-    if not resp:
-        return None
-    port_list = resp.get("port") or resp.get("ports") or []
-    if isinstance(port_list, dict):
-        port_list = [port_list]
-    if not port_list:
-        return None
-    return port_list[0].get("ifOperStatus")
+TRACER = Tracer()
 
-def force_device_down(device_id_or_host):
-    libre_api("PATCH", f"/devices/{device_id_or_host}",
-              {"field": "overwrite_ip", "data": UNSUPERVISED_IP})
-    libre_api("GET", f"/devices/{device_id_or_host}/discover")
+def run_traced(cid, trace, stage, fn, *args):
+    """Run `fn` under correlation id `cid`, timed as `stage` of `trace`."""
+    with correlation(cid), TRACER.activate(trace), TRACER.span(stage):
+        return fn(*args)
 
-def restore_device_ip(device_id_or_host, original_ip):
-    libre_api("PATCH", f"/devices/{device_id_or_host}",
-              {"field": "overwrite_ip", "data": original_ip})
-    libre_api("GET", f"/devices/{device_id_or_host}/discover")
+def load_trace_events(directory, since_ts):
+    """Complete-span events from the trace files in `directory` that
+    started at or after `since_ts`, plus {(pid, tid): trace label}."""
+    events, labels = [], {}
+    for path in sorted(glob.glob(os.path.join(directory, "trace-*.json"))):
+        with open(path) as f:
+            for line in f:
+                line = line.strip().rstrip(",")
+                if line in ("", "[", "]"):
+                    continue
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    continue   # torn last line of a file still being written
+                if event.get("ph") == "M":
+                    labels[(event["pid"], event["tid"])] = event["args"]["name"]
+                elif event.get("ph") == "X" and event["ts"] >= since_ts * 1e6:
+                    events.append(event)
+    return events, labels
+
+def print_trace_summary(directory=TRACE_DIR, since_sec=3600, top=10):
+    """Slowest stages and slowest devices among the traces of the last
+    `since_sec` seconds (--trace-summary)."""
+    events, labels = load_trace_events(directory, time.time() - since_sec)
+    traces = {}
+    for e in events:
+        traces.setdefault((e["pid"], e["tid"]), {})[e["args"]["span"]] = e
+
+    stages, devices, kinds = {}, [], {}
+    for key, spans in traces.items():
+        root = spans.get(0)
+        if root is None:
+            continue
+        kinds[root["cat"]] = kinds.get(root["cat"], 0) + 1
+        busy, slowest = 0, None
+        for span_id, e in spans.items():
+            if span_id == 0:
+                continue
+            path, parent = [e["name"]], spans.get(e["args"]["parent"])
+            while parent is not None and parent["args"]["span"] != 0:
+                path.append(parent["name"])
+                parent = spans.get(parent["args"]["parent"])
+            stage = f"{root['cat']}: " + " > ".join(reversed(path))
+            stages.setdefault(stage, []).append(e["dur"] / 1000.0)
+            if e["args"]["parent"] == 0:
+                busy += e["dur"] / 1000.0
+                if slowest is None or e["dur"] > slowest["dur"]:
+                    slowest = e
+        if root["args"].get("device_id") is not None:
+            devices.append((busy, root, slowest, labels.get(key, "")))
+
+    window = f"{since_sec / 3600:g}h" if since_sec >= 3600 else f"{since_sec / 60:g}m"
+    print(f"Traces from the last {window} in {directory}: "
+          + (", ".join(f"{n} {kind}" for kind, n in sorted(kinds.items())) or "none"))
+    if not traces:
+        return
+
+    print(f"\nSlowest stages (by total time, top {top}):")
+    print(f"{'stage':<60} {'count':>6} {'total s':>9} {'mean ms':>9} {'p95 ms':>9} {'max ms':>9}")
+    ranked = sorted(stages.items(), key=lambda item: -sum(item[1]))[:top]
+    for stage, durations in ranked:
+        durations.sort()
+        p95 = durations[min(len(durations) - 1, int(0.95 * (len(durations) - 1) + 0.5))]
+        print(f"{stage[:60]:<60} {len(durations):>6} {sum(durations) / 1000:>9.2f} "
+              f"{sum(durations) / len(durations):>9.1f} {p95:>9.1f} {durations[-1]:>9.1f}")
+
+    print(f"\nSlowest devices (by time in their own stages, top {top}):")
+    print(f"{'device':>8} {'started':<19} {'busy ms':>9}  {'slowest stage':<28} trace")
+    for busy, root, slowest, label in sorted(devices, key=lambda d: -d[0])[:top]:
+        started = datetime.fromtimestamp(root["ts"] / 1e6).strftime("%Y-%m-%d %H:%M:%S")
+        stage = f"{slowest['name']} ({slowest['dur'] / 1000:.0f} ms)" if slowest else "-"
+        print(f"{root['args']['device_id']:>8} {started:<19} {busy:>9.1f}  {stage[:28]:<28} {label}")
 
 # =======================
-# Recovery Manager
+# State Store
 # =======================
-class RecoveryManager:
-    def __init__(self):
+class JsonStateStore:
+    """Legacy backend: the whole state lives in STATE_FILE and every change
+    rewrites it. Fine for a handful of devices."""
+    def __init__(self, path):
+        self.path = path
+        # Handler threads, intake workers and the recovery thread all
+        # read-modify-write the file; serialize those cycles.
+        self.lock = threading.RLock()
+
+    def load_all(self):
+        with self.lock:
+            return read_state_file(self.path)
+
+    def replace_all(self, state):
+        with self.lock:
+            write_state_file(self.path, state)
+
+    def get(self, device_id):
+        return self.load_all().get(str(device_id))
+
+    def get_many(self, device_ids):
+        state = self.load_all()
+        return {str(d): state[str(d)] for d in device_ids if str(d) in state}
+
+    def count(self):
+        return len(self.load_all())
+
+    def upsert(self, device_id, info):
+        with self.lock:
+            state = read_state_file(self.path)
+            state[str(device_id)] = info
+            write_state_file(self.path, state)
+
+    def update(self, device_id, **fields):
+        with self.lock:
+            state = read_state_file(self.path)
+            if str(device_id) not in state:
+                return False
+            state[str(device_id)].update(fields)
+            write_state_file(self.path, state)
+            return True
+
+    def delete(self, device_id):
+        with self.lock:
+            state = read_state_file(self.path)
+            if state.pop(str(device_id), None) is None:
+                return False
+            write_state_file(self.path, state)
+            return True
+
+    def apply_many(self, ops):
+        """Apply (op, device_id, data) mutations with a single rewrite."""
+        with self.lock:
+            state = read_state_file(self.path)
+            for op, device_id, data in ops:
+                apply_state_op(state, op, str(device_id), data)
+            write_state_file(self.path, state)
+
+class SqliteStateStore:
+    """SQLite (WAL) backend: one row per device, so every change is a
+    single-row upsert/delete in its own transaction. Scheduling reads due
+    times from the in-memory DeviceTable, so the row is just the device's
+    JSON. device_state.json remains the import/export format and is
+    migrated automatically on first start."""
+    def __init__(self, path, json_path=None):
+        self.path = path
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS devices (
+                               device_id TEXT PRIMARY KEY,
+                               data      TEXT NOT NULL)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS meta (
+                               key   TEXT PRIMARY KEY,
+                               value TEXT)""")
+        if json_path:
+            self._migrate_from(json_path)
+
+    def _migrate_from(self, json_path):
+        """Import json_path once. Instances starting together serialize on
+        the write lock; the first one records a "migrated" marker row and
+        the others find it and leave the database alone."""
+        if not os.path.exists(json_path):
+            return
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                done = self.db.execute("SELECT 1 FROM meta WHERE key = 'migrated'").fetchone()
+                state = {} if done or self.count() else read_state_file(json_path)
+                if state:
+                    self.db.executemany("INSERT INTO devices (device_id, data) VALUES (?, ?)",
+                                        [(str(d), json.dumps(i)) for d, i in state.items()])
+                    self.db.execute("INSERT INTO meta VALUES ('migrated', ?)", (json_path,))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        if not state:
+            return
+        os.replace(json_path, json_path + ".migrated")
+        log(f"📦 Migrated {len(state)} devices from {json_path} into {self.path} "
+            f"(original kept as {json_path}.migrated).")
+
+    def load_all(self):
+        with self.lock:
+            rows = self.db.execute("SELECT device_id, data FROM devices").fetchall()
+        return {d: json.loads(data) for d, data in rows}
+
+    def replace_all(self, state):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.execute("DELETE FROM devices")
+                self.db.executemany("INSERT INTO devices (device_id, data) VALUES (?, ?)",
+                                    [(str(d), json.dumps(i)) for d, i in state.items()])
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def get(self, device_id):
+        with self.lock:
+            row = self.db.execute("SELECT data FROM devices WHERE device_id = ?",
+                                  (str(device_id),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_many(self, device_ids):
+        ids = [str(d) for d in device_ids]
+        found = {}
+        with self.lock:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                rows = self.db.execute(
+                    f"SELECT device_id, data FROM devices WHERE device_id IN ({','.join('?' * len(chunk))})",
+                    chunk).fetchall()
+                found.update((d, json.loads(data)) for d, data in rows)
+        return found
+
+    def count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM devices").fetchone()[0]
+
+    def upsert(self, device_id, info):
+        with self.lock:
+            self.db.execute("INSERT INTO devices (device_id, data) VALUES (?, ?) "
+                            "ON CONFLICT(device_id) DO UPDATE SET data = excluded.data",
+                            (str(device_id), json.dumps(info)))
+
+    def update(self, device_id, **fields):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute("SELECT data FROM devices WHERE device_id = ?",
+                                      (str(device_id),)).fetchone()
+                if row is None:
+                    self.db.execute("ROLLBACK")
+                    return False
+                info = json.loads(row[0])
+                info.update(fields)
+                self.db.execute("UPDATE devices SET data = ? WHERE device_id = ?",
+                                (json.dumps(info), str(device_id)))
+                self.db.execute("COMMIT")
+                return True
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def delete(self, device_id):
+        with self.lock:
+            return self.db.execute("DELETE FROM devices WHERE device_id = ?",
+                                   (str(device_id),)).rowcount > 0
+
+    def apply_many(self, ops):
+        """Apply (op, device_id, data) mutations in one transaction."""
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                for op, device_id, data in ops:
+                    device_id = str(device_id)
+                    if op == "patch":
+                        row = self.db.execute("SELECT data FROM devices WHERE device_id = ?",
+                                              (device_id,)).fetchone()
+                        if row is None:
+                            continue
+                        data = dict(json.loads(row[0]), **data)
+                    if op in ("put", "patch"):
+                        self.db.execute("INSERT INTO devices (device_id, data) VALUES (?, ?) "
+                                        "ON CONFLICT(device_id) DO UPDATE SET data = excluded.data",
+                                        (device_id, json.dumps(data)))
+                    elif op == "del":
+                        self.db.execute("DELETE FROM devices WHERE device_id = ?", (device_id,))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+class JournalStateStore:
+    """Write-behind backend: STATE_FILE is a snapshot and every mutation is
+    appended as one JSON line to a journal. A background thread writes and
+    fsyncs the pending lines in batches every JOURNAL_FSYNC_MS; the journal
+    is folded into a fresh snapshot once it holds JOURNAL_COMPACT_OPS
+    entries. Startup replays snapshot + journal."""
+    def __init__(self, snapshot_path, journal_path, fsync_ms=None, compact_ops=None):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.fsync_sec = (JOURNAL_FSYNC_MS if fsync_ms is None else fsync_ms) / 1000.0
+        self.compact_ops = JOURNAL_COMPACT_OPS if compact_ops is None else compact_ops
         self.lock = threading.Lock()
         self.cv = threading.Condition(self.lock)
-        self.running = False
-        self.next_run_at = None
-        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.pending = []
+        self.ops_since_compact = 0
+        self.journal = None
+        self.thread = None
 
-    def start_if_needed(self, delay_sec):
+    def load_all(self):
+        state = read_state_file(self.snapshot_path)
+        if not os.path.exists(self.journal_path):
+            return state
+        replayed = 0
+        with open(self.journal_path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    warning(f"⚠️ Torn record at the end of {self.journal_path}; stopping replay there.")
+                    break
+                apply_state_op(state, entry.get("op"), entry.get("id"), entry.get("data") or {})
+                replayed += 1
+        if replayed:
+            log(f"📜 Replayed {replayed} journal entries from {self.journal_path}.")
+        return state
+
+    def _append(self, *entries):
         with self.lock:
-            now = datetime.now()
-            if not self.running:
-                self.next_run_at = now + timedelta(seconds=delay_sec)
-                self.running = True
-                log(f"🕒 Recovery loop scheduled to start at {self.next_run_at}.")
+            self.pending.extend(json.dumps(e, separators=(",", ":")) for e in entries)
+            self.ops_since_compact += len(entries)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._flush_loop, name="state-journal", daemon=True)
                 self.thread.start()
-            else:
-                if self.next_run_at is None or self.next_run_at > now + timedelta(seconds=delay_sec):
-                    self.next_run_at = now + timedelta(seconds=delay_sec)
-                    log(f"🕒 Recovery loop next run adjusted to {self.next_run_at}.")
-            self.cv.notify_all()
+            self.cv.notify()
 
-    def _loop(self):
+    def upsert(self, device_id, info):
+        self._append({"op": "put", "id": str(device_id), "data": info})
+
+    def update(self, device_id, **fields):
+        self._append({"op": "patch", "id": str(device_id), "data": fields})
+        return True
+
+    def delete(self, device_id):
+        self._append({"op": "del", "id": str(device_id)})
+        return True
+
+    def apply_many(self, ops):
+        """Queue (op, device_id, data) mutations together, so they reach the
+        journal in the same write and fsync."""
+        self._append(*({"op": op, "id": str(device_id), "data": data} if op != "del"
+                       else {"op": op, "id": str(device_id)} for op, device_id, data in ops))
+
+    def _write_pending(self):
+        """Write and fsync queued lines; caller holds the lock."""
+        if not self.pending:
+            return
+        if self.journal is None:
+            self.journal = open(self.journal_path, "a")
+        self.journal.write("\n".join(self.pending) + "\n")
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.pending = []
+
+    def flush(self):
+        with self.lock:
+            self._write_pending()
+
+    def _flush_loop(self):
         while True:
             with self.lock:
-                state = load_state()
-                if not state:
-                    log("🛌 State file empty — pausing recovery loop until next alert.")
-                    self.running = False
-                    self.next_run_at = None
+                while not self.pending:
                     self.cv.wait()
-                    continue
+            # Let more mutations pile up so one fsync covers the whole batch.
+            time.sleep(self.fsync_sec)
+            try:
+                self.flush()
+            except OSError as e:
+                warning(f"⚠️ Failed to write state journal: {e}")
 
-                if not self.next_run_at:
-                    self.next_run_at = datetime.now() + timedelta(seconds=RECOVERY_INTERVAL_SEC)
+    def needs_compaction(self):
+        return self.ops_since_compact >= self.compact_ops
 
-                now = datetime.now()
-                wait_s = (self.next_run_at - now).total_seconds()
-                if wait_s > 0:
-                    self.cv.wait(timeout=wait_s)
+    def compact(self, state):
+        """Write `state` (which already reflects every journaled op) as the new
+        snapshot and start an empty journal."""
+        with self.lock:
+            write_state_file(self.snapshot_path, state)
+            self.pending = []
+            if self.journal is not None:
+                self.journal.close()
+            self.journal = open(self.journal_path, "w")
+            os.fsync(self.journal.fileno())
+            self.ops_since_compact = 0
 
-            self._do_recovery_pass()
+    def replace_all(self, state):
+        self.compact(state)
 
-            with self.lock:
-                self.next_run_at = datetime.now() + timedelta(seconds=RECOVERY_INTERVAL_SEC)
+def open_state_store(backend=STATE_BACKEND):
+    if backend == "sqlite":
+        return SqliteStateStore(STATE_DB, json_path=STATE_FILE)
+    if backend == "journal":
+        return JournalStateStore(STATE_FILE, STATE_FILE + ".journal")
+    if backend != "json":
+        warning(f"⚠️ Unknown STATE_BACKEND {backend!r}; using json.")
+    return JsonStateStore(STATE_FILE)
 
-    def _do_recovery_pass(self):
-        state = load_state()
-        if not state:
-            return
+@dataclass(slots=True)
+class DeviceRecord:
+    """Compact in-memory form of one tracked device."""
+    hostname: str = None
+    ip: str = None
+    port_id: str = None           # port of the first supervised ifName
+    ports: dict = None            # supervised ifName -> port_id
+    ifnames: list = None          # per-device port set (None: TARGET_IFNAMES)
+    rule: str = None              # per-device recovery rule (None: RECOVERY_RULE)
+    applied_ip: str = None        # overwrite_ip we last set in LibreNMS
+    added_at: str = None
+    attempts: int = 0
+    status: str = None
+    last_result: str = None
+    last_check_at: str = None
+    next_check_at: str = None
+    next_check_ts: float = None   # parsed next_check_at, kept for the scheduler
+    extra: dict = None            # fields this version does not know about
+
+    CORE_FIELDS = ("hostname", "ip", "port_id", "added_at")
+
+    @classmethod
+    def from_dict(cls, info):
+        known = {f: info[f] for f in DEVICE_FIELDS if f in info}
+        extra = {k: v for k, v in info.items() if k not in DEVICE_FIELDS}
+        record = cls(**known, extra=extra or None)
+        record.next_check_ts = due_timestamp(info)
+        return record
+
+    def to_dict(self):
+        info = {f: getattr(self, f) for f in DEVICE_FIELDS
+                if f in self.CORE_FIELDS or getattr(self, f) is not None}
+        if self.extra:
+            info.update(self.extra)
+        return info
+
+    def apply(self, fields):
+        for key, value in fields.items():
+            if key in DEVICE_FIELDS:
+                setattr(self, key, value)
+            else:
+                self.extra = dict(self.extra or {}, **{key: value})
+        if "next_check_at" in fields:
+            self.next_check_ts = due_timestamp(fields)
+
+DEVICE_FIELDS = tuple(f for f in DeviceRecord.__dataclass_fields__ if f not in ("next_check_ts", "extra"))
+
+class DeviceTable:
+    """Authoritative in-memory map of tracked devices.
+
+    Reads never touch disk. Every mutation is applied in memory under one
+    lock and then handed to the persistence backend (journal append,
+    SQLite row or JSON rewrite). The table is empty and has no backend
+    until open() loads one.
+    """
+    def __init__(self):
+        self.store = None
+        self.lock = threading.RLock()
+        self.pending_ops = None   # store writes held back by transaction()
+        self.records = {}
+
+    def open(self, store):
+        """Load `store` and persist to it from now on. A journal is folded
+        into a fresh snapshot first, so it starts out empty."""
+        records = {d: DeviceRecord.from_dict(i) for d, i in store.load_all().items()}
+        with self.lock:
+            self.store = store
+            self.records = records
+            if isinstance(store, JournalStateStore):
+                store.compact(self._snapshot())
+
+    def _snapshot(self):
+        return {d: r.to_dict() for d, r in self.records.items()}
+
+    def _maybe_compact(self):
+        if isinstance(self.store, JournalStateStore) and self.store.needs_compaction():
+            self.store.compact(self._snapshot())
+
+    def get(self, device_id):
+        with self.lock:
+            record = self.records.get(str(device_id))
+            return record.to_dict() if record else None
+
+    def get_many(self, device_ids):
+        with self.lock:
+            return {str(d): self.records[str(d)].to_dict() for d in device_ids if str(d) in self.records}
+
+    def load_all(self):
+        with self.lock:
+            return self._snapshot()
+
+    def count(self):
+        with self.lock:
+            return len(self.records)
+
+    def due_entries(self):
+        with self.lock:
+            return sorted(((d, r.next_check_ts) for d, r in self.records.items()),
+                          key=lambda e: (e[1] is not None, e[1] or 0))
 
-        log("🔁 Starting recovery pass for all tracked devices.")
-        changed = False
+    def upsert(self, device_id, info):
+        with self.lock:
+            self.records[str(device_id)] = DeviceRecord.from_dict(info)
+            if self.pending_ops is not None:
+                self.pending_ops.append(("put", device_id, info))
+                return
+            self.store.upsert(device_id, info)
+            self._maybe_compact()
 
-        for device_id, info in list(state.items()):
-            hostname = info.get("hostname")
-            original_ip = info.get("ip")
-            port_id = info.get("port_id")
+    def update(self, device_id, **fields):
+        with self.lock:
+            record = self.records.get(str(device_id))
+            if record is None:
+                return False
+            record.apply(fields)
+            if self.pending_ops is not None:
+                self.pending_ops.append(("patch", device_id, fields))
+                return True
+            self.store.update(device_id, **fields)
+            self._maybe_compact()
+            return True
 
-            log(f"\n--- Recovery Check for {hostname} (ID: {device_id}, PortID: {port_id}) ---")
+    def delete(self, device_id):
+        with self.lock:
+            if self.records.pop(str(device_id), None) is None:
+                return False
+            if self.pending_ops is not None:
+                self.pending_ops.append(("del", device_id, None))
+                return True
+            self.store.delete(device_id)
+            self._maybe_compact()
+            return True
 
+    @contextmanager
+    def transaction(self):
+        """Group the mutations made inside the block: memory changes at once,
+        the store receives them as one batch on exit (one SQLite
+        transaction, one journal write, one JSON rewrite). Other threads
+        wait on the table lock meanwhile, so keep API calls out of it."""
+        with self.lock:
+            if self.pending_ops is not None:
+                yield   # nested: the outer transaction writes
+                return
+            self.pending_ops = []
             try:
-                restore_device_ip(device_id, original_ip)
+                yield
+            finally:
+                ops, self.pending_ops = self.pending_ops, None
+                if ops:
+                    self.store.apply_many(ops)
+                    self._maybe_compact()
 
-                if not port_id:
-                    log("ℹ️ No port_id in state; attempting to re-detect.")
-                    port_id = find_port_id_for_ifname(device_id)
-                    if port_id:
-                        state[device_id]["port_id"] = port_id
-                        save_state(state)
+    def replace_all(self, state):
+        with self.lock:
+            self.records = {str(d): DeviceRecord.from_dict(i) for d, i in state.items()}
+            self.store.replace_all(state)
 
-                status = get_port_oper_status(port_id) if port_id else None
-                log(f"{TARGET_IFNAME} ifOperStatus = {status}")
+    def reload(self):
+        """Re-read every device from the store (other instances write to it
+        in sharded mode). The store is read under the table lock, so no
+        local write can land between the read and the swap and be lost."""
+        with self.lock:
+            state = self.store.load_all()
+            self.records = {str(d): DeviceRecord.from_dict(i) for d, i in state.items()}
 
-                if status and status.lower() == "up":
-                    log(f"✅ {hostname} recovered ({TARGET_IFNAME} is UP). Removing from state.")
-                    del state[device_id]
-                    save_state(state)
-                    changed = True
+    def refresh_many(self, device_ids):
+        """Re-read the given devices from the store."""
+        ids = [str(d) for d in device_ids]
+        found = self.store.get_many(ids)
+        with self.lock:
+            for device_id in ids:
+                if device_id in found:
+                    self.records[device_id] = DeviceRecord.from_dict(found[device_id])
                 else:
-                    log(f"❌ {hostname} still not healthy; forcing UNSUPERVISED_IP again.")
-                    force_device_down(device_id)
+                    self.records.pop(device_id, None)
 
-            except requests.HTTPError as e:
-                log(f"⚠️ HTTP error during recovery for {hostname}: {e}")
-            except Exception as e:
-                log(f"⚠️ Unexpected error during recovery for {hostname}: {e}")
+    def flush(self):
+        if isinstance(self.store, JournalStateStore):
+            self.store.flush()
 
-        if not load_state():
-            log("🎉 All devices recovered; recovery loop will pause until next alert.")
-        elif changed:
-            log("💾 State updated; remaining devices will be retried next cycle.")
+STATE = DeviceTable()
 
-RECOVERY = RecoveryManager()
+def open_state():
+    """Open the configured store into STATE, and the shard leases in
+    SHARD_MODE. Called from main (and by bench.py and simulate.py), never
+    at import: opening a journal compacts it, which must not happen under a
+    running instance, and importing prod.py must not touch STATE_DB."""
+    global SHARDS
+    STATE.open(open_state_store())
+    atexit.register(STATE.flush)
+    if SHARD_MODE and SHARDS is None:
+        SHARDS = ShardLeases()
+
+def upsert_device(device_id, info):
+    with TRACER.span("state upsert"):
+        STATE.upsert(device_id, info)
+
+def update_device(device_id, **fields):
+    with TRACER.span("state update"):
+        return STATE.update(device_id, **fields)
+
+def remove_device(device_id):
+    with TRACER.span("state delete"):
+        return STATE.delete(device_id)
 
 # =======================
-# HTTP Handler
+# Sharding
 # =======================
-class AlertHandler(BaseHTTPRequestHandler):
-    def do_POST(self):
-        content_length = int(self.headers.get("Content-Length", 0))
-        raw = self.rfile.read(content_length)
+def shard_of(device_id, shards=SHARD_COUNT):
+    return zlib.crc32(str(device_id).encode()) % shards
 
-        log("\n### RAW ALERT PAYLOAD ###")
-        log(raw.decode(errors="replace"))
-        log("#########################\n")
+class HashRing:
+    """Consistent-hash ring of instance IDs, `vnodes` points per instance,
+    so adding or losing an instance only moves that instance's share."""
+    def __init__(self, members, vnodes=SHARD_VNODES):
+        self.points = sorted((zlib.crc32(f"{m}#{v}".encode()), m) for m in members for v in range(vnodes))
+        self.keys = [p[0] for p in self.points]
 
-        try:
-            payload = json.loads(raw)
-        except json.JSONDecodeError as e:
-            log(f"⚠️ JSON decode error: {e}")
-            self.send_response(400)
-            self.end_headers()
-            self.wfile.write(b"Invalid JSON")
-            return
+    def owner(self, key):
+        if not self.points:
+            return None
+        i = bisect.bisect(self.keys, zlib.crc32(str(key).encode())) % len(self.points)
+        return self.points[i][1]
 
-        log("\n### ALERT RECEIVED ###")
-        log(json.dumps(payload, indent=2))
+class ShardLeases:
+    """Lease-based shard ownership shared by instances through SQLite.
 
-        device_id = payload.get("device_id") or payload.get("device", {}).get("device_id")
-        hostname  = payload.get("host")      or payload.get("device", {}).get("hostname")
-        ip        = payload.get("ip")        or payload.get("device", {}).get("ip") or payload.get("device", {}).get("overwrite_ip")
+    Each renewal heartbeats this instance in `members`, places the live
+    members on a hash ring, gives back shards the ring moved elsewhere and
+    claims (or extends) the leases on its own shards that are free, expired
+    or already ours. A shard still leased by another live instance is only
+    taken once that instance releases it or its lease runs out, so as long
+    as renewals succeed two instances never work the same device; when an
+    instance dies its shards move after at most LEASE_TTL_SEC.
 
-        log(f"Device ID: {device_id}")
-        log(f"Hostname:  {hostname}")
-        log(f"IP:        {ip}")
+    Checks run under begin_checks()/end_checks(). A shard the ring moves
+    away while checks on it are in flight is kept leased ("draining") and
+    only given back at the first renewal after they finish; no new checks
+    start on it meanwhile.
+    """
+    def __init__(self, path=STATE_DB, instance_id=INSTANCE_ID, shards=SHARD_COUNT,
+                 ttl_sec=LEASE_TTL_SEC, renew_sec=LEASE_RENEW_SEC):
+        self.instance_id = instance_id
+        self.shards = shards
+        self.ttl_sec = ttl_sec
+        self.renew_sec = renew_sec
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS members (
+                               instance_id TEXT PRIMARY KEY,
+                               expires_at  REAL NOT NULL)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS shard_leases (
+                               shard      INTEGER PRIMARY KEY,
+                               owner      TEXT,
+                               expires_at REAL NOT NULL DEFAULT 0)""")
+        self.owned = frozenset()
+        self.draining = frozenset()   # moved away, held until their checks finish
+        self.busy = {}                # shard -> checks in flight
+        self.busy_lock = threading.Lock()
+        self.members = []
+        self.valid_until = 0.0   # monotonic; ownership is not trusted past this
+        self.thread = None
+
+    def owns(self, device_id):
+        return time.monotonic() < self.valid_until and shard_of(device_id, self.shards) in self.owned
+
+    def holds(self, device_id):
+        """True while a check already running on the device may go on."""
+        shard = shard_of(device_id, self.shards)
+        return time.monotonic() < self.valid_until and (shard in self.owned or shard in self.draining)
+
+    def begin_checks(self, device_ids):
+        """Mark checks on the owned ones of `device_ids` as in flight and
+        return those; their shards stay leased until end_checks()."""
+        with self.busy_lock:
+            held = [d for d in device_ids if self.owns(d)]
+            for device_id in held:
+                shard = shard_of(device_id, self.shards)
+                self.busy[shard] = self.busy.get(shard, 0) + 1
+        return held
+
+    def end_checks(self, device_ids):
+        with self.busy_lock:
+            for device_id in device_ids:
+                shard = shard_of(device_id, self.shards)
+                self.busy[shard] -= 1
+                if not self.busy[shard]:
+                    del self.busy[shard]
+
+    def renew(self):
+        """One heartbeat + rebalance. Returns (gained, lost) shard sets."""
+        started = time.monotonic()
+        now = time.time()
+        before = self.owned
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.execute("INSERT INTO members VALUES (?, ?) ON CONFLICT(instance_id) "
+                                "DO UPDATE SET expires_at = excluded.expires_at",
+                                (self.instance_id, now + self.ttl_sec))
+                members = [r[0] for r in self.db.execute(
+                    "SELECT instance_id FROM members WHERE expires_at > ? ORDER BY instance_id", (now,))]
+                ring = HashRing(members)
+                wanted = {s for s in range(self.shards) if ring.owner(f"shard-{s}") == self.instance_id}
+                leases = {s: (o, e) for s, o, e in self.db.execute("SELECT shard, owner, expires_at FROM shard_leases")}
 
-        if not all([device_id, hostname, ip]):
-            log("⚠️ Missing device_id/hostname/ip in alert; ignoring.")
-            self.send_response(400)
-            self.end_headers()
-            self.wfile.write(b"Missing required fields")
+                # Stop starting checks on shards the ring moved away before
+                # deciding which of them still have checks in flight.
+                with self.busy_lock:
+                    draining = frozenset(s for s in self.busy if s not in wanted
+                                         and leases.get(s, (None,))[0] == self.instance_id)
+                    self.owned, self.draining = self.owned & wanted, draining
+
+                # Give back shards the ring now assigns elsewhere, once idle.
+                self.db.executemany("UPDATE shard_leases SET owner = NULL, expires_at = 0 "
+                                    "WHERE shard = ? AND owner = ?",
+                                    [(s, self.instance_id) for s, (o, _) in leases.items()
+                                     if o == self.instance_id and s not in wanted and s not in draining])
+                claim = [s for s in wanted
+                         if s not in leases or leases[s][0] in (None, self.instance_id) or leases[s][1] <= now]
+                self.db.executemany("INSERT INTO shard_leases VALUES (?, ?, ?) ON CONFLICT(shard) "
+                                    "DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at",
+                                    [(s, self.instance_id, now + self.ttl_sec) for s in (*claim, *draining)])
+                self.db.execute("DELETE FROM members WHERE expires_at <= ?", (now - self.ttl_sec,))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        owned = frozenset(claim)
+        gained, lost = owned - before, before - owned
+        self.owned, self.members = owned, members
+        # Stop trusting the leases a renewal interval before they expire.
+        self.valid_until = started + max(0.0, self.ttl_sec - self.renew_sec)
+        if gained or lost:
+            log(f"🧩 Shards: own {len(owned)}/{self.shards} across {len(members)} instances "
+                f"(+{len(gained)} / -{len(lost)}, {len(draining)} draining).")
+        return gained, lost
+
+    def release(self):
+        """Hand every shard back at shutdown so the others take over at once."""
+        self.valid_until = 0.0
+        with self.lock:
+            self.db.execute("UPDATE shard_leases SET owner = NULL, expires_at = 0 WHERE owner = ?",
+                            (self.instance_id,))
+            self.db.execute("DELETE FROM members WHERE instance_id = ?", (self.instance_id,))
+        log(f"🧩 Released shard leases of {self.instance_id}.")
+
+    def start(self, on_renew):
+        if self.thread is not None:
             return
+        self.thread = threading.Thread(target=self._loop, args=(on_renew,), name="shard-leases", daemon=True)
+        self.thread.start()
 
-        port_id = find_port_id_for_ifname(device_id, TARGET_IFNAME)
-        log(f"Detected {TARGET_IFNAME} port_id: {port_id}")
+    def _loop(self, on_renew):
+        while True:
+            time.sleep(self.renew_sec)
+            try:
+                self.renew()
+                on_renew()
+            except Exception as e:
+                warning(f"⚠️ Shard lease renewal failed: {e}")
 
-        state = load_state()
-        state[str(device_id)] = {
-            "hostname": hostname,
-            "ip": ip,
-            "port_id": port_id,
-            "added_at": datetime.now().isoformat()
-        }
-        save_state(state)
+SHARDS = None   # ShardLeases in SHARD_MODE, built by open_state()
 
-        try:
-            force_device_down(device_id)
-        except Exception as e:
-            log(f"⚠️ Failed to force device down initially: {e}")
+def owns(device_id):
+    """True when this instance is responsible for the device's recovery."""
+    return SHARDS is None or SHARDS.owns(device_id)
 
-        RECOVERY.start_if_needed(delay_sec=RECOVERY_INTERVAL_SEC)
+def holds(device_id):
+    """True while a running check on the device may make its next API call."""
+    return SHARDS is None or SHARDS.holds(device_id)
 
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(b"OK")
+@contextmanager
+def shard_hold(device_ids):
+    """The ones of `device_ids` this instance may check now; their shards
+    stay leased until the block exits."""
+    if SHARDS is None:
+        yield list(device_ids)
+        return
+    held = SHARDS.begin_checks(device_ids)
+    try:
+        yield held
+    finally:
+        SHARDS.end_checks(held)
 
-# =======================
-# Main
-# =======================
-if __name__ == "__main__":
-    log(f"HTTP server listening on 0.0.0.0:{HTTP_PORT} for LibreNMS alerts...")
-    server = HTTPServer(("0.0.0.0", HTTP_PORT), AlertHandler)
+class ApiResponse:
+    """The parts of requests.Response that libre_api() uses, for responses
+    read by AsyncLibreClient."""
+    def __init__(self, method, url, status_code, headers, content, bytes_sent=0):
+        self.method = method
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers   # lower-cased names
+        self.content = content
+        self.bytes_sent = bytes_sent
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            kind = "Client" if self.status_code < 500 else "Server"
+            try:
+                reason = HTTPStatus(self.status_code).phrase
+            except ValueError:
+                reason = ""
+            raise requests.HTTPError(f"{self.status_code} {kind} Error: {reason} for url: {self.url}",
+                                     response=self)
+
+class AsyncLibreClient:
+    """asyncio counterpart of LibreClient, used by the async engine.
+
+    Speaks HTTP/1.1 over asyncio streams (no extra dependency) through a
+    pool of at most max_connections keep-alive connections. Timeouts, the
+    retry policy and backoff are LibreClient's, and it takes tokens from the
+    same bucket, so both engines share one rate limit against LibreNMS.
+    """
+    RETRY_METHODS = LibreClient.RETRY_METHODS
+    _backoff = LibreClient._backoff
+
+    def __init__(self, base_url, token, limiter, max_connections=ASYNC_API_CONNECTIONS,
+                 connect_timeout=API_CONNECT_TIMEOUT, read_timeout=API_READ_TIMEOUT,
+                 max_retries=API_MAX_RETRIES, backoff_sec=API_BACKOFF_SEC,
+                 backoff_max_sec=API_BACKOFF_MAX_SEC):
+        self.base_url = base_url.rstrip("/")
+        parts = urlsplit(self.base_url)
+        self.ssl = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.ssl else 80)
+        self.base_path = parts.path
+        self.header_block = (f"Host: {parts.netloc}\r\nX-Auth-Token: {token}\r\n"
+                             "Content-Type: application/json\r\nAccept: application/json\r\n")
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_sec = backoff_sec
+        self.backoff_max_sec = backoff_max_sec
+        self.limiter = limiter
+        self.max_connections = max(1, max_connections)
+        self.slots = None   # asyncio.Semaphore, created inside the running loop
+        self.idle = []      # (reader, writer) of idle keep-alive connections
+
+    async def request(self, method, endpoint, data=None, params=None):
+        method = method.upper()
+        target = self.base_path + endpoint + (f"?{urlencode(params)}" if params else "")
+        body = json.dumps(data).encode() if data is not None else b""
+        retries = self.max_retries if method in self.RETRY_METHODS else 0
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_connections)
+
+        attempt = 0
+        while True:
+            while (wait_s := self.limiter.try_acquire()) > 0:
+                await asyncio.sleep(wait_s)
+            try:
+                async with self.slots:
+                    r = await self._exchange(method, target, body)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+                if attempt >= retries:
+                    raise
+                delay = self._backoff(attempt)
+                warning(f"⚠️ {method} {endpoint} failed ({e.__class__.__name__}); retry {attempt + 1}/{retries} in {delay:.1f}s")
+            else:
+                if not (r.status_code >= 500 or r.status_code == 429) or attempt >= retries:
+                    return r
+                retry_after = r.headers.get("retry-after")
+                delay = self._backoff(attempt, float(retry_after) if retry_after and retry_after.isdigit() else None)
+                warning(f"⚠️ {method} {endpoint} returned {r.status_code}; retry {attempt + 1}/{retries} in {delay:.1f}s")
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def _exchange(self, method, target, body):
+        """One request/response on a pooled connection. A pooled connection
+        the server already closed is replaced before anything is sent on it;
+        one that fails mid-request is only resent on for RETRY_METHODS, as a
+        POST may have reached LibreNMS."""
+        head = (f"{method} {target} HTTP/1.1\r\n{self.header_block}"
+                f"Content-Length: {len(body)}\r\n\r\n").encode("latin-1")
+        while True:
+            reused = bool(self.idle)
+            if reused:
+                reader, writer = self.idle.pop()
+                if reader.at_eof() or writer.is_closing():
+                    writer.close()   # closed by LibreNMS while idle
+                    continue
+            else:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port, ssl=self.ssl or None),
+                    self.connect_timeout)
+            try:
+                writer.write(head + body)
+                await writer.drain()
+                status, headers, content, keep_alive = await asyncio.wait_for(
+                    self._read_response(reader, method), self.read_timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused and method in self.RETRY_METHODS:
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            if keep_alive:
+                self.idle.append((reader, writer))
+            else:
+                writer.close()
+            return ApiResponse(method, f"{self.base_url}{target[len(self.base_path):]}",
+                               status, headers, content, len(body))
+
+    @staticmethod
+    async def _read_response(reader, method):
+        line = await reader.readline()
+        if not line:
+            raise ConnectionResetError("connection closed by LibreNMS")
+        version, status = line.split(None, 2)[:2]
+        status = int(status)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = version == b"HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        if method == "HEAD" or status in (204, 304) or status < 200:
+            content = b""
+        elif headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";", 1)[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass   # trailers
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            content = b"".join(chunks)
+        elif "content-length" in headers:
+            content = await reader.readexactly(int(headers["content-length"]))
+        else:
+            content, keep_alive = await reader.read(), False
+        return status, headers, content, keep_alive
+
+API = LibreClient(LIBRENMS_URL, API_TOKEN, API_POOL_SIZE, API_CONNECT_TIMEOUT, API_READ_TIMEOUT,
+                  API_MAX_RETRIES, API_BACKOFF_SEC, API_BACKOFF_MAX_SEC, API_RATE_PER_SEC, API_RATE_BURST)
+ASYNC_API = AsyncLibreClient(LIBRENMS_URL, API_TOKEN, API.limiter)
+
+def libre_api(method, endpoint, data=None, params=None):
+    debug("API request %s %s params=%s data=%s", method, endpoint, params,
+          lambda: json.dumps(data) if data else None)
+
+    started = time.monotonic()
+    with TRACER.span(f"API {method} {endpoint_label(endpoint)}", endpoint=endpoint) as span, \
+            METRICS.timer("api_request_seconds", method=method, endpoint=endpoint_label(endpoint),
+                          status="error") as labels:
+        r = API.request(method, endpoint, data=data, params=params)
+        labels["status"] = r.status_code
+        span.update(status=r.status_code, bytes=len(r.content), bytes_sent=len(r.request.body or b""))
+    return _api_result(method, endpoint, r, started)
+
+async def alibre_api(method, endpoint, data=None, params=None):
+    """libre_api() for the async engine."""
+    debug("API request %s %s params=%s data=%s", method, endpoint, params,
+          lambda: json.dumps(data) if data else None)
+
+    started = time.monotonic()
+    with TRACER.span(f"API {method} {endpoint_label(endpoint)}", endpoint=endpoint) as span, \
+            METRICS.timer("api_request_seconds", method=method, endpoint=endpoint_label(endpoint),
+                          status="error") as labels:
+        r = await ASYNC_API.request(method, endpoint, data=data, params=params)
+        labels["status"] = r.status_code
+        span.update(status=r.status_code, bytes=len(r.content), bytes_sent=r.bytes_sent)
+    return _api_result(method, endpoint, r, started)
+
+def _api_result(method, endpoint, r, started):
+    elapsed_ms = (time.monotonic() - started) * 1000
+    log(f"API {method} {endpoint} -> {r.status_code} ({elapsed_ms:.0f} ms, {len(r.content)} B)")
+    if LOGGER.enabled("DEBUG"):
+        debug("API response body: %s", r.content)
+
+    r.raise_for_status()
+    if r.content:
+        try:
+            return r.json()
+        except ValueError:
+            return None
+    return None
+
+class PortIndex:
+    """In-memory (device_id, ifName) -> port_id index.
+
+    Filled by one bulk /ports/search/ifName call per ifName and shared by all
+    alerts, so a storm of N alerts costs a single search instead of N. Entries
+    expire after a TTL, the least recently used ones are evicted beyond
+    max_entries, and a miss after a fresh bulk load falls back to a targeted
+    /devices/{id}/ports lookup for that one device.
+    """
+    def __init__(self, ttl_sec=PORT_INDEX_TTL_SEC, max_entries=PORT_INDEX_MAX_ENTRIES,
+                 refresh_sec=PORT_INDEX_REFRESH_SEC):
+        self.ttl_sec = ttl_sec
+        self.max_entries = max_entries
+        self.refresh_sec = refresh_sec
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()   # (device_id, ifName) -> (port_id, fetched_at)
+        self.bulk_loaded_at = {}       # ifName -> monotonic time of the last bulk load
+        self.bulk_locks = {}           # ifName -> lock, so only one bulk fetch runs at a time
+        self.async_bulk_locks = {}     # ifName -> asyncio.Lock, the same for the async engine
+        self.hits = 0
+        self.misses = 0
+        self.bulk_fetches = 0
+        self.device_lookups = 0
+        self.thread = None
+
+    def _get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            port_id, fetched_at = entry
+            if time.monotonic() - fetched_at > self.ttl_sec:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return port_id
+
+    def _put_many(self, items, fetched_at):
+        with self.lock:
+            for key, port_id in items:
+                self.entries[key] = (port_id, fetched_at)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _bulk_is_fresh(self, ifname):
+        loaded_at = self.bulk_loaded_at.get(ifname)
+        return loaded_at is not None and time.monotonic() - loaded_at <= self.ttl_sec
+
+    def _bulk_load(self, ifname, force=False):
+        with self.lock:
+            bulk_lock = self.bulk_locks.setdefault(ifname, threading.Lock())
+        with bulk_lock:
+            # Another thread may have completed the load while we waited.
+            if not force and self._bulk_is_fresh(ifname):
+                return
+            resp = libre_api("GET", f"/ports/search/ifName/{ifname}",
+                             params={"columns": "port_id,device_id,ifName"})
+            self.ingest(resp.get("ports", []) if resp else [], ifname)
+            with self.lock:
+                self.bulk_fetches += 1
+
+    def ingest(self, ports, ifname):
+        """Load a full /ports/search/ifName result for `ifname`."""
+        now = time.monotonic()
+        self._put_many([((str(p.get("device_id")), ifname), str(p.get("port_id")))
+                        for p in ports
+                        if p.get("port_id") is not None and p.get("ifName", ifname) == ifname], now)
+        with self.lock:
+            self.bulk_loaded_at[ifname] = now
+
+    def ingest_device(self, device_id, ports):
+        """Load a /devices/{id}/ports result (every ifName of one device)."""
+        self._put_many([((str(device_id), p.get("ifName")), str(p.get("port_id")))
+                        for p in ports if p.get("port_id") is not None and p.get("ifName")],
+                       time.monotonic())
+
+    def _lookup_device(self, device_id, ifname):
+        resp = libre_api("GET", f"/devices/{device_id}/ports",
+                         params={"columns": "port_id,ifName"})
+        with self.lock:
+            self.device_lookups += 1
+        self.ingest_device(device_id, resp.get("ports", []) if resp else [])
+        return self._get((str(device_id), ifname))
+
+    def lookup(self, device_id, ifname=TARGET_IFNAME):
+        key = (str(device_id), ifname)
+        port_id = self._get(key)
+        if port_id:
+            with self.lock:
+                self.hits += 1
+            return port_id
+
+        with self.lock:
+            self.misses += 1
+        if not self._bulk_is_fresh(ifname):
+            self._bulk_load(ifname)
+            port_id = self._get(key)
+            if port_id:
+                return port_id
+        return self._lookup_device(device_id, ifname)
+
+    async def alookup(self, device_id, ifname=TARGET_IFNAME):
+        """lookup() for the async engine: same cache, with bulk loads
+        single-flighted per ifName on an asyncio lock."""
+        key = (str(device_id), ifname)
+        port_id = self._get(key)
+        if port_id:
+            with self.lock:
+                self.hits += 1
+            return port_id
+
+        with self.lock:
+            self.misses += 1
+        if not self._bulk_is_fresh(ifname):
+            async with self.async_bulk_locks.setdefault(ifname, asyncio.Lock()):
+                if not self._bulk_is_fresh(ifname):
+                    resp = await alibre_api("GET", f"/ports/search/ifName/{ifname}",
+                                            params={"columns": "port_id,device_id,ifName"})
+                    self.ingest(resp.get("ports", []) if resp else [], ifname)
+                    with self.lock:
+                        self.bulk_fetches += 1
+            port_id = self._get(key)
+            if port_id:
+                return port_id
+
+        resp = await alibre_api("GET", f"/devices/{device_id}/ports",
+                                params={"columns": "port_id,ifName"})
+        with self.lock:
+            self.device_lookups += 1
+        self.ingest_device(device_id, resp.get("ports", []) if resp else [])
+        return self._get(key)
+
+    def invalidate(self, device_id, ifname=None):
+        """Forget a port LibreNMS no longer has (every port of the device
+        when `ifname` is None), so the next lookup searches again."""
+        with self.lock:
+            if ifname is not None:
+                self.entries.pop((str(device_id), ifname), None)
+                return
+            for key in [k for k in self.entries if k[0] == str(device_id)]:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses,
+                    "bulk_fetches": self.bulk_fetches, "device_lookups": self.device_lookups}
+
+    def start_refresher(self):
+        if self.refresh_sec <= 0 or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._refresh_loop, name="port-index", daemon=True)
+        self.thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_sec)
+            for ifname in list(self.bulk_loaded_at):
+                try:
+                    self._bulk_load(ifname, force=True)
+                except Exception as e:
+                    warning(f"⚠️ Port index refresh for {ifname} failed: {e}")
+            log(f"📇 Port index refreshed: {self.stats()}")
+
+PORT_INDEX = PortIndex()
+
+def find_port_id_for_ifname(device_id_or_host, ifname=TARGET_IFNAME):
+    try:
+        return PORT_INDEX.lookup(device_id_or_host, ifname)
+    except Exception as e:
+        warning(f"⚠️ Failed to lookup port_id via search API for {device_id_or_host}: {e}")
+    return None
+
+def load_supervision_groups(path=SUPERVISION_GROUPS_FILE):
+    if not path:
+        return {}
+    try:
+        with open(path) as f:
+            groups = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        warning(f"⚠️ Could not read supervision groups from {path}: {e}")
+        return {}
+    for name, group in list(groups.items()):
+        if not group.get("ifnames") or not valid_rule(group.get("rule") or RECOVERY_RULE):
+            warning(f"⚠️ Ignoring supervision group {name!r}: needs ifnames and a valid rule.")
+            del groups[name]
+    return groups
+
+def valid_rule(rule):
+    rule = str(rule).lower()
+    if rule in ("all", "any"):
+        return True
+    return rule.startswith("min:") and rule[4:].isdigit() and int(rule[4:]) > 0
+
+def rule_satisfied(rule, statuses):
+    """Apply a recovery rule to {ifName: ifOperStatus} of one device."""
+    up = sum(1 for status in statuses.values() if status and status.lower() == "up")
+    rule = rule.lower()
+    if rule == "any":
+        return up > 0
+    if rule.startswith("min:"):
+        return up >= int(rule[4:])
+    return bool(statuses) and up == len(statuses)
+
+def supervision_for(info):
+    """(ifnames, rule) supervised for one tracked device."""
+    return info.get("ifnames") or TARGET_IFNAMES, info.get("rule") or RECOVERY_RULE
+
+def known_ports(info):
+    """Supervised ifName -> port_id already in state (records written before
+    multi-port supervision only carry port_id, for the first ifName)."""
+    ports = dict(info.get("ports") or {})
+    first = supervision_for(info)[0][0]
+    if info.get("port_id") and first not in ports:
+        ports[first] = info["port_id"]
+    return ports
+
+def fetch_device_ports(device_id):
+    """ifName -> (port_id, ifOperStatus) for every port of one device, from a
+    single /devices/{id}/ports call however many ports are supervised."""
+    try:
+        resp = libre_api("GET", f"/devices/{device_id}/ports",
+                         params={"columns": "port_id,ifName,ifOperStatus"})
+    except requests.HTTPError as e:
+        _device_ports_failed(device_id, e)
+        raise
+    return _device_ports(device_id, resp)
+
+async def afetch_device_ports(device_id):
+    try:
+        resp = await alibre_api("GET", f"/devices/{device_id}/ports",
+                                params={"columns": "port_id,ifName,ifOperStatus"})
+    except requests.HTTPError as e:
+        _device_ports_failed(device_id, e)
+        raise
+    return _device_ports(device_id, resp)
+
+def _device_ports_failed(device_id, e):
+    # 404: LibreNMS no longer knows the device, so none of its cached ports are valid.
+    if getattr(e.response, "status_code", None) == 404:
+        PORT_INDEX.invalidate(device_id)
+
+def _device_ports(device_id, resp):
+    ports = resp.get("ports", []) if resp else []
+    PORT_INDEX.ingest_device(device_id, ports)
+    return {p["ifName"]: (str(p["port_id"]), p.get("ifOperStatus"))
+            for p in ports if p.get("port_id") is not None and p.get("ifName")}
+
+def fetch_port_snapshot(devices, min_devices=PORT_STATUS_BULK_MIN):
+    """Map device_id -> {ifName: (port_id, ifOperStatus)} for the given
+    {device_id: info} with one /ports/search/ifName request per supervised
+    ifName, carrying the ifOperStatus column.
+
+    An ifName supervised on fewer than `min_devices` of the devices is not
+    searched (the fleet-wide search would cost more than it saves);
+    callers fall back to one per-device lookup for any device the snapshot
+    does not fully cover.
+    """
+    snapshot = {}
+    for ifname, device_ids in _snapshot_wanted(devices, min_devices).items():
+        try:
+            resp = libre_api("GET", f"/ports/search/ifName/{ifname}",
+                             params={"columns": "port_id,device_id,ifName,ifOperStatus"})
+        except Exception as e:
+            warning(f"⚠️ Bulk port status fetch for {ifname} failed; falling back to per-device lookups: {e}")
+            continue
+        _snapshot_ingest(snapshot, ifname, device_ids, resp)
+    return snapshot
+
+async def afetch_port_snapshot(devices, min_devices=PORT_STATUS_BULK_MIN):
+    snapshot = {}
+    for ifname, device_ids in _snapshot_wanted(devices, min_devices).items():
+        try:
+            resp = await alibre_api("GET", f"/ports/search/ifName/{ifname}",
+                                    params={"columns": "port_id,device_id,ifName,ifOperStatus"})
+        except Exception as e:
+            warning(f"⚠️ Bulk port status fetch for {ifname} failed; falling back to per-device lookups: {e}")
+            continue
+        _snapshot_ingest(snapshot, ifname, device_ids, resp)
+    return snapshot
+
+def _snapshot_wanted(devices, min_devices):
+    """ifName -> device IDs supervising it, for ifNames worth a bulk search."""
+    wanted = {}
+    for device_id, info in devices.items():
+        for ifname in supervision_for(info)[0]:
+            wanted.setdefault(ifname, set()).add(str(device_id))
+    return {n: ids for n, ids in wanted.items() if len(ids) >= min_devices}
+
+def _snapshot_ingest(snapshot, ifname, device_ids, resp):
+    ports = resp.get("ports", []) if resp else []
+    PORT_INDEX.ingest(ports, ifname)
+    covered = 0
+    for p in ports:
+        device_id = str(p.get("device_id"))
+        if device_id in device_ids and p.get("port_id") is not None and p.get("ifName", ifname) == ifname:
+            snapshot.setdefault(device_id, {})[ifname] = (str(p.get("port_id")), p.get("ifOperStatus"))
+            covered += 1
+    log(f"📊 Port status snapshot: 1 {ifname} request covered {covered}/{len(device_ids)} devices.")
+
+class ApiSavings:
+    """Counts LibreNMS calls that were skipped as redundant."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.patches = 0
+        self.discoveries = 0
+
+    def add(self, patches=0, discoveries=0):
+        with self.lock:
+            self.patches += patches
+            self.discoveries += discoveries
+
+    def snapshot(self):
+        with self.lock:
+            return {"patches": self.patches, "discoveries": self.discoveries}
+
+SAVINGS = ApiSavings()
+
+def set_overwrite_ip(device_id_or_host, ip, discover=True):
+    """Point the device's overwrite_ip at `ip`, then rediscover it.
+
+    The PATCH is skipped when state records `ip` as the value we last
+    applied, and discovery only follows a PATCH that changed something.
+    `ip` counts as applied only once its discovery succeeded.
+    Returns True when the PATCH was sent.
+    """
+    if _overwrite_ip_applied(device_id_or_host, ip, discover):
+        return False
+
+    libre_api("PATCH", f"/devices/{device_id_or_host}",
+              {"field": "overwrite_ip", "data": ip})
+    if discover:
+        # Not in effect until rediscovered: forget the old value, and only
+        # record `ip` once discovery went through, so a failed discovery is
+        # retried instead of skipped.
+        update_device(device_id_or_host, applied_ip=None)
+        libre_api("GET", f"/devices/{device_id_or_host}/discover")
+    else:
+        SAVINGS.add(discoveries=1)
+    update_device(device_id_or_host, applied_ip=ip)
+    return True
+
+async def aset_overwrite_ip(device_id_or_host, ip, discover=True):
+    """set_overwrite_ip() for the async engine."""
+    if _overwrite_ip_applied(device_id_or_host, ip, discover):
+        return False
+
+    await alibre_api("PATCH", f"/devices/{device_id_or_host}",
+                     {"field": "overwrite_ip", "data": ip})
+    if discover:
+        update_device(device_id_or_host, applied_ip=None)   # see set_overwrite_ip()
+        await alibre_api("GET", f"/devices/{device_id_or_host}/discover")
+    else:
+        SAVINGS.add(discoveries=1)
+    update_device(device_id_or_host, applied_ip=ip)
+    return True
+
+def _overwrite_ip_applied(device_id_or_host, ip, discover):
+    """True (and the skipped calls counted) when state says `ip` is already applied."""
+    info = STATE.get(device_id_or_host)
+    if info is not None and info.get("applied_ip") == ip:
+        SAVINGS.add(patches=1, discoveries=1 if discover else 0)
+        log(f"⏭️ overwrite_ip of device {device_id_or_host} is already {ip}; skipping PATCH"
+            f"{' and discovery' if discover else ''}.")
+        return True
+    return False
+
+def force_device_down(device_id_or_host, discover=True):
+    return set_overwrite_ip(device_id_or_host, UNSUPERVISED_IP, discover)
+
+def restore_device_ip(device_id_or_host, original_ip, discover=True):
+    return set_overwrite_ip(device_id_or_host, original_ip, discover)
+
+async def aforce_device_down(device_id_or_host, discover=True):
+    return await aset_overwrite_ip(device_id_or_host, UNSUPERVISED_IP, discover)
+
+async def arestore_device_ip(device_id_or_host, original_ip, discover=True):
+    return await aset_overwrite_ip(device_id_or_host, original_ip, discover)
+
+class LocalPoller(librenms_common.LocalPoller):
+    """librenms_common.LocalPoller, recording each poll of poll_many() as a
+    "local poll" span in the device's sampled trace."""
+    def poll_many(self, hosts_or_ids, traces=None):
+        """Poll every device; `traces` maps a device to its sampled Trace."""
+        traces = traces or {}
+
+        def poll(host_or_id):
+            with TRACER.activate(traces.get(host_or_id)), TRACER.span("local poll"):
+                return self.poll(host_or_id)
+
+        super().poll_many(hosts_or_ids, poll)
+
+POLLER = (LocalPoller(POLL_COMMAND, POLL_CONCURRENCY, POLL_TIMEOUT_SEC, POLL_KILL_GRACE_SEC)
+          if POLL_BACKEND == "local" else None)
+
+# =======================
+# Recovery Manager
+# =======================
+def device_splay(device_id):
+    """Stable per-device offset in [0, RECOVERY_SPLAY_SEC) used to spread
+    devices that were alerted at the same moment across the interval."""
+    return (zlib.crc32(str(device_id).encode()) / 0xFFFFFFFF) * RECOVERY_SPLAY_SEC
+
+def backoff_delay(attempts):
+    """Delay before the next check of a device that failed `attempts` checks:
+    the interval grown by RECOVERY_BACKOFF_FACTOR per failure, capped at
+    RECOVERY_BACKOFF_MAX_SEC, with +/- RECOVERY_BACKOFF_JITTER spread."""
+    delay = min(RECOVERY_BACKOFF_MAX_SEC,
+                RECOVERY_INTERVAL_SEC * RECOVERY_BACKOFF_FACTOR ** max(0, attempts - 1))
+    return delay * random.uniform(1 - RECOVERY_BACKOFF_JITTER, 1 + RECOVERY_BACKOFF_JITTER)
+
+def next_check_time(device_id, info, now=None):
+    """Epoch time of a device's next recovery check.
+
+    The first check is due one interval after added_at, pulled forward by the
+    device's splay; every later check backs off from now.
+    """
+    now = time.time() if now is None else now
+    attempts = int(info.get("attempts", 0))
+    if attempts > 0:
+        return now + backoff_delay(attempts)
+    try:
+        anchor = datetime.fromisoformat(info.get("added_at")).timestamp()
+    except (TypeError, ValueError):
+        anchor = now
+    return anchor + RECOVERY_INTERVAL_SEC - device_splay(device_id)
+
+class FlapDetector:
+    """Sliding-window count of up/down transitions per device.
+
+    A transition is recorded when a device recovers and when an untracked
+    device is alerted again; devices crossing FLAP_THRESHOLD within
+    FLAP_WINDOW_SEC are held quiet instead of being re-checked right away.
+    """
+    def __init__(self, threshold=FLAP_THRESHOLD, window_sec=FLAP_WINDOW_SEC):
+        self.threshold = threshold
+        self.window_sec = window_sec
+        self.lock = threading.Lock()
+        self.events = {}   # device_id -> deque of transition timestamps
+
+    def record(self, device_id, now=None):
+        """Record a transition and return the count inside the window."""
+        now = time.time() if now is None else now
+        cutoff = now - self.window_sec
+        with self.lock:
+            events = self.events.setdefault(str(device_id), deque())
+            events.append(now)
+            while events and events[0] < cutoff:
+                events.popleft()
+            if len(self.events) > 10000:
+                self.events = {d: e for d, e in self.events.items() if e and e[-1] >= cutoff}
+            return len(events)
+
+    def is_flapping(self, count):
+        return self.threshold > 0 and count >= self.threshold
+
+FLAPS = FlapDetector()
+
+class RecoveryManager:
+    """Per-device recovery scheduler.
+
+    Every tracked device sits in a min-heap keyed by its own next-check time.
+    The dispatcher thread sleeps until the earliest device is due, then runs a
+    recovery pass over just the devices that are due at that moment.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cv = threading.Condition(self.lock)
+        self.heap = []          # (due_ts, device_id); stale entries are skipped lazily
+        self.scheduled = {}     # device_id -> due_ts of its live heap entry
+        self.started = False
+        self.thread = threading.Thread(target=self._loop, name="recovery", daemon=True)
+
+    def start(self):
+        """Seed the schedule from state and start the dispatcher (idempotent)."""
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        for device_id, due in STATE.due_entries():
+            if due is None:
+                due = next_check_time(device_id, STATE.get(device_id) or {})
+            self.schedule(device_id, due)
+        self.thread.start()
+
+    def track(self, device_id, info):
+        """Record an alerted device in state and schedule its first check.
+
+        Returns False when the device is already tracked: a repeated alert
+        only refreshes hostname/ip and keeps the device's backoff and
+        schedule. Only a fresh alert counts as a flap transition.
+        """
+        device_id = str(device_id)
+        if SHARDS is not None:
+            STATE.refresh_many([device_id])   # may have been tracked via another instance
+        with STATE.lock:
+            existing = STATE.get(device_id)
+            if existing:
+                changed = {k: info[k] for k in ("hostname", "ip", "ifnames", "rule")
+                           if k in info and info[k] != existing.get(k)}
+                if changed:
+                    update_device(device_id, **changed)
+                self.start()
+                return False
+            self._track_new(device_id, info)
+        self.start()
+        log(f"🕒 Recovery check for device {device_id} scheduled at {info['next_check_at']}.")
+        return True
+
+    def _track_new(self, device_id, info):
+        transitions = FLAPS.record(device_id)
+        if FLAPS.is_flapping(transitions):
+            due = time.time() + FLAP_QUIET_SEC
+            info["status"] = "quiet"
+            log(f"🔇 Device {device_id} flapped {transitions}x in {FLAP_WINDOW_SEC}s; "
+                f"holding it down for {FLAP_QUIET_SEC}s.")
+        else:
+            due = next_check_time(device_id, info)
+            info["status"] = "active"
+        info["next_check_at"] = datetime.fromtimestamp(due).isoformat()
+        upsert_device(device_id, info)
+        self.schedule(device_id, due)
+
+    def schedule(self, device_id, due_ts):
+        if not owns(device_id):
+            return   # another instance's shard; it schedules the device itself
+        with self.lock:
+            self.scheduled[str(device_id)] = due_ts
+            heapq.heappush(self.heap, (due_ts, str(device_id)))
+            if len(self.heap) > 2 * len(self.scheduled) + 64:
+                self.heap = [(d, i) for i, d in self.scheduled.items()]
+                heapq.heapify(self.heap)
+            self.cv.notify_all()
+
+    def unschedule(self, device_id):
+        with self.lock:
+            self.scheduled.pop(str(device_id), None)
+
+    def alive(self):
+        return not self.started or self.thread.is_alive()
+
+    def sync_shards(self):
+        """After a lease renewal: pick up devices other instances tracked in
+        our shards and drop the ones whose shard moved away."""
+        STATE.reload()
+        self._sync_owned()
+
+    def _sync_owned(self):
+        for device_id, due in STATE.due_entries():
+            if owns(device_id) and device_id not in self.scheduled:
+                self.schedule(device_id, due if due is not None
+                              else next_check_time(device_id, STATE.get(device_id) or {}))
+        for device_id in [d for d in list(self.scheduled) if not owns(d)]:
+            self.unschedule(device_id)
+
+    def _pop_due(self, now):
+        """Pop every device due at `now`; caller holds the lock."""
+        due_ids = []
+        while self.heap and self.heap[0][0] <= now:
+            due_ts, device_id = heapq.heappop(self.heap)
+            if self.scheduled.get(device_id) == due_ts:
+                del self.scheduled[device_id]
+                due_ids.append(device_id)
+        return due_ids
+
+    def _next_wait(self, now):
+        """Seconds until the earliest live entry is due, or None if idle."""
+        while self.heap and self.scheduled.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return max(0.0, self.heap[0][0] - now) if self.heap else None
+
+    def _loop(self):
+        idle_logged = False
+        passes = 0
+        while True:
+            with self.lock:
+                now = time.time()
+                due_ids = self._pop_due(now)
+                if not due_ids:
+                    wait_s = self._next_wait(now)
+                    if wait_s is None and not idle_logged:
+                        log("🛌 No tracked devices — pausing recovery loop until next alert.")
+                        idle_logged = True
+                    self.cv.wait(timeout=wait_s)
+                    continue
+                idle_logged = False
+
+            with shard_hold(due_ids) as due_ids:
+                if SHARDS is not None:
+                    STATE.refresh_many(due_ids)
+                if not due_ids:
+                    continue
+                passes += 1
+                with correlation(f"pass-{passes}"):
+                    try:
+                        self._do_recovery_pass(due_ids)
+                    except Exception as e:
+                        # Keep the dispatcher alive; the devices are retried when next due.
+                        warning(f"⚠️ Recovery pass failed: {e}")
+                        for device_id in due_ids:
+                            info = STATE.get(device_id)
+                            if info is not None and device_id not in self.scheduled:
+                                self.schedule(device_id, next_check_time(device_id, info))
+
+    def _restore_device(self, device_id, info):
+        """Phase 1: put the device's real IP back. Returns False on failure."""
+        hostname = info.get("hostname")
+        ports = known_ports(info)
+        log(f"--- Recovery check for {hostname} (ID: {device_id}, ports: {ports or 'unknown'}) ---")
+        try:
+            restore_device_ip(device_id, info.get("ip"), discover=self._restore_discovers(info, ports))
+            return True
+        except requests.HTTPError as e:
+            warning(f"⚠️ HTTP error restoring {hostname}: {e}")
+        except Exception as e:
+            warning(f"⚠️ Unexpected error restoring {hostname}: {e}")
+        return False
+
+    @staticmethod
+    def _restore_discovers(info, ports):
+        # A device missing a supervised port needs discovery to find it again.
+        return RECOVERY_CHECK_MODE == "full" or any(n not in ports for n in supervision_for(info)[0])
+
+    def _check_device(self, device_id, info, snapshot):
+        """Phase 2: decide from the pass-wide port snapshot (falling back to a
+        per-device lookup when the snapshot does not cover the device).
+
+        Returns "recovered", "down" or "error". Failures are contained here so
+        one bad device cannot abort the rest of the pass.
+        """
+        hostname = info.get("hostname")
+        ifnames, _ = supervision_for(info)
+
+        try:
+            found = snapshot.get(device_id, {})
+            if any(n not in found for n in ifnames):
+                # One call returns every port of the device, whatever K is.
+                found = fetch_device_ports(device_id)
+            if self._apply_port_statuses(device_id, info, found):
+                return "recovered"
+            if not holds(device_id):
+                return self._lapsed(hostname)
+            force_device_down(device_id, discover=RECOVERY_CHECK_MODE == "full")
+            return "down"
+
+        except requests.HTTPError as e:
+            warning(f"⚠️ HTTP error during recovery for {hostname}: {e}")
+        except Exception as e:
+            warning(f"⚠️ Unexpected error during recovery for {hostname}: {e}")
+        return "error"
+
+    @staticmethod
+    def _lapsed(hostname):
+        warning(f"⚠️ Shard lease of {hostname} lapsed mid-check; leaving it to its next owner.")
+        return "error"
+
+    def _apply_port_statuses(self, device_id, info, found):
+        """Record the device's ports from `found` ({ifName: (port_id,
+        ifOperStatus)}) and apply its rule. A recovered device is released
+        and True returned; False means it must be forced down again."""
+        hostname = info.get("hostname")
+        ifnames, rule = supervision_for(info)
+        statuses = {n: found[n][1] if n in found else None for n in ifnames}
+        ports = {n: found[n][0] for n in ifnames if n in found}
+        for ifname in ifnames:
+            if ifname not in found:
+                PORT_INDEX.invalidate(device_id, ifname)   # gone, or renamed by a rediscovery
+        if ports != known_ports(info):
+            update_device(device_id, ports=ports, port_id=ports.get(ifnames[0]))
+        log(f"{hostname}: ifOperStatus " + ", ".join(f"{n}={statuses[n]}" for n in ifnames) + f" (rule {rule})")
+
+        if rule_satisfied(rule, statuses):
+            log(f"✅ {hostname} recovered (rule {rule} met). Removing from state.")
+            remove_device(device_id)
+            FLAPS.record(device_id)
+            try:
+                METRICS.observe("time_to_recovery_seconds",
+                                time.time() - datetime.fromisoformat(info["added_at"]).timestamp())
+            except (KeyError, TypeError, ValueError):
+                pass
+            return True
+
+        log(f"❌ {hostname} still not healthy; forcing UNSUPERVISED_IP again.")
+        return False
+
+    def _do_recovery_pass(self, device_ids=None):
+        """Check the given devices (all tracked devices when None) and
+        reschedule the ones that are still down.
+
+        Restores run in parallel, the restored devices are polled (when a
+        poll backend is configured), then one bulk port-status snapshot is
+        taken for the whole pass, then the per-device decisions run in
+        parallel.
+        """
+        state = STATE.load_all() if device_ids is None else STATE.get_many(device_ids)
+        if not state:
+            return
+
+        workers = max(1, min(RECOVERY_CONCURRENCY, len(state)))
+        log(f"🔁 Starting recovery pass for {len(state)} due devices ({workers} in flight).")
+        started = time.monotonic()
+        results = {"recovered": 0, "down": 0, "error": 0}
+
+        cid = CORRELATION_ID.get() or "pass"
+        pass_trace = TRACER.start("pass", f"recovery {cid}", devices=len(state))
+        traces = {d: TRACER.start("recovery", f"device {d} ({cid})", device_id=d) for d in state}
+        traces = {d: t for d, t in traces.items() if t is not None}
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="recovery") as pool, \
+                TRACER.activate(pass_trace):
+            with TRACER.span("restore phase"):
+                restored = dict(zip(state, pool.map(
+                    lambda item: run_traced(f"{cid}/{item[0]}", traces.get(item[0]), "restore",
+                                            self._restore_device, *item),
+                    state.items())))
+            checking = {d: i for d, i in state.items() if restored[d] and holds(d)}
+            for device_id in state.keys() - checking.keys():
+                if restored[device_id]:
+                    self._lapsed(state[device_id].get("hostname"))
+                results["error"] += 1
+                with TRACER.activate(traces.get(device_id)):
+                    self._reschedule(device_id, state[device_id], "error")
+
+            if POLLER is not None:
+                with TRACER.span("poll phase", devices=len(checking)):
+                    POLLER.poll_many(checking, traces)
+            with TRACER.span("snapshot", devices=len(checking)):
+                snapshot = fetch_port_snapshot(checking) if checking else {}
+
+            with TRACER.span("check phase", devices=len(checking)):
+                futures = {pool.submit(run_traced, f"{cid}/{device_id}", traces.get(device_id), "check",
+                                       self._check_device, device_id, info, snapshot): (device_id, info)
+                           for device_id, info in checking.items()}
+                for fut in as_completed(futures):
+                    result = fut.result()
+                    results[result] += 1
+                    device_id = futures[fut][0]
+                    if device_id in traces:
+                        traces[device_id].root.attrs["result"] = result
+                    if result != "recovered":
+                        with TRACER.activate(traces.get(device_id)):
+                            self._reschedule(*futures[fut], result)
+
+        elapsed = time.monotonic() - started
+        rate = len(state) / elapsed if elapsed > 0 else float(len(state))
+        METRICS.observe("recovery_pass_seconds", elapsed)
+        METRICS.observe("recovery_pass_devices", len(state))
+        METRICS.observe("recovery_pass_recovered", results["recovered"])
+        for result, count in results.items():
+            if count:
+                METRICS.inc("recovery_checks_total", count, result=result)
+        for trace in (pass_trace, *traces.values()):
+            TRACER.finish(trace)
+        log(f"⏱️ Recovery pass finished in {elapsed:.1f}s ({rate:.2f} devices/s): "
+            f"{results['recovered']} recovered, {results['down']} still down, {results['error']} errors.")
+
+        saved = SAVINGS.snapshot()
+        log(f"💡 Redundant API calls avoided so far: {saved['patches']} PATCH, {saved['discoveries']} discover.")
+
+        if not STATE.count():
+            log("🎉 All devices recovered; recovery loop will pause until next alert.")
+        elif results["recovered"]:
+            log("💾 State updated; remaining devices will be retried on their own schedule.")
+
+    def _reschedule(self, device_id, info, result):
+        now = time.time()
+        attempts = int(info.get("attempts", 0)) + 1
+        due = next_check_time(device_id, dict(info, attempts=attempts), now)
+        if update_device(device_id, attempts=attempts, last_result=result, status="active",
+                         last_check_at=datetime.fromtimestamp(now).isoformat(),
+                         next_check_at=datetime.fromtimestamp(due).isoformat()):
+            self.schedule(device_id, due)
+            log(f"⏳ Device {device_id}: attempt {attempts} {result}; next check in {due - now:.0f}s.")
+
+RECOVERY = RecoveryManager()
+
+class AsyncRecoveryManager(RecoveryManager):
+    """RecoveryManager for the async engine.
+
+    Every scheduled device is an asyncio task that sleeps until the device
+    is due, then restores, polls and checks it, with at most
+    ASYNC_RECOVERY_CONCURRENCY checks in flight. Checks coming due within
+    ASYNC_BATCH_WINDOW_MS of each other share one bulk port-status snapshot,
+    as the devices of one threaded recovery pass do. Tracking, backoff and
+    flap damping are inherited unchanged.
+    """
+    def __init__(self, concurrency=ASYNC_RECOVERY_CONCURRENCY, batch_window_ms=ASYNC_BATCH_WINDOW_MS):
+        super().__init__()
+        self.concurrency = max(1, concurrency)
+        self.batch_window_sec = batch_window_ms / 1000.0
+        self.loop = None
+        self.slots = None
+        self.tasks = {}        # device_id -> asyncio.Task
+        self.wakeups = {}      # device_id -> asyncio.Event, set when its due time changes
+        self.batch = {}        # device_id -> (info, future) waiting for the next snapshot
+        self.batch_task = None
+        self.checks = 0
+
+    def start(self):
+        """Seed a task per tracked device (idempotent); runs on the event loop."""
+        if self.started:
+            return
+        self.loop = asyncio.get_running_loop()
+        self.slots = asyncio.Semaphore(self.concurrency)
+        self.started = True
+        for device_id, due in STATE.due_entries():
+            if due is None:
+                due = next_check_time(device_id, STATE.get(device_id) or {})
+            self.schedule(device_id, due)
+
+    def schedule(self, device_id, due_ts):
+        if not owns(device_id):
+            return
+        device_id = str(device_id)
+        self.scheduled[device_id] = due_ts
+        if device_id in self.tasks:
+            self.wakeups[device_id].set()
+            return
+        self.wakeups[device_id] = asyncio.Event()
+        self.tasks[device_id] = asyncio.get_running_loop().create_task(
+            self._run_device(device_id), name=f"recovery-{device_id}")
+
+    def unschedule(self, device_id):
+        device_id = str(device_id)
+        self.scheduled.pop(device_id, None)
+        if device_id in self.wakeups:
+            self.wakeups[device_id].set()
+
+    def alive(self):
+        # Every scheduled device must have a live task waiting on it.
+        return all(d in self.tasks for d in list(self.scheduled))
+
+    def sync_shards(self):
+        # Called from the lease thread: read the store there, schedule on the loop.
+        STATE.reload()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._sync_owned)
+
+    async def _run_device(self, device_id):
+        wakeup = self.wakeups[device_id]
+        try:
+            while True:
+                due = self.scheduled.get(device_id)
+                if due is None:
+                    return
+                wait_s = due - time.time()
+                if wait_s > 0:
+                    wakeup.clear()
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), wait_s)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                del self.scheduled[device_id]
+                with shard_hold([device_id]) as held:
+                    if not held:
+                        return
+                    if SHARDS is not None:
+                        STATE.refresh_many([device_id])
+                    info = STATE.get(device_id)
+                    if info is None:
+                        return
+                    self.checks += 1
+                    cid = f"check-{self.checks}/{device_id}"
+                    trace = TRACER.start("recovery", f"device {device_id} (check-{self.checks})", device_id=device_id)
+                    with correlation(cid), TRACER.activate(trace):
+                        try:
+                            with TRACER.span("wait for slot"):
+                                await self.slots.acquire()
+                            try:
+                                result = await self._recover(device_id, info)
+                            finally:
+                                self.slots.release()
+                        except Exception as e:
+                            warning(f"⚠️ Recovery check of device {device_id} failed: {e}")
+                            result = "error"
+                        METRICS.inc("recovery_checks_total", result=result)
+                        if result != "recovered":
+                            self._reschedule(device_id, info, result)
+                if trace is not None:
+                    trace.root.attrs["result"] = result
+                    TRACER.finish(trace)
+        finally:
+            self.tasks.pop(device_id, None)
+            self.wakeups.pop(device_id, None)
+
+    async def _recover(self, device_id, info):
+        """_restore_device, the poll and _check_device for one device."""
+        hostname = info.get("hostname")
+        ports = known_ports(info)
+        log(f"--- Recovery check for {hostname} (ID: {device_id}, ports: {ports or 'unknown'}) ---")
+        if not holds(device_id):
+            return self._lapsed(hostname)
+        try:
+            with TRACER.span("restore"):
+                await arestore_device_ip(device_id, info.get("ip"), discover=self._restore_discovers(info, ports))
+        except requests.HTTPError as e:
+            warning(f"⚠️ HTTP error restoring {hostname}: {e}")
+            return "error"
+        except Exception as e:
+            warning(f"⚠️ Unexpected error restoring {hostname}: {e}")
+            return "error"
+        if not holds(device_id):
+            return self._lapsed(hostname)
+
+        if POLLER is not None:
+            with TRACER.span("local poll"):
+                await POLLER.apoll(device_id)
+
+        try:
+            with TRACER.span("snapshot"):
+                found = await self._snapshot_for(device_id, info)
+            with TRACER.span("check"):
+                if any(n not in found for n in supervision_for(info)[0]):
+                    found = await afetch_device_ports(device_id)
+                if self._apply_port_statuses(device_id, info, found):
+                    return "recovered"
+                if not holds(device_id):
+                    return self._lapsed(hostname)
+                await aforce_device_down(device_id, discover=RECOVERY_CHECK_MODE == "full")
+            return "down"
+        except requests.HTTPError as e:
+            warning(f"⚠️ HTTP error during recovery for {hostname}: {e}")
+        except Exception as e:
+            warning(f"⚠️ Unexpected error during recovery for {hostname}: {e}")
+        return "error"
+
+    async def _snapshot_for(self, device_id, info):
+        """The device's entry in a port-status snapshot shared by every
+        check that joins within the batch window."""
+        future = self.loop.create_future()
+        self.batch[device_id] = (info, future)
+        if self.batch_task is None:
+            self.batch_task = self.loop.create_task(self._take_snapshot())
+        return await future
+
+    async def _take_snapshot(self):
+        CURRENT_SPAN.set(None)   # shared by the batch, not part of the check that started it
+        await asyncio.sleep(self.batch_window_sec)
+        batch, self.batch, self.batch_task = self.batch, {}, None
+        try:
+            snapshot = await afetch_port_snapshot({d: info for d, (info, _) in batch.items()})
+        except Exception as e:
+            warning(f"⚠️ Port status snapshot for {len(batch)} devices failed: {e}")
+            snapshot = {}
+        METRICS.observe("recovery_pass_devices", len(batch))
+        for device_id, (_, future) in batch.items():
+            if not future.done():
+                future.set_result(snapshot.get(device_id, {}))
+
+# =======================
+# Startup Reconciliation
+# =======================
+def reconcile_state():
+    """Bring persisted state in line with LibreNMS before resuming.
+
+    One /devices request gives every device's current overwrite_ip and one
+    /ports/search/ifName request per supervised ifName gives the port
+    statuses. Devices LibreNMS no longer knows are dropped, devices whose
+    real IP is back and whose rule is met recovered while we were down and
+    are released, and devices found restored but unhealthy are checked (and
+    forced down again) right away. Everything else keeps its schedule.
+    Returns the device IDs to check immediately.
+    """
+    state = {d: i for d, i in STATE.load_all().items() if owns(d)}
+    if not state:
+        log("🧭 Startup: no tracked devices to reconcile.")
+        return []
+
+    started = time.monotonic()
+    requests_made = 0
+    try:
+        resp = libre_api("GET", "/devices")
+        requests_made += 1
+        current = {str(d.get("device_id")): d for d in (resp or {}).get("devices", [])}
+    except Exception as e:
+        warning(f"⚠️ Startup: could not fetch devices from LibreNMS ({e}); resuming saved schedules as-is.")
+        return []
+
+    snapshot = fetch_port_snapshot(state, min_devices=1)
+    requests_made += len({n for info in state.values() for n in supervision_for(info)[0]})
+
+    removed, recovered, check_now = [], [], []
+    for device_id, info in state.items():
+        device = current.get(device_id)
+        if device is None:
+            if current:
+                removed.append(device_id)
+                remove_device(device_id)
+            continue
+
+        overwrite_ip = device.get("overwrite_ip") or None
+        if overwrite_ip != info.get("applied_ip"):
+            # Someone (or a crash mid-check) changed it behind our back.
+            update_device(device_id, applied_ip=overwrite_ip)
+        if overwrite_ip == UNSUPERVISED_IP:
+            continue
+
+        ifnames, rule = supervision_for(info)
+        found = snapshot.get(device_id, {})
+        statuses = {n: found[n][1] if n in found else None for n in ifnames}
+        if rule_satisfied(rule, statuses):
+            recovered.append(device_id)
+            remove_device(device_id)
+            FLAPS.record(device_id)
+        else:
+            check_now.append(device_id)
+
+    elapsed = time.monotonic() - started
+    log(f"🧭 Startup reconciliation of {len(state)} devices in {elapsed:.1f}s ({requests_made} API requests): "
+        f"{len(recovered)} recovered while down, {len(removed)} no longer in LibreNMS, "
+        f"{len(check_now)} restored but unhealthy (checking now), "
+        f"{len(state) - len(recovered) - len(removed) - len(check_now)} resuming their schedule.")
+    return check_now
+
+def resume_recovery(reconcile=True):
+    """Start the recovery scheduler from persisted state instead of waiting
+    for the next alert."""
+    check_now = reconcile_state() if reconcile else []
+    RECOVERY.start()
+    now = time.time()
+    for device_id in check_now:
+        RECOVERY.schedule(device_id, now)
+    if STATE.count():
+        log(f"▶️ Resumed recovery schedules for {STATE.count()} tracked devices.")
+
+# =======================
+# Alert Intake
+# =======================
+SUPERVISION_GROUPS = load_supervision_groups()
+
+def alert_supervision(payload):
+    """Per-device supervision carried by an alert: {"ifnames", "rule"} taken
+    from a named "group" and/or explicit "ifnames"/"rule" fields (empty for
+    the defaults), or None when the group or rule is not valid."""
+    supervision = {}
+    group = payload.get("group")
+    if group:
+        if group not in SUPERVISION_GROUPS:
+            return None
+        supervision["ifnames"] = list(SUPERVISION_GROUPS[group]["ifnames"])
+        if SUPERVISION_GROUPS[group].get("rule"):
+            supervision["rule"] = SUPERVISION_GROUPS[group]["rule"].lower()
+    ifnames = payload.get("ifnames")
+    if ifnames:
+        if isinstance(ifnames, str):
+            ifnames = ifnames.split(",")
+        supervision["ifnames"] = [str(n).strip() for n in ifnames if str(n).strip()]
+    if payload.get("rule"):
+        supervision["rule"] = str(payload["rule"]).lower()
+    if "rule" in supervision and not valid_rule(supervision["rule"]):
+        return None
+    return supervision
+
+class AlertRejected(Exception):
+    """An alert the webhook answers with an error instead of tracking."""
+    def __init__(self, reason, code, body, headers=None):
+        super().__init__(reason)
+        self.reason = reason
+        self.code = code
+        self.body = body
+        self.headers = headers
+
+def parse_alert(raw):
+    """Validate one alert webhook body. Returns (device_id, info) ready for
+    RECOVERY.track(), or raises AlertRejected."""
+    debug("Raw alert payload: %s", raw)
+
+    try:
+        payload = json.loads(raw)
+    except json.JSONDecodeError as e:
+        warning(f"⚠️ JSON decode error: {e}")
+        raise AlertRejected("invalid_json", 400, b"Invalid JSON")
+    return alert_from_payload(payload)
+
+def alert_from_payload(payload):
+    if not isinstance(payload, dict):
+        warning("⚠️ Alert is not a JSON object; ignoring.")
+        raise AlertRejected("invalid_json", 400, b"Alert must be a JSON object")
+
+    device = payload.get("device") or {}
+    if not isinstance(device, dict):
+        warning("⚠️ Alert field device is not a JSON object; ignoring.")
+        raise AlertRejected("invalid_fields", 400, b"Field device must be a JSON object")
+
+    device_id = payload.get("device_id") or device.get("device_id")
+    hostname  = payload.get("host")      or device.get("hostname")
+    ip        = payload.get("ip")        or device.get("ip") or device.get("overwrite_ip")
+
+    log(f"🚨 Alert received: device_id={device_id} hostname={hostname} ip={ip}")
+
+    if not all([device_id, hostname, ip]):
+        warning("⚠️ Missing device_id/hostname/ip in alert; ignoring.")
+        raise AlertRejected("missing_fields", 400, b"Missing required fields")
+    if isinstance(device_id, bool) or not isinstance(device_id, (str, int)) \
+            or not isinstance(hostname, str) or not isinstance(ip, str):
+        warning("⚠️ device_id must be a string or integer and hostname/ip strings; ignoring.")
+        raise AlertRejected("invalid_fields", 400, b"device_id must be a string or integer, hostname and ip strings")
+
+    try:
+        supervision = alert_supervision(payload)
+    except (TypeError, AttributeError):
+        supervision = None   # e.g. a list for "group"
+    if supervision is None:
+        warning(f"⚠️ Unknown supervision group or invalid rule in alert for {hostname}; ignoring.")
+        raise AlertRejected("invalid_supervision", 400, b"Unknown group or invalid rule")
+
+    return device_id, {
+        "hostname": hostname,
+        "ip": ip,
+        "port_id": None,
+        "added_at": datetime.now().isoformat(),
+        "attempts": 0,
+        **supervision,
+    }
+
+class AlertStreamParser:
+    """Incremental parser for batch bodies: a JSON array of alerts or NDJSON
+    (one alert per line), fed chunk by chunk as they come off the socket.
+
+    feed() returns the payloads completed so far, with an AlertRejected in
+    place of each one that is not valid JSON. Only the unparsed tail is
+    buffered. An NDJSON line over max_item_bytes is skipped; in an array a
+    malformed or oversized element ends the batch, since there is no safe
+    point to resume from.
+    """
+    def __init__(self, max_item_bytes=BATCH_ITEM_MAX_BYTES):
+        self.max_item_bytes = max_item_bytes
+        self.decoder = json.JSONDecoder()
+        self.text = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.buf = ""
+        self.mode = None          # "array" or "ndjson", from the first non-blank character
+        self.expect_comma = False
+        self.after_comma = False  # a "]" here would close the array on a trailing comma
+        self.skipping = False     # dropping the rest of an oversized NDJSON line
+        self.closed = False       # array finished or failed; ignore the rest
+
+    def feed(self, data, final=False):
+        self.buf += self.text.decode(data, final)
+        if self.mode is None:
+            self.buf = self.buf.lstrip()
+            if not self.buf:
+                return []
+            self.mode = "array" if self.buf[0] == "[" else "ndjson"
+            if self.mode == "array":
+                self.buf = self.buf[1:]
+        return self._array(final) if self.mode == "array" else self._lines(final)
+
+    def _lines(self, final):
+        *lines, self.buf = self.buf.split("\n")
+        if final:
+            lines.append(self.buf)
+            self.buf = ""
+        items = []
+        for line in lines:
+            if self.skipping:
+                self.skipping = False
+                continue
+            if line.strip():
+                items.append(self._decode_line(line))
+        if len(self.buf) > self.max_item_bytes and not self.skipping:
+            items.append(AlertRejected("item_too_large", 413, b"Alert larger than BATCH_ITEM_MAX_BYTES"))
+            self.buf, self.skipping = "", True
+        elif self.skipping:
+            self.buf = ""
+        return items
+
+    @staticmethod
+    def _decode_line(line):
+        try:
+            return json.loads(line)
+        except json.JSONDecodeError as e:
+            return AlertRejected("invalid_json", 400, f"Invalid JSON: {e}".encode())
+
+    def _array(self, final):
+        items, pos, buf = [], 0, self.buf
+        while not self.closed:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos == len(buf):
+                break
+            if buf[pos] == "]":
+                if self.after_comma:
+                    items.append(AlertRejected("invalid_json", 400, b"Invalid JSON: trailing comma before ']'"))
+                self.closed = True
+            elif self.expect_comma:
+                if buf[pos] != ",":
+                    items.append(AlertRejected("invalid_json", 400, b"Invalid JSON: expecting ',' between alerts"))
+                    self.closed = True
+                pos += 1
+                self.expect_comma = False
+                self.after_comma = True
+            else:
+                try:
+                    item, end = self.decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError as e:
+                    if not final and len(buf) - pos <= self.max_item_bytes:
+                        break   # wait for the rest of the element
+                    items.append(AlertRejected("invalid_json", 400, f"Invalid JSON: {e}".encode()))
+                    self.closed = True
+                    break
+                if end == len(buf) and not final and not isinstance(item, (dict, list)):
+                    break       # a number may continue in the next chunk
+                items.append(item)
+                pos = end
+                self.expect_comma = True
+                self.after_comma = False
+        self.buf = "" if self.closed else buf[pos:]
+        if final and not self.closed:
+            items.append(AlertRejected("invalid_json", 400, b"Invalid JSON: unterminated array"))
+            self.closed = True
+        return items
+
+def batch_entry(index, item, cid):
+    """Validate one parsed batch item: (device_id, info) or AlertRejected."""
+    METRICS.inc("alerts_received_total")
+    with correlation(f"{cid}/{index}"):
+        if index >= BATCH_MAX_ITEMS:
+            return AlertRejected("batch_too_large", 413, f"Batch limited to {BATCH_MAX_ITEMS} alerts".encode())
+        if isinstance(item, AlertRejected):
+            warning(f"⚠️ Batch item {index}: {item.body.decode()}")
+            return item
+        try:
+            return alert_from_payload(item)
+        except AlertRejected as e:
+            return e
+        except Exception as e:
+            # One odd item must not cost the client the whole batch's results.
+            warning(f"⚠️ Batch item {index} could not be validated: {e!r}")
+            return AlertRejected("invalid_fields", 400, f"Invalid alert: {e}".encode())
+
+def record_alert_batch(entries, cid, room=None):
+    """Track the valid entries of a batch in one state transaction.
+
+    At most `room` new devices (None: no limit) are taken; alerts for
+    further new devices get a 503 result. Returns (per-item results,
+    [(device_id, correlation_id)] of the devices that need forcing down).
+    """
+    results, new, queued = [], [], set()
+    if SHARDS is not None:
+        STATE.refresh_many([e[0] for e in entries if not isinstance(e, AlertRejected)])
+    with STATE.transaction():
+        for index, entry in enumerate(entries):
+            if isinstance(entry, AlertRejected):
+                METRICS.inc("alerts_rejected_total", reason=entry.reason)
+                results.append({"index": index, "status": "rejected", "code": entry.code,
+                                "reason": entry.reason, "error": entry.body.decode()})
+                continue
+            device_id, info = entry
+            item_cid = f"{cid}/{index}"
+            with correlation(item_cid):
+                retry = str(device_id) not in queued and needs_force_down(device_id)
+                if room is not None and len(new) >= room and (STATE.get(device_id) is None or retry):
+                    METRICS.inc("alerts_rejected_total", reason="queue_full")
+                    results.append({"index": index, "device_id": str(device_id), "status": "rejected",
+                                    "code": 503, "reason": "queue_full", "error": "Busy"})
+                elif RECOVERY.track(device_id, info) or retry:
+                    # A tracked device whose force-down failed or was never queued is retried.
+                    new.append((str(device_id), item_cid))
+                    queued.add(str(device_id))
+                    results.append({"index": index, "device_id": str(device_id), "status": "accepted"})
+                else:
+                    METRICS.inc("alerts_duplicate_total")
+                    results.append({"index": index, "device_id": str(device_id), "status": "duplicate"})
+
+    counts = {status: sum(1 for r in results if r["status"] == status)
+              for status in ("accepted", "duplicate", "rejected")}
+    METRICS.observe("alert_batch_items", len(results))
+    log(f"📥 Batch of {len(results)} alerts: {counts['accepted']} new, {counts['duplicate']} already tracked, "
+        f"{counts['rejected']} rejected.")
+    return results, new
+
+def batch_response(results):
+    counts = {status: sum(1 for r in results if r["status"] == status)
+              for status in ("accepted", "duplicate", "rejected")}
+    return json.dumps({**counts, "results": results}).encode()
+
+class PendingForceDowns:
+    """Devices whose force-down is queued or running, so a repeated alert
+    neither duplicates it nor is dropped while none is on its way."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.devices = set()
+
+    def add(self, device_ids):
+        with self.lock:
+            self.devices.update(str(e[0] if isinstance(e, tuple) else e) for e in device_ids)
+
+    def discard(self, device_ids):
+        with self.lock:
+            self.devices.difference_update(str(e[0] if isinstance(e, tuple) else e) for e in device_ids)
+
+    def __contains__(self, device_id):
+        with self.lock:
+            return str(device_id) in self.devices
+
+FORCE_DOWNS = PendingForceDowns()
+
+def needs_force_down(device_id):
+    """Whether a repeated alert for a tracked device must queue its
+    force-down again: LibreNMS is not known to poll it at UNSUPERVISED_IP
+    (the first force-down failed, or was never queued because the intake
+    was full) and no force-down for it is pending."""
+    info = STATE.get(device_id)
+    return (info is not None and info.get("applied_ip") != UNSUPERVISED_IP
+            and device_id not in FORCE_DOWNS)
+
+def process_alerts(device_ids):
+    """Resolve ports and force devices down for alerts that have already
+    been recorded in state: resolve_alerts(), then force_down_resolved()
+    for each device in turn."""
+    FORCE_DOWNS.add(device_ids)
+    for job in resolve_alerts(device_ids):
+        force_down_resolved(*job)
+
+def resolve_alerts(device_ids):
+    """Resolve and record the supervised ports of a batch of alerted
+    devices. The first port lookup fills the shared port index, so the rest
+    of the batch resolves from memory, and every port is recorded in one
+    state transaction.
+
+    Entries may be plain device IDs or (device_id, correlation_id) pairs
+    carried over from the webhook that raised them. Returns one
+    (device_id, correlation_id, trace) job per device for
+    force_down_resolved(), each holding its own reference to the trace."""
+    entries = [e if isinstance(e, tuple) else (e, CORRELATION_ID.get()) for e in device_ids]
+    traces = {cid: TRACER.claim(cid) for _, cid in entries}
+    resolved = []
+    try:
+        for device_id, cid in entries:
+            with correlation(cid), TRACER.activate(traces[cid]), TRACER.span("resolve ports"):
+                ifnames, _ = supervision_for(STATE.get(device_id) or {})
+                ports = {}
+                for ifname in ifnames:
+                    port_id = find_port_id_for_ifname(device_id, ifname)
+                    if port_id:
+                        ports[ifname] = port_id
+                resolved.append((device_id, cid, ifnames, ports))
+        _record_ports(resolved, traces)
+    except Exception:
+        FORCE_DOWNS.discard(entries)   # none of them will be forced down now
+        raise
+
+    counts = Counter(cid for _, cid in entries)
+    for cid, trace in traces.items():
+        TRACER.retain(trace, counts[cid] - 1)
+    return [(device_id, cid, traces[cid]) for device_id, cid, _, _ in resolved]
+
+def force_down_resolved(device_id, cid, trace):
+    with correlation(cid), TRACER.activate(trace), TRACER.span("force down"):
+        try:
+            force_device_down(device_id)
+        except Exception as e:
+            warning(f"⚠️ Failed to force device {device_id} down initially: {e}")
+    FORCE_DOWNS.discard([device_id])
+    TRACER.finish(trace)
+
+def _record_ports(resolved, traces):
+    with STATE.transaction():
+        for device_id, cid, ifnames, ports in resolved:
+            with correlation(cid), TRACER.activate(traces[cid]):
+                log(f"Detected supervised ports for device {device_id}: {ports or 'none'}")
+                if ports:
+                    update_device(device_id, ports=ports, port_id=ports.get(ifnames[0]))
+
+def process_alert(device_id):
+    process_alerts([device_id])
+
+async def aprocess_alerts(entries):
+    """process_alerts() for the async engine, with the devices' port lookups
+    and force-downs running concurrently. Concurrent lookups share the port
+    index's single-flighted bulk search, so a burst costs one search
+    without a coalescing window."""
+    async def resolve(device_id, cid):
+        with correlation(cid), TRACER.activate(traces[cid]), TRACER.span("resolve ports"):
+            ifnames, _ = supervision_for(STATE.get(device_id) or {})
+            ports = {}
+            for ifname in ifnames:
+                try:
+                    port_id = await PORT_INDEX.alookup(device_id, ifname)
+                except Exception as e:
+                    warning(f"⚠️ Failed to lookup port_id via search API for {device_id}: {e}")
+                    port_id = None
+                if port_id:
+                    ports[ifname] = port_id
+            return device_id, cid, ifnames, ports
+
+    async def force_down(device_id, cid):
+        with correlation(cid), TRACER.activate(traces[cid]), TRACER.span("force down"):
+            try:
+                await aforce_device_down(device_id)
+            except Exception as e:
+                warning(f"⚠️ Failed to force device {device_id} down initially: {e}")
+
+    CURRENT_SPAN.set(None)   # a task of its own, not part of the request that created it
+    entries = [e if isinstance(e, tuple) else (e, CORRELATION_ID.get()) for e in entries]
+    traces = {cid: TRACER.claim(cid) for _, cid in entries}
+    FORCE_DOWNS.add(entries)
+    try:
+        _record_ports(await asyncio.gather(*(resolve(*e) for e in entries)), traces)
+        await asyncio.gather(*(force_down(*e) for e in entries))
+    finally:
+        FORCE_DOWNS.discard(entries)
+        for trace in traces.values():
+            TRACER.finish(trace)
+
+class ForceDownQueue:
+    """Bounded queue of force-down batches drained by a fixed pool of
+    worker threads.
+
+    The HTTP handler only records the alert and hands the device on; the
+    LibreNMS round trips happen here so the webhook can be acknowledged
+    immediately. A worker takes a batch, resolves its ports with one shared
+    lookup (resolve_alerts) and puts a force-down job per device back on
+    the queue, so the PATCH and discover calls of one batch spread over all
+    workers. Capacity is counted in devices, each released once its
+    force-down ran: when it is exhausted, submit() returns False and the
+    handler answers 503 so LibreNMS backs off and retries.
+    """
+    def __init__(self, workers, max_depth):
+        self.workers = max(1, workers)
+        self.max_depth = max(1, max_depth)
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.threads = []
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker, name=f"force-down-{i}", daemon=True)
+                t.start()
+                self.threads.append(t)
+        log(f"👷 Started {self.workers} force-down workers (queue limit {self.max_depth}).")
+
+    def has_room(self, n=1):
+        with self.lock:
+            return self.pending + n <= self.max_depth
+
+    def submit(self, device_ids):
+        with self.lock:
+            if self.pending + len(device_ids) > self.max_depth:
+                return False
+            self.pending += len(device_ids)
+        FORCE_DOWNS.add(device_ids)
+        self.queue.put([(str(e[0]), e[1]) if isinstance(e, tuple) else str(e) for e in device_ids])
+        return True
+
+    def depth(self):
+        with self.lock:
+            return self.pending
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            done = 1
+            try:
+                if isinstance(job, list):
+                    done = len(job)
+                    fanned = resolve_alerts(job)
+                    for device_job in fanned:
+                        self.queue.put(device_job)
+                    done -= len(fanned)
+                else:
+                    force_down_resolved(*job)
+            except Exception as e:
+                warning(f"⚠️ Unexpected error processing alerts for {done} devices: {e}")
+            finally:
+                with self.lock:
+                    self.pending -= done
+                self.queue.task_done()
+
+FORCE_DOWN_QUEUE = ForceDownQueue(INTAKE_WORKERS, INTAKE_QUEUE_MAX)
+
+class AlertCoalescer:
+    """Merges alerts for new devices that arrive within COALESCE_WINDOW_MS
+    into batched force-down dispatches, and counts alerts that needed no
+    API work at all because the device was already tracked."""
+    def __init__(self, window_ms=COALESCE_WINDOW_MS, max_batch=COALESCE_MAX_BATCH):
+        self.window_sec = window_ms / 1000.0
+        self.max_batch = max(1, max_batch)
+        self.lock = threading.Lock()
+        self.cv = threading.Condition(self.lock)
+        self.pending = []
+        self.suppressed = 0
+        self.thread = None
+
+    def note_suppressed(self):
+        with self.lock:
+            self.suppressed += 1
+            return self.suppressed
+
+    def add(self, device_id):
+        """Queue a device for force-down. Returns False when the intake is
+        out of capacity."""
+        device_id = str(device_id)
+        with self.lock:
+            if not FORCE_DOWN_QUEUE.has_room(len(self.pending) + 1):
+                return False
+            self.pending.append((device_id, CORRELATION_ID.get()))
+            FORCE_DOWNS.add([device_id])
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._flush_loop, name="coalescer", daemon=True)
+                self.thread.start()
+            self.cv.notify()
+        return True
+
+    def _flush_loop(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.cv.wait()
+            # Give the rest of the burst a chance to join this dispatch.
+            time.sleep(self.window_sec)
+            with self.lock:
+                batch, self.pending = self.pending, []
+                suppressed = self.suppressed
+            log(f"📦 Dispatching force-down for {len(batch)} devices ({suppressed} alerts suppressed so far).")
+            for i in range(0, len(batch), self.max_batch):
+                chunk = batch[i:i + self.max_batch]
+                if not FORCE_DOWN_QUEUE.submit(chunk):
+                    # Already recorded in state; their next alert queues the force-down again.
+                    FORCE_DOWNS.discard(chunk)
+                    warning(f"⛔ Intake queue full; force-down for {len(chunk)} devices deferred.")
+
+COALESCER = AlertCoalescer()
+
+# =======================
+# HTTP Handler
+# =======================
+def health_report(intake_depth, **checks):
+    """(healthy, body) for GET /healthz: the engine's own `checks` plus the
+    logger and shard lease checks both engines share."""
+    checks = {
+        "logger": LOGGER.thread.is_alive(),
+        **checks,
+        "shard_leases": SHARDS is None or (SHARDS.thread is not None and SHARDS.thread.is_alive()
+                                          and time.monotonic() < SHARDS.valid_until),
+    }
+    healthy = all(checks.values())
+    return healthy, {"status": "ok" if healthy else "unhealthy", "checks": checks,
+                     "devices_tracked": STATE.count(), "intake_queue_depth": intake_depth}
+
+class AlertHandler(BaseHTTPRequestHandler):
+    def log_message(self, fmt, *args):
+        debug("HTTP %s - " + fmt, self.address_string(), *args)
+
+    def _reply(self, code, body, headers=None):
+        self.send_response(code)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _reject(self, reason, code, body, headers=None):
+        METRICS.inc("alerts_rejected_total", reason=reason)
+        self._reply(code, body, headers)
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/metrics":
+            self._reply(200, METRICS.render().encode(),
+                        {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+        elif path == "/healthz":
+            healthy, body = health_report(
+                FORCE_DOWN_QUEUE.depth(),
+                recovery_loop=RECOVERY.alive(),
+                intake_workers=INTAKE_MODE != "queue" or all(t.is_alive() for t in FORCE_DOWN_QUEUE.threads))
+            self._reply(200 if healthy else 503, json.dumps(body).encode(),
+                        {"Content-Type": "application/json"})
+        else:
+            self._reply(404, b"Not found")
+
+    def do_POST(self):
+        cid = self.headers.get("X-Request-ID") or uuid.uuid4().hex[:12]
+        if self.path.split("?", 1)[0] == "/alerts/batch":
+            trace = TRACER.start("alert", f"alert batch {cid}")
+            with correlation(cid), TRACER.activate(trace), TRACER.span("handle batch"), \
+                    METRICS.timer("alert_handling_seconds", intake="batch"):
+                self._handle_batch()
+            TRACER.finish(trace)
+            return
+        METRICS.inc("alerts_received_total")
+        trace = TRACER.start("alert", f"alert {cid}")
+        with correlation(cid), TRACER.activate(trace), TRACER.span("handle alert") as span, \
+                METRICS.timer("alert_handling_seconds", intake=INTAKE_MODE):
+            self._handle_alert(span)
+        TRACER.finish(trace)
+
+    def _body_chunks(self, size=65536):
+        """The request body in pieces of at most `size` bytes, de-chunking
+        Transfer-Encoding: chunked uploads."""
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                remaining = int(self.rfile.readline().split(b";", 1)[0], 16)
+                if remaining == 0:
+                    while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    return
+                while remaining > 0:
+                    data = self.rfile.read(min(size, remaining))
+                    if not data:
+                        return
+                    remaining -= len(data)
+                    yield data
+                self.rfile.readline()
+        remaining = int(self.headers.get("Content-Length", 0))
+        while remaining > 0:
+            data = self.rfile.read(min(size, remaining))
+            if not data:
+                return
+            remaining -= len(data)
+            yield data
+
+    def _handle_batch(self):
+        cid = CORRELATION_ID.get()
+        parser = AlertStreamParser()
+        entries = []
+        try:
+            for chunk in self._body_chunks():
+                entries += [batch_entry(len(entries) + i, item, cid) for i, item in enumerate(parser.feed(chunk))]
+        except ValueError:
+            self._reject("invalid_json", 400, b"Malformed chunked body")
+            return
+        entries += [batch_entry(len(entries) + i, item, cid) for i, item in enumerate(parser.feed(b"", final=True))]
+
+        room = None
+        if INTAKE_MODE == "queue":
+            room = max(0, FORCE_DOWN_QUEUE.max_depth - FORCE_DOWN_QUEUE.depth())
+        results, new = record_alert_batch(entries, cid, room)
+        if new and INTAKE_MODE == "queue":
+            for i in range(0, len(new), COALESCE_MAX_BATCH):
+                if not FORCE_DOWN_QUEUE.submit(new[i:i + COALESCE_MAX_BATCH]):
+                    # Already recorded; their next alert queues the force-down again.
+                    warning(f"⛔ Intake queue full; force-down for {len(new) - i} devices deferred.")
+                    break
+        elif new:
+            process_alerts(new)
+        self._reply(202 if INTAKE_MODE == "queue" else 200, batch_response(results),
+                    {"Content-Type": "application/json"})
+
+    def _handle_alert(self, span):
+        content_length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(content_length)
+        span["bytes"] = len(raw)
+        try:
+            device_id, info = parse_alert(raw)
+        except AlertRejected as e:
+            self._reject(e.reason, e.code, e.body, e.headers)
+            return
+
+        hostname = info["hostname"]
+        span["device_id"] = device_id
+        tracked = STATE.get(device_id) is not None
+        if INTAKE_MODE == "queue" and not tracked and not FORCE_DOWN_QUEUE.has_room():
+            warning(f"⛔ Intake queue full ({FORCE_DOWN_QUEUE.depth()}); rejecting alert for {hostname}.")
+            self._reject("queue_full", 503, b"Busy", {"Retry-After": str(INTAKE_RETRY_AFTER_SEC)})
+            return
+
+        is_new = RECOVERY.track(device_id, info)
+        if not is_new:
+            if not needs_force_down(device_id):
+                suppressed = COALESCER.note_suppressed()
+                METRICS.inc("alerts_duplicate_total")
+                log(f"🔕 {hostname} is already tracked; metadata only, no API calls ({suppressed} alerts suppressed so far).")
+                self._reply(202 if INTAKE_MODE == "queue" else 200, b"Already tracked")
+                return
+            log(f"🔁 {hostname} is tracked but was never forced down; retrying the force-down.")
+
+        if INTAKE_MODE == "queue":
+            TRACER.park(CORRELATION_ID.get())
+            if not COALESCER.add(device_id):
+                TRACER.finish(TRACER.claim(CORRELATION_ID.get()))
+                # Already recorded; its next alert queues the force-down again.
+                warning(f"⛔ Intake queue full; force-down for {hostname} deferred.")
+                self._reject("queue_full", 503, b"Busy", {"Retry-After": str(INTAKE_RETRY_AFTER_SEC)})
+                return
+            self._reply(202, b"Accepted")
+            return
+
+        process_alert(device_id)
+        self._reply(200, b"OK")
+
+class AlertHTTPServer(ThreadingHTTPServer):
+    """Webhook server of the threaded engine, listening with HTTP_BACKLOG."""
+    request_queue_size = HTTP_BACKLOG
+
+class AsyncAlertServer:
+    """Webhook server of the async engine: HTTP/1.1 keep-alive on asyncio
+    streams, with the same routes and answers as AlertHandler.
+
+    Each new device is forced down by its own task; with INTAKE_QUEUE_MAX
+    of them pending, alerts for further new devices get 503 like the queue
+    intake does.
+    """
+    IDLE_TIMEOUT_SEC = 75
+    MAX_LINE_BYTES = 65536   # request and header lines, as http.server
+    MAX_HEADERS = 100
+    MAX_BATCH_BYTES = BATCH_MAX_ITEMS * BATCH_ITEM_MAX_BYTES
+
+    def __init__(self, max_pending=INTAKE_QUEUE_MAX):
+        self.max_pending = max(1, max_pending)
+        self.pending = 0      # devices waiting for their force-down
+        self.intake = set()   # force-down tasks in flight
+
+    async def serve(self, host, port, backlog):
+        return await asyncio.start_server(self._connection, host, port, backlog=backlog,
+                                          limit=self.MAX_LINE_BYTES)
+
+    async def _connection(self, reader, writer):
+        peer = (writer.get_extra_info("peername") or ("-",))[0]
+        try:
+            while True:
+                method = target = version = "-"
+                try:
+                    head = await self._read_head(reader)
+                    if head is None:
+                        break
+                    method, target, version, headers = head
+                    keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                    if method == "POST" and target.split("?", 1)[0] == "/alerts/batch":
+                        cid = headers.get("x-request-id") or uuid.uuid4().hex[:12]
+                        trace = TRACER.start("alert", f"alert batch {cid}")
+                        try:
+                            with correlation(cid), TRACER.activate(trace), TRACER.span("handle batch"), \
+                                    METRICS.timer("alert_handling_seconds", intake="batch"):
+                                code, payload, extra = await self._handle_batch(reader, headers)
+                        finally:
+                            TRACER.finish(trace)
+                    else:
+                        length = self._content_length(headers, BATCH_ITEM_MAX_BYTES)
+                        body = await reader.readexactly(length) if length else b""
+                        code, payload, extra = self._dispatch(method, target, headers, body)
+                except AlertRejected as e:
+                    # The rest of the request is unread: answer, then close.
+                    METRICS.inc("alerts_rejected_total", reason=e.reason)
+                    code, payload, extra, keep_alive = e.code, e.body, e.headers, False
+                debug("HTTP %s - \"%s %s %s\" %s -", peer, method, target, version, code)
+                head = [f"HTTP/1.1 {code} {HTTPStatus(code).phrase}",
+                        f"Content-Length: {len(payload)}",
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+                head += [f"{k}: {v}" for k, v in (extra or {}).items()]
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            debug("HTTP %s - connection dropped: %s", peer, e)
+        except Exception as e:
+            warning(f"⚠️ HTTP {peer} - request failed, closing connection: {type(e).__name__}: {e}")
+        finally:
+            writer.close()
+
+    async def _read_head(self, reader):
+        """(method, target, version, headers) of the next request, or None
+        once the client closed or idled out. Raises AlertRejected for a head
+        http.server would refuse as well."""
+        try:
+            line = await asyncio.wait_for(reader.readline(), self.IDLE_TIMEOUT_SEC)
+        except asyncio.TimeoutError:
+            return None
+        except ValueError:   # longer than the reader's MAX_LINE_BYTES limit
+            raise AlertRejected("bad_request", 414, b"Request line too long")
+        if not line.strip():
+            return None
+        words = line.decode("latin-1").split()
+        if len(words) != 3 or not words[2].startswith("HTTP/"):
+            raise AlertRejected("bad_request", 400, b"Malformed request line")
+        headers, count = {}, 0
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                raise AlertRejected("bad_request", 431, b"Header line too long")
+            if line in (b"\r\n", b"\n", b""):
+                break
+            count += 1
+            if count > self.MAX_HEADERS:
+                raise AlertRejected("bad_request", 431, b"Too many headers")
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return (*words, headers)
+
+    @staticmethod
+    def _content_length(headers, limit):
+        """The declared body size, rejected when malformed or over `limit`."""
+        value = headers.get("content-length") or "0"
+        if not value.isdigit():
+            raise AlertRejected("bad_request", 400, b"Invalid Content-Length")
+        if int(value) > limit:
+            raise AlertRejected("body_too_large", 413, f"Body limited to {limit} bytes".encode())
+        return int(value)
+
+    def _dispatch(self, method, target, headers, body):
+        """(status, body, headers) for one request."""
+        path = target.split("?", 1)[0]
+        if method == "GET":
+            if path == "/metrics":
+                return 200, METRICS.render().encode(), {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+            if path == "/healthz":
+                healthy, report = health_report(self.pending, recovery_tasks=RECOVERY.alive())
+                return 200 if healthy else 503, json.dumps(report).encode(), {"Content-Type": "application/json"}
+            return 404, b"Not found", None
+        if method == "POST":
+            METRICS.inc("alerts_received_total")
+            cid = headers.get("x-request-id") or uuid.uuid4().hex[:12]
+            trace = TRACER.start("alert", f"alert {cid}")
+            try:
+                with correlation(cid), TRACER.activate(trace), TRACER.span("handle alert", bytes=len(body)) as span, \
+                        METRICS.timer("alert_handling_seconds", intake="async"):
+                    return self._handle_alert(body, span)
+            finally:
+                TRACER.finish(trace)
+        return 501, b"Unsupported method", None
+
+    def _handle_alert(self, raw, span):
+        try:
+            device_id, info = parse_alert(raw)
+        except AlertRejected as e:
+            METRICS.inc("alerts_rejected_total", reason=e.reason)
+            return e.code, e.body, e.headers
+
+        hostname = info["hostname"]
+        span["device_id"] = device_id
+        if STATE.get(device_id) is None and self.pending >= self.max_pending:
+            warning(f"⛔ {self.pending} force-downs pending; rejecting alert for {hostname}.")
+            METRICS.inc("alerts_rejected_total", reason="queue_full")
+            return 503, b"Busy", {"Retry-After": str(INTAKE_RETRY_AFTER_SEC)}
+
+        if not RECOVERY.track(device_id, info):
+            if not needs_force_down(device_id):
+                suppressed = COALESCER.note_suppressed()
+                METRICS.inc("alerts_duplicate_total")
+                log(f"🔕 {hostname} is already tracked; metadata only, no API calls ({suppressed} alerts suppressed so far).")
+                return 202, b"Already tracked", None
+            log(f"🔁 {hostname} is tracked but was never forced down; retrying the force-down.")
+
+        TRACER.park(CORRELATION_ID.get())
+        self._force_down([(str(device_id), CORRELATION_ID.get())])
+        return 202, b"Accepted", None
+
+    async def _handle_batch(self, reader, headers):
+        cid = CORRELATION_ID.get()
+        parser = AlertStreamParser()
+        entries = []
+        try:
+            async for chunk in self._body_chunks(reader, headers):
+                entries += [batch_entry(len(entries) + i, item, cid) for i, item in enumerate(parser.feed(chunk))]
+        except ValueError:
+            raise AlertRejected("invalid_json", 400, b"Malformed chunked body")
+        entries += [batch_entry(len(entries) + i, item, cid) for i, item in enumerate(parser.feed(b"", final=True))]
+
+        results, new = record_alert_batch(entries, cid, max(0, self.max_pending - self.pending))
+        if new:
+            self._force_down(new)
+        return 202, batch_response(results), {"Content-Type": "application/json"}
+
+    async def _body_chunks(self, reader, headers, size=65536):
+        """The request body in pieces of at most `size` bytes; raises
+        AlertRejected past MAX_BATCH_BYTES."""
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            total = 0
+            while True:
+                remaining = int((await reader.readline()).split(b";", 1)[0], 16)
+                if remaining < 0:
+                    raise ValueError(f"negative chunk size {remaining}")
+                total += remaining
+                if total > self.MAX_BATCH_BYTES:
+                    raise AlertRejected("body_too_large", 413,
+                                        f"Body limited to {self.MAX_BATCH_BYTES} bytes".encode())
+                if remaining == 0:
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    return
+                while remaining > 0:
+                    data = await reader.read(min(size, remaining))
+                    if not data:
+                        raise asyncio.IncompleteReadError(b"", remaining)
+                    remaining -= len(data)
+                    yield data
+                await reader.readline()
+        remaining = self._content_length(headers, self.MAX_BATCH_BYTES)
+        while remaining > 0:
+            data = await reader.read(min(size, remaining))
+            if not data:
+                raise asyncio.IncompleteReadError(b"", remaining)
+            remaining -= len(data)
+            yield data
+
+    def _force_down(self, entries):
+        """One task forces these (device_id, cid) entries down."""
+        self.pending += len(entries)
+        task = asyncio.get_running_loop().create_task(aprocess_alerts(entries))
+        self.intake.add(task)
+
+        def done(task):
+            self.pending -= len(entries)
+            self.intake.discard(task)
+        task.add_done_callback(done)
+
+ASYNC_SERVER = AsyncAlertServer()
+
+async def serve_async():
+    """Main of the async engine: webhook, force-downs and recovery checks
+    all run on this one event loop."""
+    server = await ASYNC_SERVER.serve("0.0.0.0", HTTP_PORT, HTTP_BACKLOG)
+    # Bound already, so alerts arriving during reconciliation wait in the backlog.
+    resume_recovery(reconcile=STARTUP_RECONCILE)
+    log(f"HTTP server listening on 0.0.0.0:{HTTP_PORT} for LibreNMS alerts (async engine, {POLL_BACKEND} polling)...")
+    async with server:
+        await server.serve_forever()
+
+# =======================
+# Main
+# =======================
+def parse_args():
+    parser = argparse.ArgumentParser(description="LibreNMS device/port supervision alert handler")
+    parser.add_argument("--export-state", metavar="PATH",
+                        help="write the current state as device_state.json-format JSON and exit")
+    parser.add_argument("--import-state", metavar="PATH",
+                        help="replace the current state with a device_state.json-format file and exit")
+    parser.add_argument("--engine", choices=("threads", "async"), default="threads",
+                        help="threads: http.server plus worker threads (default); "
+                             "async: one asyncio event loop for intake and recovery")
+    parser.add_argument("--trace-summary", action="store_true",
+                        help="print the slowest stages and devices recorded in TRACE_DIR and exit")
+    parser.add_argument("--since", default="1h", type=parse_duration,
+                        help="time window for --trace-summary, e.g. 30m, 2h, 1d (default 1h)")
+    parser.add_argument("--top", type=int, default=10, help="rows per table in --trace-summary")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.trace_summary:   # read-only: leaves the state store alone
+        print_trace_summary(TRACE_DIR, args.since, args.top)
+        raise SystemExit(0)
+    # Export and import use the store directly: no startup compaction.
+    if args.export_state:
+        state = open_state_store().load_all()
+        write_state_file(args.export_state, state)
+        log(f"📤 Exported {len(state)} devices from the {STATE_BACKEND} store to {args.export_state}.")
+        raise SystemExit(0)
+    if args.import_state:
+        state = read_state_file(args.import_state)
+        open_state_store().replace_all(state)
+        log(f"📥 Imported {len(state)} devices from {args.import_state} into the {STATE_BACKEND} store.")
+        raise SystemExit(0)
+    if RECOVERY_CHECK_MODE == "light" and POLL_BACKEND != "local":
+        # Nothing repolls a restored device before its check, so the check would
+        # read the status LibreNMS recorded while the device was unsupervised.
+        warning("⛔ RECOVERY_CHECK_MODE=light needs POLL_BACKEND=local (a fresh poll before each check).")
+        LOGGER.flush()
+        raise SystemExit(2)
+    open_state()
+
+    if args.engine == "async":
+        RECOVERY = AsyncRecoveryManager()
+        METRICS.gauge("intake_queue_depth", "Devices waiting for a force-down task.",
+                      lambda: ASYNC_SERVER.pending)
+        METRICS.gauge("recovery_tasks", "Device recovery tasks (async engine).", lambda: len(RECOVERY.tasks))
+    elif INTAKE_MODE == "queue":
+        FORCE_DOWN_QUEUE.start()
+    PORT_INDEX.start_refresher()
+    if args.engine == "threads":
+        server = AlertHTTPServer(("0.0.0.0", HTTP_PORT), AlertHandler)
+    if POLL_BACKEND not in ("none", "local"):
+        warning(f"⚠️ Unknown POLL_BACKEND {POLL_BACKEND!r}; polling disabled.")
+    # SIGTERM (systemd stop) exits through atexit: log/state flush, lease release.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    if SHARDS is not None:
+        if STATE_BACKEND != "sqlite":
+            warning("⛔ SHARD_MODE needs STATE_BACKEND=sqlite (state shared through STATE_DB).")
+            LOGGER.flush()
+            raise SystemExit(2)
+        SHARDS.renew()
+        atexit.register(SHARDS.release)
+        SHARDS.start(RECOVERY.sync_shards)
+        log(f"🧩 Sharded mode as {INSTANCE_ID}: {len(SHARDS.owned)}/{SHARD_COUNT} shards, "
+            f"{len(SHARDS.members)} live instances.")
+    if args.engine == "async":
+        asyncio.run(serve_async())
+        raise SystemExit(0)
+    # The socket is already bound, so alerts arriving meanwhile wait in the backlog.
+    resume_recovery(reconcile=STARTUP_RECONCILE)
+    log(f"HTTP server listening on 0.0.0.0:{HTTP_PORT} for LibreNMS alerts ({INTAKE_MODE} intake, {POLL_BACKEND} polling)...")
     server.serve_forever()
@@ -0,0 +1,474 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import selectors
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+from urllib.parse import parse_qsl, urlsplit
+
+from fake_librenms import FakeLibreNMS
+from librenms_common import parse_duration
+
+# =======================
+# Replay simulator: prod.py on a simulated clock
+# =======================
+# Replays the alerts found in handler logs against prod.py's own intake and
+# recovery code (the async engine's AsyncAlertServer and
+# AsyncRecoveryManager) and a model of the fleet, on an event loop whose
+# clock jumps straight to the next timer instead of waiting. Hours of
+# recovery run in seconds. API latencies are drawn from the
+# "API <method> <endpoint> -> ... (N ms" lines of the same logs.
+#
+# Reports projected API calls/min (and discoveries/min), intake and check
+# queue depths and time-to-recovery for the given interval, concurrency and
+# backoff settings:
+#
+#   python3 simulate.py handler.log --scale 10
+#   python3 simulate.py handler.log --scale 10 --interval 600 --workers 200 --backoff-factor 1.5
+#   python3 simulate.py Output-example.txt --scale 5000 --spread 300
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay logged alerts against prod.py on a simulated clock.")
+    parser.add_argument("logs", nargs="+", metavar="LOG",
+                        help="handler logs (text or LOG_FORMAT=json, or the old dialer1.py output)")
+    parser.add_argument("--scale", type=int, default=1,
+                        help="replay every alert for this many devices, to project a larger fleet")
+    parser.add_argument("--spread", type=parse_duration, default=0.0,
+                        help="spread the scaled copies of an alert over this long (default: all at once)")
+    parser.add_argument("--interval", type=int, help="RECOVERY_INTERVAL_SEC")
+    parser.add_argument("--workers", type=int, help="ASYNC_RECOVERY_CONCURRENCY: device checks in flight")
+    parser.add_argument("--connections", type=int, help="ASYNC_API_CONNECTIONS: API requests in flight")
+    parser.add_argument("--backoff-factor", type=float, help="RECOVERY_BACKOFF_FACTOR")
+    parser.add_argument("--backoff-max", type=int, help="RECOVERY_BACKOFF_MAX_SEC")
+    parser.add_argument("--rate", type=float, help="API_RATE_PER_SEC (0 disables the limiter)")
+    parser.add_argument("--check-mode", choices=("full", "light"), help="RECOVERY_CHECK_MODE")
+    parser.add_argument("--outage", type=parse_duration, default=900.0,
+                        help="mean time until an alerted device's port really comes back (exponential, default 15m)")
+    parser.add_argument("--recover-rate", type=float, default=1.0,
+                        help="fraction of alerted devices that come back at all")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of API requests failing with 500")
+    parser.add_argument("--latency-ms", type=float, default=50.0,
+                        help="API latency for endpoints the logs have no timings for (+/- 50%%)")
+    parser.add_argument("--duration", type=parse_duration, default=6 * 3600.0,
+                        help="how long to keep simulating after the last alert (default 6h)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", metavar="FILE", help="also write the results as JSON")
+    return parser.parse_args()
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+# =======================
+# Log Parsing
+# =======================
+TEXT_LINE = re.compile(r"^(?P<ts>\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d(?:\.\d+)?)(?: \[[^\]]*\])* - (?P<msg>.*)$")
+ALERT_LINE = re.compile(r"🚨 Alert received: device_id=(?P<device>\S+)")
+LEGACY_ALERT_LINE = re.compile(r"^Device ID: (?P<device>\S+)")   # dialer1.py
+API_LINE = re.compile(r"^API (?P<method>[A-Z]+) (?P<endpoint>\S+) -> \S+ \((?P<ms>\d+) ms")
+
+def read_log(path, alerts, latencies):
+    """Append (epoch, device_id) alerts and {route: [ms]} API timings."""
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line.startswith("{"):
+                try:
+                    record = json.loads(line)
+                    ts, msg = datetime.fromisoformat(record["ts"]).timestamp(), record["msg"]
+                except (ValueError, KeyError, TypeError):
+                    continue
+            else:
+                m = TEXT_LINE.match(line)
+                if not m:
+                    continue
+                ts, msg = datetime.fromisoformat(m.group("ts")).timestamp(), m.group("msg")
+            m = ALERT_LINE.search(msg) or LEGACY_ALERT_LINE.match(msg)
+            if m:
+                alerts.append((ts, m.group("device")))
+                continue
+            m = API_LINE.match(msg)
+            if m:
+                route = f"{m.group('method')} {re.sub(r'/[0-9.]+(?=/|$)', '/{id}', m.group('endpoint'))}"
+                latencies.setdefault(route, []).append(int(m.group("ms")))
+
+def replay_schedule(alerts, scale, spread, rng):
+    """[(offset_sec, device_id)] with the logged devices renumbered 1..K and
+    every alert repeated for `scale` devices."""
+    if not alerts:
+        return [], 0
+    alerts.sort()
+    numbers = {}
+    for _, device in alerts:
+        numbers.setdefault(device, len(numbers) + 1)
+    known = len(numbers)
+    start = alerts[0][0]
+    schedule = []
+    for ts, device in alerts:
+        for copy in range(scale):
+            offset = ts - start + (rng.uniform(0, spread) if copy else 0.0)
+            schedule.append((offset, copy * known + numbers[device]))
+    schedule.sort()
+    return schedule, known * scale
+
+class LatencyModel:
+    """Samples a route's latency from its logged timings, from all logged
+    timings for a route never seen, or around `default_ms` with no logs."""
+    def __init__(self, samples, default_ms, rng):
+        self.samples = samples
+        self.pooled = [ms for values in samples.values() for ms in values]
+        self.default_ms = default_ms
+        self.rng = rng
+
+    def sample(self, route):
+        values = self.samples.get(route) or self.pooled
+        if values:
+            return self.rng.choice(values) / 1000.0
+        return self.default_ms * self.rng.uniform(0.5, 1.5) / 1000.0
+
+# =======================
+# Simulated Clock
+# =======================
+class SimClock:
+    def __init__(self, epoch):
+        self.epoch = epoch
+        self.elapsed = 0.0
+
+    def time(self):
+        return self.epoch + self.elapsed
+
+    def monotonic(self):
+        return self.elapsed
+
+class SimTime:
+    """Stands in for the `time` module inside prod.py."""
+    def __init__(self, clock):
+        self.clock = clock
+        self.time = clock.time
+        self.monotonic = clock.monotonic
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+def sim_datetime(clock):
+    class SimDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return cls.fromtimestamp(clock.time(), tz)
+    return SimDatetime
+
+class SimSelector(selectors.DefaultSelector):
+    """Never blocks while a timer is pending: the clock jumps to it. Every
+    loop iteration also costs a microsecond, as it would on a real clock;
+    without that, a wait rounded down to nothing (a token bucket a hair
+    short of a token) would spin at one instant forever."""
+    TICK_SEC = 1e-6
+
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if events or timeout is None:
+            self.clock.elapsed += self.TICK_SEC
+            return events or super().select(None)
+        self.clock.elapsed += max(timeout, self.TICK_SEC)
+        return []
+
+class SimEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self, clock):
+        super().__init__(SimSelector(clock))
+        self.clock = clock
+
+    def time(self):
+        return self.clock.monotonic()
+
+class CountingSemaphore(asyncio.Semaphore):
+    """Semaphore that knows how many holders it has and how many wait."""
+    def __init__(self, value):
+        super().__init__(value)
+        self.waiting = 0
+        self.held = 0
+
+    async def acquire(self):
+        self.waiting += 1
+        try:
+            await super().acquire()
+        finally:
+            self.waiting -= 1
+        self.held += 1
+        return True
+
+    def release(self):
+        self.held -= 1
+        super().release()
+
+# =======================
+# Simulated Fleet and API
+# =======================
+class SimFleet(FakeLibreNMS):
+    """FakeLibreNMS on the simulated clock: an alerted device's port comes
+    back at its outage_end (never, for inf), once its IP is restored."""
+    def __init__(self, devices, clock, error_rate, seed):
+        super().__init__(devices, latency_ms=0.0, error_rate=error_rate, seed=seed)
+        self.clock = clock
+        self.outage_end = {}
+
+    def _recovers(self, device_id):
+        return self.clock.time() >= self.outage_end.get(device_id, 0.0)
+
+def sim_client(prod, fleet, latency, clock):
+    class SimLibreClient(prod.AsyncLibreClient):
+        """prod.py's async client (retries, rate limit, connection limit)
+        with the network replaced by the simulated fleet."""
+        def __init__(self):
+            # A bucket of its own: prod.API's was started on the real clock.
+            super().__init__("http://librenms.sim/api/v0", "sim",
+                             prod.TokenBucket(prod.API_RATE_PER_SEC, prod.API_RATE_BURST))
+            self.slots = CountingSemaphore(self.max_connections)
+            self.open = 0                  # requests started, including waits for a token or connection
+            self.calls = Counter()         # route -> calls
+            self.per_minute = {}           # simulated minute -> Counter(route)
+
+        async def request(self, method, endpoint, data=None, params=None):
+            self.open += 1
+            try:
+                return await super().request(method, endpoint, data=data, params=params)
+            finally:
+                self.open -= 1
+
+        async def _exchange(self, method, target, body):
+            parts = urlsplit(target)
+            endpoint = parts.path[len(self.base_path):]
+            route = f"{method} {prod.endpoint_label(endpoint)}"
+            await asyncio.sleep(latency.sample(route))
+            status, payload = fleet.handle(method, parts.path, dict(parse_qsl(parts.query)),
+                                           json.loads(body) if body else None)
+            self.calls[route] += 1
+            self.per_minute.setdefault(int(clock.monotonic() // 60), Counter())[route] += 1
+            return prod.ApiResponse(method, f"{self.base_url}{endpoint}", status, {},
+                                    json.dumps(payload).encode(), len(body))
+    return SimLibreClient()
+
+# =======================
+# Replay
+# =======================
+class Replay:
+    def __init__(self, prod, fleet, client, schedule, args, rng):
+        self.prod = prod
+        self.fleet = fleet
+        self.client = client
+        self.schedule = schedule
+        self.args = args
+        self.rng = rng
+        self.open_since = {}      # device_id -> simulated time of the alert that opened it
+        self.ttr = []             # alert -> released, seconds
+        self.lag = []             # port really back -> released, seconds
+        self.samples = []         # one (intake, checks waiting, checks running, API waiting, tracked) per second
+        self.answers = Counter()
+        self.replayed = 0
+
+    def send(self, device_id):
+        prod, now = self.prod, self.fleet.clock.time()
+        ip = self.fleet.device_ip(device_id)
+        body = json.dumps({"host": ip, "device_id": str(device_id), "ip": ip}).encode()
+        if str(device_id) not in self.open_since and self.fleet.outage_end.get(device_id, 0.0) <= now:
+            self.fleet.outage_end[device_id] = (now + self.rng.expovariate(1.0 / self.args.outage)
+                                                if self.rng.random() < self.args.recover_rate else float("inf"))
+        code, answer, _ = prod.ASYNC_SERVER._dispatch("POST", "/", {}, body)
+        self.answers[f"{code} {answer.decode()}"] += 1
+        if code == 503:
+            # LibreNMS re-sends the alert later; model that as one retry per Retry-After.
+            asyncio.get_running_loop().call_later(prod.INTAKE_RETRY_AFTER_SEC, self.send, device_id)
+        elif answer == b"Accepted":
+            self.open_since.setdefault(str(device_id), now)
+
+    def released(self, device_id):
+        now = self.fleet.clock.time()
+        opened = self.open_since.pop(str(device_id), None)
+        if opened is not None:
+            self.ttr.append(now - opened)
+            self.lag.append(now - self.fleet.outage_end.get(int(device_id), opened))
+
+    async def sample(self):
+        prod = self.prod
+        while True:
+            slots = prod.RECOVERY.slots
+            self.samples.append((prod.ASYNC_SERVER.pending, slots.waiting, slots.held,
+                                 self.client.open - self.client.slots.held, prod.STATE.count()))
+            await asyncio.sleep(1)
+
+    async def run(self):
+        prod, loop = self.prod, asyncio.get_running_loop()
+        prod.RECOVERY.start()
+        prod.RECOVERY.slots = CountingSemaphore(prod.RECOVERY.concurrency)
+        sampler = loop.create_task(self.sample())
+        start = loop.time()
+        for offset, device_id in self.schedule:
+            if start + offset > loop.time():
+                await asyncio.sleep(start + offset - loop.time())
+            self.send(device_id)
+            self.replayed += 1
+        deadline = loop.time() + self.args.duration
+        while loop.time() < deadline and (prod.STATE.count() or prod.ASYNC_SERVER.pending):
+            await asyncio.sleep(1)
+        sampler.cancel()
+        for task in list(prod.RECOVERY.tasks.values()) + list(prod.ASYNC_SERVER.intake):
+            task.cancel()
+        await asyncio.sleep(0)
+
+def summarize(replay, prod, clock, wall_sec, devices):
+    client = replay.client
+    minutes = max(1, int(clock.monotonic() // 60) + 1)
+    routes = {}
+    for route, total in sorted(client.calls.items(), key=lambda item: -item[1]):
+        peak = max(counts[route] for counts in client.per_minute.values())
+        routes[route] = {"calls": total, "per_min": total / minutes, "peak_per_min": peak}
+    all_peak = max((sum(c.values()) for c in client.per_minute.values()), default=0)
+    discover = [sum(n for r, n in c.items() if r.endswith("/discover")) for c in client.per_minute.values()]
+    queues = {}
+    for i, name in enumerate(("intake_pending", "checks_waiting", "checks_running", "api_waiting", "tracked")):
+        series = [s[i] for s in replay.samples]
+        queues[name] = {"mean": sum(series) / len(series) if series else 0,
+                        "p95": percentile(series, 95) or 0, "max": max(series, default=0)}
+    with prod.METRICS.lock:
+        checks = {dict(labels).get("result"): v for (name, labels), v in prod.METRICS.counters.items()
+                  if name == "recovery_checks_total"}
+    return {
+        "simulated_sec": clock.monotonic(),
+        "wall_sec": wall_sec,
+        "devices": devices,
+        "alerts": replay.replayed,
+        "answers": dict(replay.answers),
+        "checks": checks,
+        "api_calls": sum(client.calls.values()),
+        "api_calls_per_min": sum(client.calls.values()) / minutes,
+        "api_calls_peak_per_min": all_peak,
+        "discoveries": sum(discover),
+        "discoveries_per_min": sum(discover) / minutes,
+        "discoveries_peak_per_min": max(discover, default=0),
+        "routes": routes,
+        "queues": queues,
+        "recovered": len(replay.ttr),
+        "still_tracked": prod.STATE.count(),
+        "time_to_recovery_sec": {p: percentile(replay.ttr, p) for p in (50, 95, 100)},
+        "detection_lag_sec": {p: percentile(replay.lag, p) for p in (50, 95, 100)},
+    }
+
+def print_report(r, config):
+    def sec(value):
+        return "-" if value is None else f"{value / 60:.1f} min" if value >= 120 else f"{value:.0f} s"
+
+    print(f"\n=== Replay: {r['alerts']} alerts for {r['devices']} devices ===")
+    print(f"config            interval {config['RECOVERY_INTERVAL_SEC']}s, {config['ASYNC_RECOVERY_CONCURRENCY']} checks / "
+          f"{config['ASYNC_API_CONNECTIONS']} API requests in flight, {config['API_RATE_PER_SEC']} API calls/s, "
+          f"backoff x{config['RECOVERY_BACKOFF_FACTOR']} up to {config['RECOVERY_BACKOFF_MAX_SEC']}s, "
+          f"{config['RECOVERY_CHECK_MODE']} checks")
+    print(f"simulated         {r['simulated_sec'] / 3600:.2f} h in {r['wall_sec']:.1f} s "
+          f"({r['simulated_sec'] / max(r['wall_sec'], 1e-9):.0f}x real time)")
+    print(f"intake answers    {r['answers']}")
+    print(f"recovery checks   {r['checks']}")
+
+    print("\n=== API load ===")
+    print(f"all calls         {r['api_calls']} ({r['api_calls_per_min']:.1f}/min, peak {r['api_calls_peak_per_min']}/min)")
+    print(f"discoveries       {r['discoveries']} ({r['discoveries_per_min']:.1f}/min, peak {r['discoveries_peak_per_min']}/min)")
+    print(f"{'route':<40} {'calls':>8} {'per min':>8} {'peak/min':>9}")
+    for route, s in r["routes"].items():
+        print(f"{route[:40]:<40} {s['calls']:>8} {s['per_min']:>8.1f} {s['peak_per_min']:>9}")
+
+    print("\n=== Queue depths (sampled every simulated second) ===")
+    print(f"{'queue':<20} {'mean':>8} {'p95':>8} {'max':>8}")
+    for name, q in r["queues"].items():
+        print(f"{name:<20} {q['mean']:>8.1f} {q['p95']:>8} {q['max']:>8}")
+
+    print("\n=== Time to recovery ===")
+    ttr, lag = r["time_to_recovery_sec"], r["detection_lag_sec"]
+    print(f"recovered          {r['recovered']} devices, {r['still_tracked']} still tracked at the end")
+    print(f"alert -> release   p50 {sec(ttr[50])}, p95 {sec(ttr[95])}, max {sec(ttr[100])}")
+    print(f"port up -> release p50 {sec(lag[50])}, p95 {sec(lag[95])}, max {sec(lag[100])}")
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    alerts, latencies = [], {}
+    for path in args.logs:
+        read_log(path, alerts, latencies)
+    if not alerts:
+        raise SystemExit(f"No alerts found in {', '.join(args.logs)}.")
+    epoch = min(ts for ts, _ in alerts)
+    schedule, devices = replay_schedule(alerts, args.scale, args.spread, rng)
+
+    # prod.py reads its configuration at import time; flags and explicit env vars win.
+    workdir = tempfile.mkdtemp(prefix="alert-sim-")
+    overrides = {"RECOVERY_INTERVAL_SEC": args.interval, "ASYNC_RECOVERY_CONCURRENCY": args.workers,
+                 "ASYNC_API_CONNECTIONS": args.connections, "RECOVERY_BACKOFF_FACTOR": args.backoff_factor,
+                 "RECOVERY_BACKOFF_MAX_SEC": args.backoff_max, "API_RATE_PER_SEC": args.rate,
+                 "RECOVERY_CHECK_MODE": args.check_mode}
+    for key, value in overrides.items():
+        if value is not None:
+            os.environ[key] = str(value)
+    os.environ.update({
+        "LIBRENMS_URL": "http://librenms.sim/api/v0",
+        "LIBRENMS_API_TOKEN": "sim",
+        "STATE_FILE": os.path.join(workdir, "device_state.json"),
+        "STATE_DB": os.path.join(workdir, "device_state.db"),
+        "POLL_BACKEND": "none",
+        "SHARD_MODE": "0",
+        "TRACE_SAMPLE_RATE": "0",
+    })
+    os.environ.setdefault("LOG_LEVEL", "ERROR")
+    os.environ.setdefault("INTAKE_QUEUE_MAX", str(max(1000, devices)))
+
+    clock = SimClock(epoch)
+    import librenms_common
+    import prod
+    prod.time = librenms_common.time = SimTime(clock)   # the shared rate limiter and metric timers too
+    prod.datetime = sim_datetime(clock)
+    prod.open_state()
+    fleet = SimFleet(devices, clock, args.error_rate, args.seed)
+    client = sim_client(prod, fleet, LatencyModel(latencies, args.latency_ms, rng), clock)
+    prod.ASYNC_API = client
+    prod.RECOVERY = prod.AsyncRecoveryManager()
+    random.seed(args.seed)   # prod.py's splay and backoff jitter
+
+    replay = Replay(prod, fleet, client, schedule, args, rng)
+    remove_device = prod.remove_device
+
+    def released(device_id):
+        replay.released(device_id)
+        return remove_device(device_id)
+    prod.remove_device = released
+
+    timed = sum(len(v) for v in latencies.values())
+    print(f"Replaying {len(alerts)} logged alerts x{args.scale} ({devices} devices) with "
+          f"{timed} logged API timings over {len(latencies)} routes.", flush=True)
+    started = time.monotonic()
+    loop = SimEventLoop(clock)
+    try:
+        loop.run_until_complete(replay.run())
+    finally:
+        loop.close()
+    wall = time.monotonic() - started
+
+    prod.LOGGER.flush()
+    config = {k: getattr(prod, k) for k in ("RECOVERY_INTERVAL_SEC", "ASYNC_RECOVERY_CONCURRENCY",
+                                            "ASYNC_API_CONNECTIONS", "API_RATE_PER_SEC",
+                                            "RECOVERY_BACKOFF_FACTOR", "RECOVERY_BACKOFF_MAX_SEC",
+                                            "RECOVERY_CHECK_MODE")}
+    results = summarize(replay, prod, clock, wall, devices)
+    print_report(results, config)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": dict(vars(args), **config), "results": results}, f, indent=2, default=str)
+        print(f"\nResults written to {args.json}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+import os
+import sys
+
+# prod.py reads its configuration at import time. Point it at nothing real.
+os.environ.setdefault("LIBRENMS_URL", "http://127.0.0.1:9/api/v0")
+os.environ.setdefault("LIBRENMS_API_TOKEN", "test")
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+os.environ.setdefault("TRACE_SAMPLE_RATE", "0")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
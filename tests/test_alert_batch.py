@@ -0,0 +1,189 @@
+import asyncio
+import http.client
+import json
+import threading
+
+import pytest
+
+import prod
+
+VALID = {"host": "10.0.0.5", "device_id": "5", "ip": "10.0.0.5"}
+
+def parse(body, chunk_size=None):
+    """Everything AlertStreamParser yields for `body`, fed in chunks."""
+    parser = prod.AlertStreamParser()
+    data = body.encode() if isinstance(body, str) else body
+    chunk_size = chunk_size or len(data) or 1
+    items = []
+    for i in range(0, len(data), chunk_size):
+        items += parser.feed(data[i:i + chunk_size])
+    return items + parser.feed(b"", final=True)
+
+def reasons(items):
+    return [i.reason if isinstance(i, prod.AlertRejected) else "ok" for i in items]
+
+@pytest.fixture
+def state(tmp_path):
+    prod.STATE.open(prod.JournalStateStore(str(tmp_path / "state.json"), str(tmp_path / "state.json.journal")))
+    yield prod.STATE
+    for device_id in list(prod.RECOVERY.scheduled):
+        prod.RECOVERY.unschedule(device_id)
+    prod.STATE.replace_all({})
+
+# =======================
+# AlertStreamParser
+# =======================
+@pytest.mark.parametrize("chunk_size", [None, 1, 2, 7])
+def test_array_split_across_chunks(chunk_size):
+    body = json.dumps([VALID, dict(VALID, device_id="6"), {"note": "café ☃"}], ensure_ascii=False)
+    items = parse(body, chunk_size)
+    assert items == [VALID, dict(VALID, device_id="6"), {"note": "café ☃"}]
+
+@pytest.mark.parametrize("chunk_size", [None, 1, 3])
+def test_ndjson_split_across_chunks(chunk_size):
+    body = "\n".join(json.dumps(dict(VALID, device_id=str(d))) for d in range(1, 4)) + "\n"
+    assert [i["device_id"] for i in parse(body, chunk_size)] == ["1", "2", "3"]
+
+@pytest.mark.parametrize("chunk_size", [None, 1])
+def test_array_trailing_comma_is_rejected(chunk_size):
+    assert reasons(parse('[{"a":1},]', chunk_size)) == ["ok", "invalid_json"]
+    assert reasons(parse('[{"a":1} \n ]', chunk_size)) == ["ok"]
+    assert reasons(parse('[{"a":1} , \n ]', chunk_size)) == ["ok", "invalid_json"]
+
+def test_array_malformed_element_ends_batch():
+    assert reasons(parse('[{"a":1}, {bad}, {"b":2}]')) == ["ok", "invalid_json"]
+    assert reasons(parse('[{"a":1} {"b":2}]')) == ["ok", "invalid_json"]
+    assert reasons(parse('[{"a":1}, ,{"b":2}]')) == ["ok", "invalid_json"]
+
+def test_array_unterminated_is_rejected():
+    assert reasons(parse('[{"a":1}, {"b":2}')) == ["ok", "ok", "invalid_json"]
+
+def test_ndjson_malformed_line_only_rejects_that_line():
+    assert reasons(parse('{"a":1}\n{bad\n{"b":2}')) == ["ok", "invalid_json", "ok"]
+
+def test_empty_bodies():
+    assert parse("") == []
+    assert parse("[]") == []
+    assert parse(" \n ") == []
+
+# =======================
+# Item validation
+# =======================
+@pytest.mark.parametrize("payload, reason", [
+    ({"device": 5}, "invalid_fields"),
+    ({"device": [1, 2], "host": "h", "ip": "i"}, "invalid_fields"),
+    ({"device_id": {"x": 1}, "host": "h", "ip": "i"}, "invalid_fields"),
+    ({"device_id": ["5"], "host": "h", "ip": "i"}, "invalid_fields"),
+    ({"device_id": True, "host": "h", "ip": "i"}, "invalid_fields"),
+    ({"device_id": "5", "host": {"h": 1}, "ip": "i"}, "invalid_fields"),
+    ({"device_id": "5", "host": "h"}, "missing_fields"),
+    (dict(VALID, group=["a"]), "invalid_supervision"),
+    (dict(VALID, rule="sometimes"), "invalid_supervision"),
+    ([VALID], "invalid_json"),
+    ("5", "invalid_json"),
+])
+def test_invalid_items_are_rejected(payload, reason):
+    entry = prod.batch_entry(0, payload, "test")
+    assert isinstance(entry, prod.AlertRejected)
+    assert entry.reason == reason
+    with pytest.raises(prod.AlertRejected):
+        prod.parse_alert(json.dumps(payload).encode())
+
+def test_valid_items_are_accepted():
+    assert prod.batch_entry(0, VALID, "test")[0] == "5"
+    device_id, info = prod.batch_entry(0, {"device": {"device_id": 7, "hostname": "h", "ip": "1.2.3.4"}}, "test")
+    assert device_id == 7 and info["ip"] == "1.2.3.4"
+
+def test_mixed_batch_results_in_order(state):
+    body = json.dumps([VALID, {"device": 5}, dict(VALID, device_id="6"), VALID, {"device_id": {"x": 1}, "host": "h", "ip": "i"}])
+    entries = [prod.batch_entry(i, item, "test") for i, item in enumerate(parse(body))]
+    results, new = prod.record_alert_batch(entries, "test")
+    assert [(r["index"], r["status"]) for r in results] == [
+        (0, "accepted"), (1, "rejected"), (2, "accepted"), (3, "duplicate"), (4, "rejected")]
+    assert [r.get("reason") for r in results if r["status"] == "rejected"] == ["invalid_fields", "invalid_fields"]
+    assert [d for d, _ in new] == ["5", "6"]
+    assert sorted(state.load_all()) == ["5", "6"]
+
+def test_tracked_device_never_forced_down_is_retried(state):
+    entries = [prod.batch_entry(0, VALID, "test")]
+    prod.record_alert_batch(entries, "test")
+    # The first force-down failed or was deferred: the repeated alert queues it again.
+    results, new = prod.record_alert_batch(entries, "test")
+    assert [r["status"] for r in results] == ["accepted"] and [d for d, _ in new] == ["5"]
+
+    prod.FORCE_DOWNS.add(["5"])
+    try:
+        assert prod.record_alert_batch(entries, "test")[1] == []
+    finally:
+        prod.FORCE_DOWNS.discard(["5"])
+
+    prod.update_device("5", applied_ip=prod.UNSUPERVISED_IP)
+    results, new = prod.record_alert_batch(entries, "test")
+    assert [r["status"] for r in results] == ["duplicate"] and new == []
+
+# =======================
+# Webhook
+# =======================
+@pytest.fixture
+def server(state):
+    httpd = prod.AlertHTTPServer(("127.0.0.1", 0), prod.AlertHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+def post(port, path, body):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    try:
+        conn.request("POST", path, body=body, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+def test_webhook_answers_malformed_device(server):
+    assert post(server, "/", b'{"device": "x"}')[0] == 400
+    assert post(server, "/", b'{"device_id": {"x": 1}, "host": "h", "ip": "i"}')[0] == 400
+
+def test_batch_webhook_answers_every_item(server):
+    status, body = post(server, "/alerts/batch", json.dumps([{"device": 5}, VALID]).encode())
+    assert status in (200, 202)
+    reply = json.loads(body)
+    assert (reply["accepted"], reply["rejected"]) == (1, 1)
+    assert [r["status"] for r in reply["results"]] == ["rejected", "accepted"]
+
+def test_async_dispatch_answers_malformed_device(state):
+    code, _, _ = prod.ASYNC_SERVER._dispatch("POST", "/", {}, b'{"device": 5}')
+    assert code == 400
+
+def async_exchange(raw):
+    """What the async engine's server answers to the raw request bytes."""
+    async def run():
+        server = await prod.ASYNC_SERVER.serve("127.0.0.1", 0, 8)
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.sockets[0].getsockname()[1])
+        writer.write(raw)
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        server.close()
+        return response
+    return asyncio.run(run())
+
+@pytest.mark.parametrize("raw, status", [
+    (b"GARBAGE\r\n\r\n", 400),
+    (b"POST / HTTP/1.1 extra\r\n\r\n", 400),
+    (b"POST / HTTP/1.1\r\nContent-Length: abc\r\n\r\n", 400),
+    (b"POST / HTTP/1.1\r\nContent-Length: -1\r\n\r\n", 400),
+    (b"POST / HTTP/1.1\r\nContent-Length: 99999999\r\n\r\n", 413),
+    (b"POST /alerts/batch HTTP/1.1\r\nContent-Length: 11\r\n\r\n", 413),
+    (b"POST /alerts/batch HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n", 400),
+    (b"GET /" + b"x" * 65536 + b" HTTP/1.1\r\n\r\n", 414),
+    (b"GET / HTTP/1.1\r\n" + b"X-Long: " + b"x" * 65536 + b"\r\n\r\n", 431),
+    (b"GET / HTTP/1.1\r\n" + b"X-Many: 1\r\n" * 101 + b"\r\n", 431),
+])
+def test_async_server_answers_malformed_requests(state, monkeypatch, raw, status):
+    monkeypatch.setattr(prod.ASYNC_SERVER, "MAX_BATCH_BYTES", 10)
+    response = async_exchange(raw)
+    assert response.split(b" ", 2)[1] == str(status).encode()
+    assert b"Connection: close" in response
@@ -0,0 +1,100 @@
+from datetime import datetime
+
+import pytest
+
+import prod
+
+NOW = 1_800_000_000.0
+ADDED_AT = "2026-01-01T00:00:00"
+
+@pytest.fixture(autouse=True)
+def schedule_config(monkeypatch):
+    monkeypatch.setattr(prod, "RECOVERY_INTERVAL_SEC", 1200)
+    monkeypatch.setattr(prod, "RECOVERY_SPLAY_SEC", 300)
+    monkeypatch.setattr(prod, "RECOVERY_BACKOFF_FACTOR", 2.0)
+    monkeypatch.setattr(prod, "RECOVERY_BACKOFF_MAX_SEC", 14400)
+    monkeypatch.setattr(prod, "RECOVERY_BACKOFF_JITTER", 0.0)
+
+# =======================
+# Splay
+# =======================
+def test_splay_is_stable_and_in_range():
+    splays = [prod.device_splay(d) for d in range(1000)]
+    assert splays == [prod.device_splay(str(d)) for d in range(1000)]
+    assert all(0 <= s < 300 for s in splays)
+    # Spread over the whole range, not bunched at one end.
+    assert min(splays) < 30 and max(splays) > 270
+
+def test_splay_disabled(monkeypatch):
+    monkeypatch.setattr(prod, "RECOVERY_SPLAY_SEC", 0)
+    assert {prod.device_splay(d) for d in range(100)} == {0}
+
+# =======================
+# Backoff
+# =======================
+@pytest.mark.parametrize("attempts, delay", [
+    (0, 1200),
+    (1, 1200),
+    (2, 2400),
+    (3, 4800),
+    (4, 9600),
+    (5, 14400),    # 19200 capped
+    (20, 14400),
+])
+def test_backoff_delay(attempts, delay):
+    assert prod.backoff_delay(attempts) == delay
+
+@pytest.mark.parametrize("attempts, delay", [(1, 1200), (3, 4800), (9, 14400)])
+def test_backoff_jitter_bounds(monkeypatch, attempts, delay):
+    monkeypatch.setattr(prod, "RECOVERY_BACKOFF_JITTER", 0.1)
+    delays = [prod.backoff_delay(attempts) for _ in range(200)]
+    assert all(0.9 * delay <= d <= 1.1 * delay for d in delays)
+    assert len(set(delays)) > 1
+
+# =======================
+# Next check time
+# =======================
+@pytest.mark.parametrize("info, expected", [
+    ({"added_at": ADDED_AT}, lambda d: datetime.fromisoformat(ADDED_AT).timestamp() + 1200 - prod.device_splay(d)),
+    ({"added_at": ADDED_AT, "attempts": 0}, lambda d: datetime.fromisoformat(ADDED_AT).timestamp() + 1200 - prod.device_splay(d)),
+    ({}, lambda d: NOW + 1200 - prod.device_splay(d)),
+    ({"added_at": "not a date"}, lambda d: NOW + 1200 - prod.device_splay(d)),
+    ({"added_at": ADDED_AT, "attempts": 1}, lambda d: NOW + 1200),
+    ({"added_at": ADDED_AT, "attempts": 2}, lambda d: NOW + 2400),
+    ({"attempts": "3"}, lambda d: NOW + 4800),
+    ({"attempts": 12}, lambda d: NOW + 14400),
+])
+@pytest.mark.parametrize("device_id", ["5", "1234"])
+def test_next_check_time(device_id, info, expected):
+    assert prod.next_check_time(device_id, info, now=NOW) == pytest.approx(expected(device_id))
+
+def test_first_checks_of_a_burst_are_spread():
+    due = [prod.next_check_time(d, {"added_at": ADDED_AT}, now=NOW) for d in range(200)]
+    assert max(due) - min(due) > 240
+    assert len(set(due)) == 200
+
+# =======================
+# Flap detection
+# =======================
+@pytest.mark.parametrize("times, counts", [
+    ([0, 10, 20], [1, 2, 3]),
+    ([0, 100], [1, 2]),              # window edge is inclusive
+    ([0, 50, 101, 102], [1, 2, 2, 3]),
+    ([0, 1000, 2000], [1, 1, 1]),
+])
+def test_flap_window_counts(times, counts):
+    flaps = prod.FlapDetector(threshold=3, window_sec=100)
+    assert [flaps.record("5", now=t) for t in times] == counts
+
+@pytest.mark.parametrize("threshold, count, flapping", [
+    (3, 2, False),
+    (3, 3, True),
+    (3, 7, True),
+    (0, 100, False),                 # 0 disables flap damping
+])
+def test_is_flapping(threshold, count, flapping):
+    assert prod.FlapDetector(threshold=threshold, window_sec=100).is_flapping(count) is flapping
+
+def test_flap_counts_are_per_device():
+    flaps = prod.FlapDetector(threshold=3, window_sec=100)
+    assert [flaps.record(d, now=1) for d in ("5", 5, "6", "5")] == [1, 2, 1, 3]
@@ -0,0 +1,48 @@
+import os
+import threading
+
+import prod
+
+def leases(path, instance_id):
+    return prod.ShardLeases(str(path), instance_id=instance_id, shards=8, ttl_sec=60, renew_sec=10)
+
+def test_moved_shard_drains_before_handover(tmp_path):
+    a = leases(tmp_path / "state.db", "a")
+    a.renew()
+    assert len(a.owned) == 8
+
+    b = leases(tmp_path / "state.db", "b")
+    b.renew()   # b is a member now, but every shard is still leased by a
+    assert not b.owned
+
+    ring = prod.HashRing(["a", "b"])
+    moving = next(s for s in range(8) if ring.owner(f"shard-{s}") == "b")
+    device_id = next(str(d) for d in range(1000) if prod.shard_of(d, 8) == moving)
+    assert a.begin_checks([device_id]) == [device_id]
+
+    a.renew()
+    assert moving not in a.owned and moving in a.draining
+    assert not a.owns(device_id) and a.holds(device_id)
+    assert a.begin_checks([device_id]) == []   # no new checks on a draining shard
+    b.renew()
+    assert moving not in b.owned
+
+    a.end_checks([device_id])
+    a.renew()
+    assert not a.holds(device_id) and not a.draining
+    b.renew()
+    assert moving in b.owned and b.owns(device_id)
+
+def test_instances_starting_together_migrate_once(tmp_path):
+    json_path = str(tmp_path / "device_state.json")
+    prod.write_state_file(json_path, {"5": {"hostname": "h5", "ip": "10.0.0.5"}})
+    stores = []
+    threads = [threading.Thread(target=lambda: stores.append(
+        prod.SqliteStateStore(str(tmp_path / "state.db"), json_path))) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(stores) == 4
+    assert list(stores[0].load_all()) == ["5"]
+    assert not os.path.exists(json_path) and os.path.exists(json_path + ".migrated")
@@ -0,0 +1,100 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import textwrap
+import time
+
+import pytest
+
+import prod
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def paths(tmp_path):
+    return str(tmp_path / "state.json"), str(tmp_path / "state.json.journal")
+
+def write_journal(path, entries, tail=""):
+    with open(path, "w") as f:
+        f.write("".join(json.dumps(e) + "\n" for e in entries) + tail)
+
+def wait_flushed(store, timeout=5):
+    deadline = time.monotonic() + timeout
+    while store.pending and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not store.pending
+
+def test_replay_applies_journal_over_snapshot(paths):
+    snapshot, journal = paths
+    prod.write_state_file(snapshot, {"1": {"hostname": "a"}, "2": {"hostname": "b"}})
+    write_journal(journal, [
+        {"op": "put", "id": "3", "data": {"hostname": "c"}},
+        {"op": "patch", "id": "1", "data": {"attempts": 2}},
+        {"op": "del", "id": "2"},
+        {"op": "patch", "id": "9", "data": {"attempts": 1}},   # never tracked: ignored
+    ])
+    assert prod.JournalStateStore(snapshot, journal).load_all() == {
+        "1": {"hostname": "a", "attempts": 2}, "3": {"hostname": "c"}}
+
+def test_replay_stops_at_torn_last_line(paths):
+    snapshot, journal = paths
+    write_journal(journal, [{"op": "put", "id": "1", "data": {"hostname": "a"}},
+                            {"op": "patch", "id": "1", "data": {"attempts": 1}}],
+                  tail='{"op": "put", "id": "2", "da')
+    assert prod.JournalStateStore(snapshot, journal).load_all() == {"1": {"hostname": "a", "attempts": 1}}
+
+def test_compaction_folds_journal_into_snapshot(paths):
+    snapshot, journal = paths
+    table = prod.DeviceTable()
+    table.open(prod.JournalStateStore(snapshot, journal, fsync_ms=0, compact_ops=3))
+    table.upsert("1", {"hostname": "a"})
+    table.upsert("2", {"hostname": "b"})
+    assert not table.store.needs_compaction()
+    table.update("1", attempts=4)   # third op: compacts
+    table.flush()
+    assert os.path.getsize(journal) == 0
+    assert prod.read_state_file(snapshot) == table.load_all()
+
+    table.delete("2")
+    table.flush()
+    assert prod.JournalStateStore(snapshot, journal).load_all() == table.load_all()
+    assert list(table.load_all()) == ["1"]
+
+def test_fsync_covers_a_whole_batch(paths, monkeypatch):
+    snapshot, journal = paths
+    fsyncs = []
+    real_fsync = os.fsync
+    monkeypatch.setattr(prod.os, "fsync", lambda fd: (fsyncs.append(fd), real_fsync(fd)))
+    store = prod.JournalStateStore(snapshot, journal, fsync_ms=200, compact_ops=10 ** 6)
+    for i in range(100):
+        store.upsert(str(i), {"hostname": f"h{i}"})
+    wait_flushed(store)
+    assert len(fsyncs) == 1
+    with open(journal) as f:
+        assert len(f.readlines()) == 100
+
+def test_killed_mid_batch_reloads_last_flushed_state(paths):
+    snapshot, journal = paths
+    script = textwrap.dedent(f"""
+        import os, signal
+        import prod
+        store = prod.JournalStateStore({snapshot!r}, {journal!r}, fsync_ms=60000, compact_ops=10 ** 6)
+        store.compact({{"1": {{"hostname": "a"}}}})
+        store.apply_many([("put", "2", {{"hostname": "b"}}), ("patch", "1", {{"attempts": 1}})])
+        store.flush()
+        store.apply_many([("put", "3", {{"hostname": "c"}}), ("del", "1", None)])
+        os.kill(os.getpid(), signal.SIGKILL)   # before the flush thread writes the batch
+    """)
+    proc = subprocess.run([sys.executable, "-c", script], cwd=REPO, capture_output=True, timeout=60)
+    assert proc.returncode == -signal.SIGKILL, proc.stderr.decode()
+
+    table = prod.DeviceTable()
+    table.open(prod.JournalStateStore(snapshot, journal))
+    state = table.load_all()
+    assert sorted(state) == ["1", "2"]
+    assert (state["1"]["attempts"], state["2"]["hostname"]) == (1, "b")
+    # Reopening compacted the replayed journal into the snapshot.
+    assert os.path.getsize(journal) == 0
+    assert set(prod.read_state_file(snapshot)) == {"1", "2"}